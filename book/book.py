@@ -9,7 +9,7 @@
 #   illustrated childrens books, sketchbooks, storyboards or similar.
 #
 # INSTALLATION
-#   Drop the script in your plug-ins folder. On Linux this is ~/.gimp-2.8/plug-ins/
+#   Drop the script, along with booktags.py, in your plug-ins folder. On Linux this is ~/.gimp-2.8/plug-ins/
 #
 # VERSION
 version = "current_version"
@@ -47,10 +47,31 @@ import gtk
 import gobject
 import urllib
 import re
+import sys
+import collections
+import subprocess
+import tempfile
+import multiprocessing
+import struct
+import zlib
+import zipfile
+import csv
+import difflib
+import mmap
+import time
+import random
+import ctypes
+import ctypes.util
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None # Some GIMP builds come without it. Books then keep their pages in the .book file.
 from sys import path
 from gimpfu import *
 from gimpenums import *
 from time import strftime
+from xml.sax.saxutils import escape, quoteattr
+from booktags import TagFilter, tag_filter, layer_tags, xcf_layers
 
 # Translation implementation
 import locale
@@ -85,46 +106,1304 @@ _ = language.ugettext #use ugettext instead of getttext to avoid unicode errors
 
 THUMBMIN=128
 THUMBMAX=512
+THUMBSIZES=[ 32, 64, 128, 256, 512, 1024 ] # All thumb sizes, built together from one load of the page.
+BATCHPOLL=250 # Milliseconds between checking on batch workers.
+BATCHMIN=4    # Fewer jobs than this are done in-process, as starting GIMP takes a while. Exports always use workers.
+THUMBCACHE=64*1024*1024 # Bytes of decoded thumbs to keep around, outside of the visible ones.
+THUMBPACK="thumbs.pack" # All the thumbs of a size in one file, in each size's folder.
+THUMBPACKSLACK=4*1024*1024 # Bytes of replaced thumbs a ThumbPack may hold, before it's compacted.
+EXPORTMANIFEST=".book-export.json" # Records what was exported to a folder.
+EXPORTQUEUE="exports.json" # Exports queued or interrupted, next to the .book file.
+BOOKJOURNAL="book.journal" # Changes not yet written to the .book file, next to it.
+BOOKSAVEDELAY=2000 # Milliseconds to wait for more changes, before rewriting the .book file.
+BOOKDATABASE="pages.sqlite" # Page list of books stored in SQLite, next to the .book file.
+BOOKGAP=1024.0 # Gap between the positions of pages in a BookDatabase, leaving room to insert pages between them.
+COMICINFO=[ 'Series', 'Number', 'Count', 'Volume', 'Summary', 'Notes', 'Year', 'Month', 'Day', 'Writer', 'Penciller',
+            'Inker', 'Colorist', 'Letterer', 'CoverArtist', 'Editor', 'Publisher', 'Genre', 'Web', 'LanguageISO',
+            'BlackAndWhite', 'AgeRating' ] # Fields of a .book file's info, in the order ComicInfo.xml wants them.
+WATCHDELAY=500  # Milliseconds to wait for more changes to pages, before acting on them.
+WATCHPOLL=2000  # Milliseconds between polls, when inotify isn't available.
+WATCHBATCH=64   # Pages checked per poll.
 
 class Thumb():
     # Managing thumbnails, and creating new ones when needed.
-    def __init__(self, imagepath, size, main):
+    def __init__(self, imagepath, size, main, build=True, index=None):
         self.imagepath = imagepath # bla/pages/one.xcf
         self.size = size
         self.main = main
+        self.index = index # ThumbIndex of the book, if any.
         imagename = os.path.split(imagepath)[1]
-        self.thumbdir = os.path.join(os.path.split(os.path.split(imagepath)[0])[0], 'thumbs', str(size))
+        self.thumbroot = os.path.join(os.path.split(os.path.split(imagepath)[0])[0], 'thumbs')
+        self.thumbdir = os.path.join(self.thumbroot, str(size))
         self.path = os.path.join(self.thumbdir, imagename+'.png')
-        self.get_thumb()
+        self.thumbpix = None
+        if build:
+            self.get_thumb()
 
     def get_thumb(self):
         # Fetch the thumb, if it exists.
-        if os.path.exists(self.path) and os.path.exists(self.imagepath):
-            if float(os.stat(self.path).st_mtime) < float(os.stat(self.imagepath).st_mtime):
-                self.build_thumb()
-        else:
-            if os.path.exists(self.imagepath):
-                self.build_thumb()
-        self.thumbpix = gtk.gdk.pixbuf_new_from_file(self.path)
+        if self.is_stale():
+            self.build_thumb()
+        self.load_thumb()
+
+    def is_stale(self, check=True):
+        # True if the thumb is missing, or older than the image. Without check, the index is trusted without looking at the image.
+        if self.index:
+            return self.index.is_stale(self.imagepath, self.size, self.path, check)
+        if not os.path.exists(self.imagepath):
+            return False
+        if not os.path.exists(self.path):
+            return True
+        return float(os.stat(self.path).st_mtime) < float(os.stat(self.imagepath).st_mtime)
+
+    def load_thumb(self):
+        # Read the thumb from disk, returns None if there is none.
+        try:
+            self.thumbpix = gtk.gdk.pixbuf_new_from_file(self.path)
+        except gobject.GError:
+            self.thumbpix = None
+        return self.thumbpix
 
     def build_thumb(self):
         # Build or rebuild a thumb for the image.
         self.main.progress.show()
         while gtk.events_pending():
             gtk.main_iteration()
-        if not os.path.exists(self.thumbdir):
-            os.makedirs(self.thumbdir)
-        img = pdb.gimp_file_load(self.imagepath, self.imagepath)
-        img.flatten()
-        width = int(self.size) if img.width > img.height else int(float(img.width) / img.height * self.size)
-        height = int(self.size) if img.height > img.width else int(float(img.height) / img.width * self.size)
-        pdb.gimp_image_scale_full(img, width, height, 2)
-        drw = pdb.gimp_image_get_active_layer(img)
-        thumbname = os.path.split(self.path)[1]
-        pdb.file_png_save(img, drw, self.path, thumbname, False, 9, False, False, False, True, True)
-        pdb.gimp_image_delete(img)
+        signature = make_thumbs(self.imagepath, self.thumbroot)
+        if self.index:
+            self.index.update(self.imagepath, signature)
+            self.index.save()
         self.main.progress.hide()
 
+    def job(self):
+        # The thumb as a batch job, so it can be built by a worker.
+        return { 'task': 'thumb', 'image': self.imagepath, 'thumbs': self.thumbroot, 'thumb': self.path, 'size': self.size }
+
+
+class ThumbIndex():
+    # On-disk index of the thumbs in a book, so checking for stale thumbs takes a single stat per page.
+    # Maps page name to the mtime, size and hash of the page the thumbs were built from, and the thumb of each size.
+    def __init__(self, thumbpath):
+        self.thumbpath = thumbpath
+        self.path = os.path.join(thumbpath, 'index.json')
+        self.pages = {}
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                f = open(self.path, "r")
+                self.pages = json.loads(f.read())['pages']
+                f.close()
+            except (IOError, ValueError, KeyError):
+                # A broken index only costs a rebuild of the thumbs.
+                self.pages = {}
+
+    def save(self):
+        # Write the index, if it has changed.
+        if not self.dirty:
+            return
+        if not os.path.isdir(self.thumbpath):
+            os.makedirs(self.thumbpath)
+        partpath = self.path + '.part'
+        f = open(partpath, "w")
+        f.write(json.dumps({ 'version': 1, 'pages': self.pages }, indent=1))
+        f.close()
+        replace_file(partpath, self.path)
+        self.dirty = False
+
+    def is_stale(self, imagepath, size, thumbpath, check=True):
+        # True if the page has changed since its thumb of this size was built. Only hashes the page if the stat has changed.
+        # Without check, only looks at the index, and not at the page.
+        name = self.key(imagepath)
+        entry = self.pages.get(name)
+        if not check and entry and str(size) in entry['thumbs']:
+            return False
+        try:
+            st = os.stat(imagepath)
+        except OSError:
+            return False
+        if not entry or not str(size) in entry['thumbs']:
+            # Not indexed yet. Adopt thumbs built before there was an index, if they're newer than the page.
+            if os.path.exists(thumbpath) and os.stat(thumbpath).st_mtime >= st.st_mtime:
+                self.update(imagepath, { 'mtime': st.st_mtime, 'size': st.st_size, 'hash': None }, [ size ])
+                return False
+            return True
+        if st.st_mtime == entry['mtime'] and st.st_size == entry['size']:
+            return False
+        if st.st_size == entry['size'] and entry['hash'] and file_signature(imagepath)['hash'] == entry['hash']:
+            # Touched, but not changed. Remember the new time, so it isn't hashed again.
+            entry['mtime'] = st.st_mtime
+            self.dirty = True
+            return False
+        return True
+
+    def update(self, imagepath, signature, sizes=THUMBSIZES):
+        # Record thumbs of the given sizes built from a page with the given signature. Thumbs built from older versions of the page are dropped.
+        name = self.key(imagepath)
+        entry = self.pages.get(name)
+        if not entry or entry['size'] != signature['size'] or not (entry['mtime'] == signature['mtime'] or (signature['hash'] and entry['hash'] == signature['hash'])):
+            entry = { 'thumbs': {}, 'hash': None }
+            self.pages[name] = entry
+        entry['mtime'] = signature['mtime']
+        entry['size'] = signature['size']
+        if signature['hash']:
+            entry['hash'] = signature['hash']
+        if 'tags' in signature:
+            entry['tags'] = signature['tags']
+        for size in sizes:
+            entry['thumbs'][str(size)] = os.path.join(str(size), os.path.basename(imagepath)+'.png')
+        self.dirty = True
+
+    def remove(self, name):
+        # Forget a page.
+        if self.pages.pop(self.key(name), None):
+            self.dirty = True
+
+    def tags(self, imagepath):
+        # The layer tags of a page, as found by layer_tags when its thumbs were built. None if they aren't known,
+        # or the page has changed since.
+        entry = self.pages.get(self.key(imagepath))
+        if not entry or not 'tags' in entry:
+            return None
+        try:
+            st = os.stat(imagepath)
+        except OSError:
+            return None
+        if st.st_mtime != entry['mtime'] or st.st_size != entry['size']:
+            return None
+        return entry['tags']
+
+    def set_tags(self, imagepath, tags):
+        # Record the layer tags of a page, if it's indexed and hasn't changed since.
+        entry = self.pages.get(self.key(imagepath))
+        if entry:
+            try:
+                st = os.stat(imagepath)
+            except OSError:
+                return
+            if st.st_mtime == entry['mtime'] and st.st_size == entry['size']:
+                entry['tags'] = tags
+                self.dirty = True
+
+    def key(self, imagepath):
+        # Page names are stored as unicode, as that's what they come back as from JSON.
+        name = os.path.basename(imagepath)
+        if isinstance(name, str):
+            name = name.decode('utf-8', 'replace')
+        return name
+
+
+class ThumbPack():
+    # All the thumbs of one size in a single file, with a table of where each one is, so opening a book maps one
+    # file rather than opening a PNG per page. Each entry records the page it was built from, as in the ThumbIndex,
+    # and only the entries of pages that have changed are rewritten, after the others.
+    MAGIC = "BOOKPACK"
+    HEADER = struct.Struct("<8sQI") # Magic, and the offset and length of the table.
+
+    def __init__(self, thumbdir, size, index):
+        self.thumbdir = thumbdir
+        self.path = os.path.join(thumbdir, THUMBPACK)
+        self.size = size
+        self.index = index # ThumbIndex of the book, telling which entries are still up to date.
+        self.entries = {}  # Offset, length, and the mtime and size of the page, by page name.
+        self.file = None
+        self.data = None
+        self.open()
+
+    def open(self):
+        # Map the pack, and read its table. A missing or broken pack is simply empty.
+        self.close()
+        self.entries = {}
+        try:
+            self.file = open(self.path, "rb")
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, offset, length = self.HEADER.unpack_from(self.data, 0)
+            if magic != self.MAGIC:
+                raise ValueError("Not a thumb pack")
+            self.entries = json.loads(self.data[offset:offset + length])['entries']
+        except (IOError, OSError, mmap.error, struct.error, ValueError, KeyError):
+            self.close()
+            self.entries = {}
+
+    def close(self):
+        # Release the file.
+        if self.data:
+            self.data.close()
+            self.data = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def fresh(self, name):
+        # The entry of a page, if the page hasn't changed since its thumb was packed.
+        entry = self.entries.get(name)
+        page = self.index.pages.get(name)
+        if entry and page and str(self.size) in page['thumbs'] and entry[2] == page['mtime'] and entry[3] == page['size']:
+            return entry
+        return None
+
+    def pixbuf(self, thumbpath):
+        # Decode a thumb straight from the mapped pack. None if it isn't packed, or is out of date.
+        entry = self.fresh(self.index.key(os.path.basename(thumbpath)[:-len('.png')]))
+        if not entry or not self.data:
+            return None
+        loader = gtk.gdk.PixbufLoader('png')
+        try:
+            loader.write(self.data[entry[0]:entry[0] + entry[1]])
+            loader.close()
+        except gobject.GError:
+            return None
+        return loader.get_pixbuf()
+
+    def update(self, pages):
+        # Pack the thumbs of the given pages whose entries are missing or out of date, and drop the entries of
+        # pages no longer in the book. The other entries stay where they are, unless the replaced ones add up
+        # to more than the live ones, and the pack is compacted.
+        if not os.path.isdir(self.thumbdir):
+            return False
+        names = dict((self.index.key(p), p) for p in pages)
+        stale = [ n for n in names if n in self.index.pages and str(self.size) in self.index.pages[n]['thumbs'] and not self.fresh(n) ]
+        gone = [ n for n in self.entries if not n in names ]
+        if not stale and not gone:
+            return False
+        for n in gone:
+            del self.entries[n]
+        live = sum([ e[1] for n, e in self.entries.items() if not n in stale ])
+        compact = not self.data or len(self.data) - live > max(live, THUMBPACKSLACK)
+        self.write(names, stale, compact)
+        self.open()
+        return True
+
+    def write(self, names, stale, compact):
+        # Write the stale thumbs after the rest of the pack, followed by a new table. The header is only pointed
+        # at the new table once the rest is on disk, so a crash leaves the pack as it was. Compacting copies the
+        # entries that are kept into a new pack first.
+        if compact:
+            partpath = self.path + '.part'
+            out = open(partpath, "wb")
+            out.write(self.HEADER.pack(self.MAGIC, 0, 0))
+            for n, entry in sorted(self.entries.items(), key=lambda e: e[1][0]):
+                if not n in stale:
+                    pos = out.tell()
+                    out.write(self.data[entry[0]:entry[0] + entry[1]])
+                    entry[0] = pos
+            self.close()
+        else:
+            partpath = None
+            self.close()
+            out = open(self.path, "r+b")
+            out.seek(0, 2)
+        for n in stale:
+            try:
+                f = open(os.path.join(self.thumbdir, names[n] + '.png'), "rb")
+                png = f.read()
+                f.close()
+            except IOError:
+                self.entries.pop(n, None)
+                continue
+            page = self.index.pages[n]
+            self.entries[n] = [ out.tell(), len(png), page['mtime'], page['size'] ]
+            out.write(png)
+        table = json.dumps({ 'version': 1, 'entries': self.entries })
+        offset = out.tell()
+        out.write(table)
+        out.flush()
+        os.fsync(out.fileno())
+        out.seek(0)
+        out.write(self.HEADER.pack(self.MAGIC, offset, len(table)))
+        out.close()
+        if partpath:
+            replace_file(partpath, self.path)
+
+
+class ExportManifest():
+    # Record of the files exported to a folder, so a later export to the same folder only redoes pages whose
+    # source or export settings have changed. Maps file name to the page, the mtime, size and hash of the page
+    # it was exported from, and a hash of the export settings used.
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, EXPORTMANIFEST)
+        self.files = {}
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                f = open(self.path, "r")
+                self.files = json.loads(f.read())['files']
+                f.close()
+            except (IOError, ValueError, KeyError):
+                # A broken manifest only costs exporting everything again.
+                self.files = {}
+
+    def save(self):
+        # Write the manifest, if it has changed.
+        if not self.dirty:
+            return
+        partpath = self.path + '.part'
+        f = open(partpath, "w")
+        f.write(json.dumps({ 'version': 1, 'files': self.files }, indent=1))
+        f.close()
+        replace_file(partpath, self.path)
+        self.dirty = False
+
+    def is_stale(self, name, imagepath, settingshash):
+        # True if the file needs exporting again. Only hashes a page if the stat has changed.
+        # Sheets of several pages pass a list of their pages.
+        entry = self.files.get(self.key(name))
+        if not entry or entry['settings'] != settingshash or not os.path.isfile(os.path.join(self.folder, name)):
+            return True
+        if isinstance(imagepath, list):
+            sources = entry.get('sources', [])
+            if len(sources) != len(imagepath):
+                return True
+            return any([ self.source_stale(source, path) for source, path in zip(sources, imagepath) ])
+        return self.source_stale(entry, imagepath)
+
+    def source_stale(self, entry, imagepath):
+        # True if a page has changed since its signature was recorded in entry.
+        try:
+            st = os.stat(imagepath)
+        except OSError:
+            return True
+        if st.st_mtime == entry['mtime'] and st.st_size == entry['size']:
+            return False
+        if st.st_size == entry['size'] and file_signature(imagepath)['hash'] == entry['hash']:
+            # Touched, but not changed.
+            entry['mtime'] = st.st_mtime
+            self.dirty = True
+            return False
+        return True
+
+    def update(self, name, page, signature, settingshash):
+        # Record a file as exported from a page, with its signature from before the export, or from the list
+        # of pages on a sheet and their signatures.
+        if isinstance(signature, list):
+            sources = [ { 'mtime': sig['mtime'], 'size': sig['size'], 'hash': sig['hash'] } for sig in signature ]
+            self.files[self.key(name)] = { 'page': " ".join(page), 'pages': page, 'sources': sources, 'settings': settingshash }
+        else:
+            self.files[self.key(name)] = { 'page': page, 'mtime': signature['mtime'], 'size': signature['size'],
+                                           'hash': signature['hash'], 'settings': settingshash }
+        self.dirty = True
+
+    def remove_stale(self, pages, editions):
+        # Delete exported files whose pages were deleted from the book, or renumbered. Pages are the names of the
+        # pages in the book, and editions a (settings hash, extension, file names, pages covered) tuple for each
+        # edition exported to the folder, listing the files it makes of the pages it covers, or of the whole book if
+        # that's None. A file counts as renumbered when an edition with the same settings hash or extension covers
+        # all its pages, but doesn't make it. Files exported with other settings, files of pages outside the export,
+        # and files not exported by GIMP Book, are left alone.
+        pages = set([ self.key(page) for page in pages ])
+        editions = [ (settingshash, ext, set([ self.key(name) for name in names ]), pages if covered is None else set([ self.key(page) for page in covered ]))
+                     for settingshash, ext, names, covered in editions ]
+        for name, entry in self.files.items():
+            if 'sources' in entry and not 'pages' in entry:
+                continue # A sheet recorded without its pages, so there's no telling if they're gone.
+            sources = set([ self.key(page) for page in entry.get('pages', [ entry['page'] ]) ])
+            stale = not sources <= pages
+            for settingshash, ext, names, covered in editions:
+                if (entry['settings'] == settingshash or os.path.splitext(name)[1] == ext) and sources <= covered and not name in names:
+                    stale = True
+            if stale:
+                path = os.path.join(self.folder, name)
+                if os.path.isfile(path):
+                    os.remove(path)
+                del self.files[name]
+                self.dirty = True
+
+    def key(self, name):
+        # File names are stored as unicode, as that's what they come back as from JSON.
+        if isinstance(name, str):
+            name = name.decode('utf-8', 'replace')
+        return name
+
+
+class PageWatcher():
+    # Watches the pages folder, and reports pages that have been written to. Uses inotify on Linux,
+    # and otherwise polls a few pages at a time in the background.
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = 0x800
+    IN_CLOEXEC = 0x80000
+
+    def __init__(self, pagepath, pages, changed):
+        self.pagepath = pagepath
+        self.pages = pages     # Returns the names of the pages to poll.
+        self.changed = changed # Called with a set of changed page names, or None if everything needs checking.
+        self.queue = set()
+        self.overflow = False
+        self.fd = None
+        self.source = None
+        self.flusher = None
+        self.seen = {}   # Polled (mtime, size) by page name.
+        self.cursor = 0  # Where the next poll starts.
+        if not self.start_inotify():
+            self.source = gobject.timeout_add(WATCHPOLL, self.poll)
+
+    def start_inotify(self):
+        # Set up an inotify watch on the pages folder. Returns False if inotify isn't available.
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd < 0:
+                return False
+            if libc.inotify_add_watch(fd, self.pagepath, self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+                os.close(fd)
+                return False
+        except (OSError, AttributeError):
+            return False
+        self.fd = fd
+        self.source = gobject.io_add_watch(fd, gobject.IO_IN, self.read_events)
+        return True
+
+    def read_events(self, fd, condition):
+        # Queue the pages named in the waiting inotify events.
+        try:
+            data = os.read(fd, 65536)
+        except OSError:
+            return True
+        pos = 0
+        while pos + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, pos)
+            name = data[pos+16:pos+16+length].rstrip('\0')
+            pos += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflow = True
+            elif name.lower().endswith('.xcf'):
+                self.queue.add(name)
+        self.schedule()
+        return True
+
+    def poll(self):
+        # Stat the next batch of pages, and queue those that changed since the last round.
+        names = self.pages()
+        if self.cursor >= len(names):
+            self.cursor = 0
+        for name in names[self.cursor:self.cursor+WATCHBATCH]:
+            try:
+                st = os.stat(os.path.join(self.pagepath, name))
+            except OSError:
+                continue
+            stat = (st.st_mtime, st.st_size)
+            if name in self.seen and self.seen[name] != stat:
+                self.queue.add(name)
+            self.seen[name] = stat
+        self.cursor += WATCHBATCH
+        self.schedule()
+        return True
+
+    def schedule(self):
+        # Wait a little for more changes, as GIMP may write a page in several goes.
+        if (self.queue or self.overflow) and not self.flusher:
+            self.flusher = gobject.timeout_add(WATCHDELAY, self.flush)
+
+    def flush(self):
+        # Report the queued pages.
+        self.flusher = None
+        if self.overflow:
+            self.changed(None)
+        else:
+            self.changed(self.queue)
+        self.queue = set()
+        self.overflow = False
+        return False
+
+    def stop(self):
+        # Stop watching.
+        for source in [ self.source, self.flusher ]:
+            if source:
+                gobject.source_remove(source)
+        self.source = self.flusher = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class XcfError(Exception):
+    # Raised by XcfReader on files it can't handle, so the caller can fall back to GIMP.
+    pass
+
+
+class XcfReader():
+    # Reads just enough of an XCF file to make a thumbnail without GIMP, by sampling the top
+    # tile level of the visible layers, and compositing them with gdk.
+    MAGIC = 'gimp xcf '
+    PROP_END = 0
+    PROP_FLOATING_SELECTION = 5
+    PROP_OPACITY = 6
+    PROP_MODE = 7
+    PROP_VISIBLE = 8
+    PROP_APPLY_MASK = 11
+    PROP_OFFSETS = 15
+    PROP_COMPRESSION = 17
+    PROP_GROUP_ITEM = 29
+    PROP_ITEM_PATH = 30
+    PROP_FLOAT_OPACITY = 33
+    NORMAL_MODES = [ 0, 28 ]  # Normal in GIMP 2.8, and legacy and default normal in 2.10.
+    PASS_THROUGH_MODE = 61    # Only used on layer groups, where it looks like normal when using the group's pixels.
+    LAYER_BPP = { 0: 3, 1: 4, 2: 1, 3: 2 } # RGB, RGBA, GRAY and GRAYA layers. Indexed is not supported.
+    TILE = 64
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            self.file.close()
+            raise XcfError("Can't map %s" % (path))
+        try:
+            self.read_header()
+        except (struct.error, IndexError, ValueError), err:
+            self.close()
+            raise XcfError("Corrupt XCF file %s (%s)" % (path, err))
+        except XcfError:
+            self.close()
+            raise
+
+    def close(self):
+        # Release the file.
+        self.data.close()
+        self.file.close()
+
+    def uint(self, pos):
+        return struct.unpack('>I', self.data[pos:pos+4])[0]
+
+    def pointer(self, pos):
+        # Read a file offset, 64 bit from XCF version 11. Returns the offset and the position after it.
+        if self.version >= 11:
+            return struct.unpack('>Q', self.data[pos:pos+8])[0], pos+8
+        return self.uint(pos), pos+4
+
+    def pointers(self, pos):
+        # Read a zero terminated list of file offsets.
+        ptrs = []
+        ptr, pos = self.pointer(pos)
+        while ptr:
+            ptrs.append(ptr)
+            ptr, pos = self.pointer(pos)
+        return ptrs, pos
+
+    def string(self, pos):
+        # Read a length prefixed, zero terminated string.
+        length = self.uint(pos)
+        return self.data[pos+4:pos+4+length].rstrip('\0'), pos+4+length
+
+    def properties(self, pos):
+        # Read a property list into a dict of raw payloads by property type.
+        props = {}
+        while True:
+            ptype, length = struct.unpack('>II', self.data[pos:pos+8])
+            pos += 8
+            if ptype == self.PROP_END:
+                return props, pos
+            props[ptype] = self.data[pos:pos+length]
+            pos += length
+
+    def read_header(self):
+        # Read the image header and the list of layers.
+        if self.data[0:9] != self.MAGIC:
+            raise XcfError("%s is not an XCF file" % (self.path))
+        version = self.data[9:13]
+        self.version = 0 if version == 'file' else int(version[1:])
+        self.width, self.height, basetype = struct.unpack('>III', self.data[14:26])
+        pos = 26
+        if self.version >= 4:
+            precision = self.uint(pos)
+            pos += 4
+            if (self.version < 7 and precision != 0) or (self.version >= 7 and precision not in [ 100, 150 ]):
+                raise XcfError("Only 8 bit XCF files are supported")
+        if basetype == 2:
+            raise XcfError("Indexed XCF files are not supported")
+        props, pos = self.properties(pos)
+        self.compression = ord(props.get(self.PROP_COMPRESSION, '\1')[0])
+        if self.compression not in [ 0, 1, 2 ]: # None, RLE and zlib.
+            raise XcfError("Unsupported XCF compression %d" % (self.compression))
+        layerptrs, pos = self.pointers(pos)
+        self.layers = [ self.read_layer(ptr) for ptr in layerptrs ]
+
+    def read_layer(self, ptr):
+        # Read a layer's header, properties and the offsets of its pixels and mask.
+        width, height, ltype = struct.unpack('>III', self.data[ptr:ptr+12])
+        name, pos = self.string(ptr+12)
+        props, pos = self.properties(pos)
+        hierarchy, pos = self.pointer(pos)
+        mask, pos = self.pointer(pos)
+        layer = { 'name': name, 'width': width, 'height': height, 'type': ltype, 'hierarchy': hierarchy,
+                  'mask': None, 'visible': True, 'opacity': 255, 'mode': 0, 'offsets': (0, 0),
+                  'group': self.PROP_GROUP_ITEM in props, 'floating': self.PROP_FLOATING_SELECTION in props, 'path': [] }
+        if self.PROP_VISIBLE in props:
+            layer['visible'] = bool(struct.unpack('>I', props[self.PROP_VISIBLE][:4])[0])
+        if self.PROP_FLOAT_OPACITY in props:
+            layer['opacity'] = int(round(struct.unpack('>f', props[self.PROP_FLOAT_OPACITY][:4])[0] * 255))
+        elif self.PROP_OPACITY in props:
+            layer['opacity'] = struct.unpack('>I', props[self.PROP_OPACITY][:4])[0]
+        if self.PROP_MODE in props:
+            layer['mode'] = struct.unpack('>i', props[self.PROP_MODE][:4])[0]
+        if self.PROP_OFFSETS in props:
+            layer['offsets'] = struct.unpack('>ii', props[self.PROP_OFFSETS][:8])
+        if self.PROP_ITEM_PATH in props:
+            path = props[self.PROP_ITEM_PATH]
+            layer['path'] = list(struct.unpack('>%dI' % (len(path) / 4), path))
+        if mask and self.PROP_APPLY_MASK in props and struct.unpack('>I', props[self.PROP_APPLY_MASK][:4])[0]:
+            # Skip the mask channel's size, name and properties, to get to its pixels.
+            name, pos = self.string(mask+8)
+            props, pos = self.properties(pos)
+            layer['mask'], pos = self.pointer(pos)
+        return layer
+
+    def thumbnail(self, size):
+        # Composite the visible top level layers at about twice the size asked for, and scale it down.
+        width, height = thumb_size(self.width, self.height, size)
+        step = max(1, min(self.width / (width * 2), self.height / (height * 2)))
+        canvas = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8, (self.width + step - 1) / step, (self.height + step - 1) / step)
+        canvas.fill(0xffffffff) # Flatten on white, like GIMP does with the default background color.
+        try:
+            for layer in reversed(self.layers):
+                if layer['visible'] and not layer['floating'] and len(layer['path']) < 2:
+                    self.composite_layer(canvas, layer, step)
+        except (struct.error, IndexError, ValueError, zlib.error), err:
+            raise XcfError("Corrupt XCF file %s (%s)" % (self.path, err))
+        return canvas.scale_simple(width, height, gtk.gdk.INTERP_HYPER)
+
+    def composite_layer(self, canvas, layer, step):
+        # Sample every step'th pixel of the layer, and composite it onto the canvas.
+        if not (layer['mode'] in self.NORMAL_MODES or (layer['group'] and layer['mode'] == self.PASS_THROUGH_MODE)):
+            raise XcfError("Unsupported layer mode %d" % (layer['mode']))
+        if not layer['type'] in self.LAYER_BPP:
+            raise XcfError("Unsupported layer type %d" % (layer['type']))
+        bpp = self.LAYER_BPP[layer['type']]
+        ox, oy = layer['offsets']
+        # Only sample pixels on the canvas' grid, so the layer lines up after sampling.
+        x0 = (-ox) % step
+        y0 = (-oy) % step
+        sw = (layer['width'] - x0 + step - 1) / step
+        sh = (layer['height'] - y0 + step - 1) / step
+        if sw <= 0 or sh <= 0 or layer['opacity'] == 0:
+            return
+        cx = (x0 + ox) / step
+        cy = (y0 + oy) / step
+        left = max(0, cx)
+        top = max(0, cy)
+        right = min(canvas.get_width(), cx + sw)
+        bottom = min(canvas.get_height(), cy + sh)
+        if right <= left or bottom <= top:
+            return
+        planes = self.sample_hierarchy(layer['hierarchy'], bpp, x0, y0, sw, sh, step)
+        rgba = bytearray(sw * sh * 4)
+        if bpp >= 3:
+            rgba[0::4] = planes[0]
+            rgba[1::4] = planes[1]
+            rgba[2::4] = planes[2]
+        else:
+            rgba[0::4] = planes[0]
+            rgba[1::4] = planes[0]
+            rgba[2::4] = planes[0]
+        if bpp in [ 2, 4 ]:
+            alpha = planes[-1]
+        else:
+            alpha = bytearray('\xff') * (sw * sh)
+        if layer['mask']:
+            mask = self.sample_hierarchy(layer['mask'], 1, x0, y0, sw, sh, step)[0]
+            alpha = bytearray([ (a * m + 127) / 255 for a, m in zip(alpha, mask) ])
+        rgba[3::4] = alpha
+        pix = gtk.gdk.pixbuf_new_from_data(str(rgba), gtk.gdk.COLORSPACE_RGB, True, 8, sw, sh, sw * 4)
+        pix.composite(canvas, left, top, right - left, bottom - top, cx, cy, 1.0, 1.0, gtk.gdk.INTERP_NEAREST, layer['opacity'])
+
+    def sample_hierarchy(self, ptr, bpp, x0, y0, sw, sh, step):
+        # Sample every step'th pixel from (x0, y0) of the top level of a tile hierarchy, one bytearray per channel.
+        width, height, hbpp = struct.unpack('>III', self.data[ptr:ptr+12])
+        if hbpp != bpp:
+            raise XcfError("Unexpected %d bytes per pixel" % (hbpp))
+        level, pos = self.pointer(ptr+12)
+        lw, lh = struct.unpack('>II', self.data[level:level+8])
+        tiles, pos = self.pointers(level+8)
+        cols = (lw + self.TILE - 1) / self.TILE
+        rows = (lh + self.TILE - 1) / self.TILE
+        if len(tiles) < cols * rows:
+            raise XcfError("Missing tiles")
+        planes = [ bytearray(sw * sh) for c in range(bpp) ]
+        for ty in range(rows):
+            ty0 = ty * self.TILE
+            th = min(self.TILE, lh - ty0)
+            r0 = (y0 - ty0) % step # First sampled row in the tile.
+            if r0 >= th:
+                continue
+            for tx in range(cols):
+                tx0 = tx * self.TILE
+                tw = min(self.TILE, lw - tx0)
+                c0 = (x0 - tx0) % step # First sampled column in the tile.
+                if c0 >= tw:
+                    continue
+                i = ty * cols + tx
+                tile = self.read_tile(tiles[i], tiles[i+1] if i+1 < len(tiles) else 0, tw * th, bpp)
+                count = (tw - c0 + step - 1) / step
+                sc = (tx0 + c0 - x0) / step
+                for r in xrange(r0, th, step):
+                    dst = ((ty0 + r - y0) / step) * sw + sc
+                    src = r * tw
+                    for c in range(bpp):
+                        planes[c][dst:dst+count] = tile[c][src+c0:src+tw:step]
+        return planes
+
+    def read_tile(self, ptr, nextptr, pixels, bpp):
+        # Decode a tile into one bytearray per channel.
+        size = pixels * bpp
+        end = nextptr if nextptr > ptr else ptr + size * 2 + 1024 # The last tile has no next offset to go by.
+        if self.compression == 1: # RLE, channel by channel.
+            src = bytearray(self.data[ptr:end])
+            planes = []
+            pos = 0
+            for c in range(bpp):
+                plane, pos = rle_decode(src, pos, pixels)
+                planes.append(plane)
+            return planes
+        if self.compression == 2: # zlib, interleaved.
+            raw = bytearray(zlib.decompressobj().decompress(self.data[ptr:end]))
+        else: # Uncompressed, interleaved.
+            raw = bytearray(self.data[ptr:ptr+size])
+        if len(raw) < size:
+            raise XcfError("Short tile")
+        return [ raw[c:size:bpp] for c in range(bpp) ]
+
+
+class BatchWorker():
+    # A headless GIMP process, working through a list of batch jobs.
+    def __init__(self, gimpbin, jobs):
+        self.jobs = dict((job['id'], job) for job in jobs)
+        fd, self.jobfile = tempfile.mkstemp(prefix='book_', suffix='.json')
+        self.statusfile = self.jobfile + '.status'
+        self.offset = 0
+        self.buffer = ""
+        open(self.statusfile, "w").close()
+        f = os.fdopen(fd, "w")
+        f.write(json.dumps({ 'status': self.statusfile, 'jobs': jobs }))
+        f.close()
+        command = "(python-fu-book-batch RUN-NONINTERACTIVE %s)" % (script_fu_string(self.jobfile))
+        devnull = open(os.devnull, "w")
+        try:
+            self.process = subprocess.Popen([ gimpbin, '-i', '-d', '-f', '-b', command, '-b', '(gimp-quit 0)' ], stdout=devnull, stderr=devnull)
+        finally:
+            devnull.close()
+
+    def poll(self):
+        # Return (job, ok, message) for each job the worker has reported on since the last poll.
+        results = []
+        f = open(self.statusfile, "r")
+        f.seek(self.offset)
+        data = f.read()
+        f.close()
+        self.offset += len(data)
+        lines = (self.buffer + data).split("\n")
+        self.buffer = lines.pop() # Keep any half written line for the next poll.
+        for line in lines:
+            status = json.loads(line)
+            job = self.jobs.pop(status['id'], None)
+            if job:
+                job['result'] = status['result']
+                results.append((job, status['ok'], status['message']))
+        return results
+
+    def running(self):
+        # True until the GIMP process exits.
+        return self.process.poll() is None
+
+    def stop(self):
+        # Kill the process, if running, and clean up the job files.
+        if self.running():
+            try:
+                self.process.kill()
+                self.process.wait()
+            except OSError:
+                pass
+        for f in [ self.jobfile, self.statusfile ]:
+            if os.path.exists(f):
+                os.remove(f)
+
+
+class BatchPool():
+    # Spreads batch jobs over headless GIMP workers, one per core, reporting back on the GTK main loop.
+    def __init__(self, finished, batchmin=BATCHMIN):
+        self.finished = finished # Called with (job, ok, message) for each job done. What the task returned is in job['result'].
+        self.batchmin = batchmin # Fewer queued jobs than this are done in-process, when no worker is busy with them.
+        self.gimpbin = find_gimp_console()
+        self.size = cpu_count()
+        self.queue = []   # Jobs waiting for a worker.
+        self.local = []   # Jobs to be done in this process.
+        self.workers = []
+        self.nextid = 0
+        self.timer = None
+        self.idler = None
+        self.paused = False
+
+    def add(self, jobs):
+        # Queue up more jobs.
+        for job in jobs:
+            job['id'] = self.nextid
+            self.nextid += 1
+        self.queue.extend(jobs)
+        self.dispatch()
+
+    def pending(self):
+        # Number of jobs not done yet.
+        return len(self.queue) + len(self.local) + sum([ len(w.jobs) for w in self.workers ])
+
+    def dispatch(self):
+        # Hand queued jobs out to idle workers, dealing them round robin so pages fill in from the start.
+        if self.paused:
+            return
+        free = self.size - len(self.workers)
+        if self.gimpbin and free > 0 and len(self.queue) >= self.batchmin:
+            count = max(1, min(free, len(self.queue) / self.batchmin))
+            chunks = [ self.queue[c::count] for c in range(count) ]
+            self.queue = []
+            for chunk in chunks:
+                try:
+                    self.workers.append(BatchWorker(self.gimpbin, chunk))
+                except OSError:
+                    # GIMP could not be started, so do it all in-process from now on.
+                    self.gimpbin = None
+                    self.queue.extend(chunk)
+        if self.queue and (not self.gimpbin or len(self.queue) < self.batchmin):
+            self.local.extend(self.queue)
+            self.queue = []
+        if self.workers and not self.timer:
+            self.timer = gobject.timeout_add(BATCHPOLL, self.poll)
+        if self.local and not self.idler:
+            self.idler = gobject.idle_add(self.run_local)
+
+    def poll(self):
+        # Collect results from the workers, and reap those that are done.
+        for w in self.workers[:]:
+            running = w.running()
+            for job, ok, message in w.poll():
+                self.finished(job, ok, message)
+            if not running:
+                if w.jobs:
+                    # The worker died, or never got going. Finish what it left behind in-process.
+                    if not w.offset:
+                        self.gimpbin = None
+                    self.local.extend(w.jobs.values())
+                w.stop()
+                self.workers.remove(w)
+        self.dispatch()
+        if self.workers:
+            return True
+        self.timer = None
+        return False
+
+    def run_local(self):
+        # Do one job in-process, then give the GTK main loop a turn.
+        if not self.local:
+            self.idler = None
+            return False
+        job = self.local.pop(0)
+        try:
+            job['result'] = run_task(job)
+        except Exception, err:
+            job['result'] = None
+            self.finished(job, False, str(err))
+        else:
+            self.finished(job, True, "")
+        return True
+
+    def pause(self):
+        # Stop the workers, putting the jobs they haven't reported on back in the queue, until resumed.
+        # A job a worker was in the middle of is done again from the start.
+        self.paused = True
+        for w in self.workers[:]:
+            for job, ok, message in w.poll():
+                self.finished(job, ok, message)
+            w.stop()
+            self.queue.extend(w.jobs.values())
+        self.queue.extend(self.local)
+        self.queue.sort(key=lambda job: job['id'])
+        self.local = []
+        self.workers = []
+        if self.timer:
+            gobject.source_remove(self.timer)
+            self.timer = None
+        if self.idler:
+            gobject.source_remove(self.idler)
+            self.idler = None
+
+    def resume(self):
+        # Carry on with the queued jobs after a pause.
+        self.paused = False
+        self.dispatch()
+
+    def stop(self):
+        # Drop all queued jobs, and stop the workers.
+        self.queue = []
+        self.local = []
+        for w in self.workers:
+            w.stop()
+        self.workers = []
+        if self.timer:
+            gobject.source_remove(self.timer)
+            self.timer = None
+        if self.idler:
+            gobject.source_remove(self.idler)
+            self.idler = None
+
+
+class PngStripWriter():
+    # Writes a PNG a strip of rows at a time, compressing as it goes.
+    def __init__(self, path, width, height, channels, resolution, settings, background):
+        self.rowbytes = width * channels
+        self.file = open(path, "wb")
+        self.file.write('\x89PNG\r\n\x1a\n')
+        self.chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2 if channels == 3 else 0, 0, 0, 0))
+        if settings['pnggamma']:
+            self.chunk('gAMA', struct.pack('>I', 45455))
+        if settings['pngbgcolor']:
+            if channels == 3:
+                self.chunk('bKGD', struct.pack('>HHH', *background))
+            else:
+                self.chunk('bKGD', struct.pack('>H', gray_level(background)))
+        if settings['pngresolution'] and resolution:
+            ppm = int(round(resolution / 0.0254))
+            self.chunk('pHYs', struct.pack('>IIB', ppm, ppm, 1))
+        if settings['pnglayeroffset']:
+            self.chunk('oFFs', struct.pack('>iiB', 0, 0, 0))
+        if settings['pngcreationtime']:
+            self.chunk('tIME', struct.pack('>HBBBBB', *time.gmtime()[:6]))
+        self.compressor = zlib.compressobj(int(settings['pngcompress']))
+
+    def chunk(self, ctype, data):
+        self.file.write(struct.pack('>I', len(data)) + ctype + data + struct.pack('>I', zlib.crc32(ctype + data) & 0xffffffff))
+
+    def write(self, rows):
+        # Add whole rows of pixels, each prefixed with filter type none.
+        data = self.compressor.compress("".join([ '\0' + rows[r:r+self.rowbytes] for r in range(0, len(rows), self.rowbytes) ]))
+        if data:
+            self.chunk('IDAT', data)
+
+    def close(self):
+        self.chunk('IDAT', self.compressor.flush())
+        self.chunk('IEND', '')
+        self.file.close()
+
+
+class TiffStripWriter():
+    # Writes a baseline TIFF a strip of rows at a time, uncompressed or deflated, with the directory at the end.
+    def __init__(self, path, width, height, channels, resolution, settings, background):
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.resolution = resolution or 72.0
+        self.deflate = settings['tifcompress'] == 3
+        self.rowsperstrip = None
+        self.offsets = []
+        self.counts = []
+        self.file = open(path, "wb")
+        self.file.write('II*\0' + struct.pack('<I', 0)) # The directory offset is filled in on close.
+
+    def write(self, rows):
+        # Add a strip. All but the last need to be the same height.
+        if self.rowsperstrip is None:
+            self.rowsperstrip = len(rows) / (self.width * self.channels)
+        data = zlib.compress(rows) if self.deflate else rows
+        self.offsets.append(self.file.tell())
+        self.counts.append(len(data))
+        self.file.write(data)
+
+    def close(self):
+        # Write the directory, with values that don't fit in an entry after it.
+        if self.file.tell() % 2:
+            self.file.write('\0')
+        ifd = self.file.tell()
+        SHORT, LONG, RATIONAL = 3, 4, 5
+        resolution = struct.pack('<II', int(round(self.resolution * 1000)), 1000)
+        entries = [ (256, LONG, [ self.width ]),
+                    (257, LONG, [ self.height ]),
+                    (258, SHORT, [ 8 ] * self.channels),
+                    (259, SHORT, [ 8 if self.deflate else 1 ]),
+                    (262, SHORT, [ 2 if self.channels == 3 else 1 ]),
+                    (273, LONG, self.offsets),
+                    (277, SHORT, [ self.channels ]),
+                    (278, LONG, [ self.rowsperstrip or self.height ]),
+                    (279, LONG, self.counts),
+                    (282, RATIONAL, resolution),
+                    (283, RATIONAL, resolution),
+                    (284, SHORT, [ 1 ]),
+                    (296, SHORT, [ 2 ]) ]
+        extra = ifd + 2 + len(entries) * 12 + 4
+        directory = struct.pack('<H', len(entries))
+        extradata = ""
+        for tag, ftype, values in entries:
+            if ftype == RATIONAL:
+                data = values
+                count = 1
+            else:
+                data = struct.pack('<%d%s' % (len(values), 'H' if ftype == SHORT else 'I'), *values)
+                count = len(values)
+            if len(data) <= 4:
+                directory += struct.pack('<HHI', tag, ftype, count) + data.ljust(4, '\0')
+            else:
+                directory += struct.pack('<HHII', tag, ftype, count, extra + len(extradata))
+                extradata += data
+        self.file.write(directory + struct.pack('<I', 0) + extradata)
+        self.file.seek(4)
+        self.file.write(struct.pack('<I', ifd))
+        self.file.close()
+
+
+class BmpStripWriter():
+    # Writes a 24 bit, top down, BMP a strip of rows at a time.
+    def __init__(self, path, width, height, channels, resolution, settings, background):
+        self.width = width
+        self.channels = channels
+        self.padding = '\0' * ((4 - width * 3 % 4) % 4)
+        ppm = int(round((resolution or 72.0) / 0.0254))
+        size = (width * 3 + len(self.padding)) * height
+        self.file = open(path, "wb")
+        self.file.write('BM' + struct.pack('<IHHI', 54 + size, 0, 0, 54))
+        self.file.write(struct.pack('<IiiHHIIiiII', 40, width, -height, 1, 24, 0, size, ppm, ppm, 0, 0))
+
+    def write(self, rows):
+        # Add whole rows of pixels, swapped to BGR order.
+        pixels = bytearray(rows)
+        if self.channels == 1:
+            gray = pixels
+            pixels = bytearray(len(gray) * 3)
+            pixels[0::3] = gray
+            pixels[1::3] = gray
+            pixels[2::3] = gray
+        else:
+            pixels[0::3], pixels[2::3] = pixels[2::3], pixels[0::3]
+        rowbytes = self.width * 3
+        if self.padding:
+            pixels = "".join([ str(pixels[r:r+rowbytes]) + self.padding for r in range(0, len(pixels), rowbytes) ])
+        self.file.write(str(pixels))
+
+    def close(self):
+        self.file.close()
+
+
+class CbzWriter():
+    # Packs exported pages into a comic book archive, one at a time as they're done, with a ComicInfo.xml.
+    def __init__(self, path, info):
+        self.path = path
+        self.info = info # Book.comic_info()
+        self.pages = {}  # Image size by page number.
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, True) # The pages are compressed already.
+
+    def add(self, imagepath, number):
+        # Add an exported page, leaving it to the caller to delete it.
+        self.zip.write(imagepath, os.path.basename(imagepath))
+        self.pages[number] = os.path.getsize(imagepath)
+
+    def close(self):
+        # Write ComicInfo.xml last, once the pages are known.
+        xml = [ '<?xml version="1.0" encoding="utf-8"?>',
+                '<ComicInfo xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">',
+                '  <Title>%s</Title>' % (escape(utf8_text(self.info['title']))) ]
+        for field in COMICINFO:
+            if field in self.info['info']:
+                xml.append('  <%s>%s</%s>' % (field, escape(utf8_text(self.info['info'][field])), field))
+        xml.append('  <PageCount>%d</PageCount>' % (len(self.pages)))
+        if self.info['righttoleft']:
+            xml.append('  <Manga>YesAndRightToLeft</Manga>')
+        xml.append('  <Pages>')
+        for i, number in enumerate(sorted(self.pages)):
+            xml.append('    <Page Image=%s ImageSize=%s%s />' % (quoteattr(str(i)), quoteattr(str(self.pages[number])), ' Type="FrontCover"' if i == 0 else ''))
+        xml.append('  </Pages>')
+        xml.append('</ComicInfo>')
+        self.zip.writestr('ComicInfo.xml', "\n".join(xml) + "\n")
+        self.zip.close()
+
+    def abort(self):
+        # Throw away a half done archive.
+        self.zip.close()
+        os.remove(self.path)
+
+
+class PdfWriter():
+    # Packs exported pages into a PDF, one at a time as they're done. JPEG pages are copied in as they are, and the
+    # compressed data of PNG pages is used without decoding it. Pages are put in book order when the PDF is closed.
+    def __init__(self, path, info):
+        self.path = path
+        self.info = info # Book.comic_info()
+        self.offsets = [ None ] # File offset of each object, by object number.
+        self.pages = {}         # Page object number, by page number.
+        self.file = open(path, "wb")
+        self.file.write("%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self.pagesid = self.reserve() # The page tree is written last, but referred to by every page.
+
+    def reserve(self):
+        # Number the next object.
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def begin(self, objid=None):
+        # Start writing an object, numbered now if it wasn't reserved.
+        if objid is None:
+            objid = self.reserve()
+        self.offsets[objid] = self.file.tell()
+        self.file.write("%d 0 obj\n" % (objid))
+        return objid
+
+    def write_object(self, data, objid=None):
+        objid = self.begin(objid)
+        self.file.write(data + "\nendobj\n")
+        return objid
+
+    def write_stream(self, dictionary, source, length=None):
+        # Write a stream object, copying from a file object a block at a time. Without a length, the rest of the
+        # file is copied. Returns the object number.
+        lengthid = self.reserve()
+        objid = self.begin()
+        self.file.write("<< %s /Length %d 0 R >>\nstream\n" % (dictionary, lengthid))
+        start = self.file.tell()
+        while length is None or length > 0:
+            block = source.read(65536 if length is None else min(65536, length))
+            if not block:
+                break
+            self.file.write(block)
+            if length is not None:
+                length -= len(block)
+        size = self.file.tell() - start
+        self.file.write("\nendstream\nendobj\n")
+        self.write_object("%d" % (size), lengthid)
+        return objid
+
+    def add(self, imagepath, number):
+        # Add an exported page, leaving it to the caller to delete it. Raises ValueError for pages that can't be
+        # read, and IOError or OSError if they can't be copied in. The PDF is left as it was if a page fails.
+        f = open(imagepath, "rb")
+        mark = self.file.tell()
+        count = len(self.offsets)
+        try:
+            try:
+                if f.read(8) == '\x89PNG\r\n\x1a\n':
+                    width, height, dpi, imageid = self.add_png(f)
+                else:
+                    f.seek(0)
+                    width, height, dpi, imageid = self.add_jpeg(f)
+            except (struct.error, IndexError, KeyError):
+                raise ValueError(_("Broken or truncated page: %s") % (imagepath))
+            # Size the page by the resolution of the image, the image filling the page.
+            w = width * 72.0 / dpi
+            h = height * 72.0 / dpi
+            content = "q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q" % (w, h)
+            contentid = self.write_object("<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+            pageid = self.write_object("<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.2f %.2f] /Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>" % (self.pagesid, w, h, imageid, contentid))
+        except Exception:
+            # Drop the objects of the page, so the cross reference table only lists whole objects.
+            self.file.seek(mark)
+            self.file.truncate()
+            del self.offsets[count:]
+            raise
+        finally:
+            f.close()
+        self.pages[number] = pageid
+
+    def add_jpeg(self, f):
+        # Copy a JPEG in as is, reading its size, channels and resolution from the headers.
+        if f.read(2) != '\xff\xd8':
+            raise ValueError(_("Not a JPEG or PNG page: %s") % (f.name))
+        dpi = 72.0
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != '\xff':
+                raise ValueError(_("Not a JPEG or PNG page: %s") % (f.name))
+            length = struct.unpack('>H', f.read(2))[0]
+            segment = f.read(length - 2)
+            if len(segment) < length - 2:
+                raise ValueError(_("Broken or truncated page: %s") % (f.name))
+            if marker == '\xff\xe0' and segment[:5] == 'JFIF\0':
+                units, xdensity = struct.unpack('>BH', segment[7:10])
+                if units == 1 and xdensity:
+                    dpi = float(xdensity)
+                elif units == 2 and xdensity:
+                    dpi = xdensity * 2.54
+            elif ord(marker[1]) in range(0xc0, 0xd0) and not ord(marker[1]) in [ 0xc4, 0xc8, 0xcc ]:
+                height, width, channels = struct.unpack('>HHB', segment[1:6])
+                break
+        if not channels in [ 1, 3, 4 ]:
+            raise ValueError(_("PDF export needs JPEG pages in gray, RGB or CMYK: %s") % (f.name))
+        colorspace = { 1: "/DeviceGray", 3: "/DeviceRGB", 4: "/DeviceCMYK" }[channels]
+        f.seek(0)
+        imageid = self.write_stream("/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode" % (width, height, colorspace), f)
+        return width, height, dpi, imageid
+
+    def add_png(self, f):
+        # Copy the IDAT data of a PNG in as a flate stream with PNG predictors. Needs 8 bit gray or RGB, or indexed
+        # colors, without transparency or interlacing.
+        dpi = 72.0
+        chunks = [] # File offset and length of the IDAT chunks.
+        palette = None
+        colortype = None
+        while True:
+            length, ctype = struct.unpack('>I4s', f.read(8))
+            if ctype == 'IDAT':
+                chunks.append((f.tell(), length))
+                f.seek(length + 4, 1)
+                continue
+            data = f.read(length)
+            if len(f.read(4)) < 4:
+                raise ValueError(_("Broken or truncated page: %s") % (f.name))
+            if ctype == 'IHDR':
+                width, height, depth, colortype, compression, pngfilter, interlace = struct.unpack('>IIBBBBB', data)
+                if interlace or not colortype in [ 0, 2, 3 ] or (colortype != 3 and depth != 8):
+                    raise ValueError(_("PDF export needs PNG pages in 8 bit gray or RGB, or indexed colors, without transparency or interlacing: %s") % (f.name))
+            elif ctype == 'PLTE':
+                palette = data
+            elif ctype == 'pHYs':
+                xppu, yppu, unit = struct.unpack('>IIB', data)
+                if unit == 1 and xppu:
+                    dpi = xppu * 0.0254
+            elif ctype == 'IEND':
+                break
+        if colortype is None or not chunks or (colortype == 3 and not palette):
+            raise ValueError(_("Broken or truncated page: %s") % (f.name))
+        if colortype == 3:
+            colorspace = "[/Indexed /DeviceRGB %d <%s>]" % (len(palette) / 3 - 1, palette.encode('hex'))
+            colors = 1
+        else:
+            colorspace = "/DeviceGray" if colortype == 0 else "/DeviceRGB"
+            colors = 1 if colortype == 0 else 3
+        dictionary = "/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent %d /Filter /FlateDecode /DecodeParms << /Predictor 15 /Colors %d /BitsPerComponent %d /Columns %d >>" % (width, height, colorspace, depth, colors, depth, width)
+        lengthid = self.reserve()
+        imageid = self.begin()
+        self.file.write("<< %s /Length %d 0 R >>\nstream\n" % (dictionary, lengthid))
+        size = 0
+        for offset, length in chunks:
+            f.seek(offset)
+            while length > 0:
+                block = f.read(min(65536, length))
+                self.file.write(block)
+                length -= len(block)
+                size += len(block)
+        self.file.write("\nendstream\nendobj\n")
+        self.write_object("%d" % (size), lengthid)
+        return width, height, dpi, imageid
+
+    def close(self):
+        # Write the page tree in book order, the document info and the cross reference table.
+        kids = " ".join([ "%d 0 R" % (self.pages[number]) for number in sorted(self.pages) ])
+        self.write_object("<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.pages)), self.pagesid)
+        direction = "/ViewerPreferences << /Direction /R2L >> " if self.info['righttoleft'] else ""
+        catalogid = self.write_object("<< /Type /Catalog /Pages %d 0 R %s>>" % (self.pagesid, direction))
+        info = { 'Title': self.info['title'], 'Producer': "GIMP Book %s" % (version) }
+        if 'Writer' in self.info['info']:
+            info['Author'] = self.info['info']['Writer']
+        if 'Summary' in self.info['info']:
+            info['Subject'] = self.info['info']['Summary']
+        infoid = self.write_object("<< %s >>" % (" ".join([ "/%s %s" % (key, pdf_string(info[key])) for key in sorted(info) ])))
+        xref = self.file.tell()
+        self.file.write("xref\n0 %d\n0000000000 65535 f \n" % (len(self.offsets)))
+        for offset in self.offsets[1:]:
+            self.file.write("%010d 00000 n \n" % (offset))
+        self.file.write("trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(self.offsets), catalogid, infoid, xref))
+        self.file.close()
+
+    def abort(self):
+        # Throw away a half done PDF.
+        self.file.close()
+        os.remove(self.path)
+
 
 class NTFileChooserButton(gtk.Button):
     # Hack for Windows to get a working FileChooserButton in Gimp 2.8.6+
@@ -379,30 +1658,511 @@ class NewBookWin(gtk.Window):
         # Destructor re-enables main window.
         self.main.set_sensitive(True)
 
+class ExportSettings():
+    # The options for exporting a book, as plain values that can be saved to and loaded from json.
+    # Missing options get the same defaults as the export window.
+    FORMATS = [ "gif", "xcf", "jpg", "ora", "psd", "png", "tif", "bmp" ]
+    SHARED = [ 'dest', 'from', 'to', 'chapters', 'editions', 'imposition', 'nupcolumns', 'nuprows', 'profile', 'profiletrace' ] # Options editions can't change.
+    CONTAINERS = { "": FORMATS,       # Page formats each container can hold.
+                   "cbz": [ "gif", "jpg", "png", "tif", "bmp" ],
+                   "pdf": [ "jpg", "png" ] }
+    DEFAULTS = { 'dest': None,        # Folder to create the export folder, named after the book, in.
+                 'name': 0,           # Name pages using 0: book name, 1: page names, 2: page numbers, 3: custom name.
+                 'customname': "",
+                 'from': 1,           # First page to export, 0 being the template.
+                 'to': None,          # Last page to export, None for the last page of the book.
+                 'chapters': [],      # Names of the chapters to export the pages of, empty for the whole book.
+                 'incremental': True, # Only export pages changed since the last export to the same folder.
+                 'subfolder': "",     # Folder within the export folder to save to.
+                 'editions': [],      # Dicts of subfolder, taghide, tagshow and any other options but SHARED, each exported from the same page loads.
+                 'taghide': "",       # Comma separated tags of layers to hide.
+                 'tagshow': "",       # Comma separated tags of layers to show.
+                 'tagun': 0,          # Untagged layers, 0: don't touch, 1: show, 2: hide.
+                 'margtop': 0,
+                 'margbot': 0,
+                 'marginner': 0,
+                 'margouter': 0,
+                 'margcolor': 0,      # Margin color, 0: the page's background color, 1: black, 2: white, 3: margcustom.
+                 'margcustom': (0, 0, 0),
+                 'imposition': 0,     # 0: single pages, 1: facing pages as spreads, 2: nupcolumns x nuprows pages per sheet.
+                 'nupcolumns': 2,
+                 'nuprows': 2,
+                 'scalepixels': False, # Scale to scalew x scaleh pixels, rather than percent.
+                 'scalew': 100.0,
+                 'scaleh': 100.0,
+                 'interp': 3,         # 0: none, 1: linear, 2: cubic, 3: sinc (lanczos3).
+                 'format': "jpg",     # One of FORMATS.
+                 'flatten': False,    # Flatten xcf, ora and psd. The other formats are always flattened.
+                 'container': "",     # Pack the pages into a single "cbz" or "pdf", rather than separate files.
+                 'gifgrayscale': False,
+                 'gifdither': 0,
+                 'gifcolors': 255,
+                 'gifinterlace': False,
+                 'jpgquality': 0.85,
+                 'jpgsmoothing': 0.0,
+                 'jpgoptimize': True,
+                 'jpgprogressive': False,
+                 'jpgcomment': "",
+                 'jpgsubsampling': 3,
+                 'jpgrestart': 0,     # Restart marker frequency, 0 for none.
+                 'jpgdct': 1,
+                 'psdcompress': 0,    # 0: none, 1: lzw, 2: pack bits.
+                 'pnginterlacing': False,
+                 'pngcompress': 9,
+                 'pngbgcolor': False,
+                 'pnggamma': False,
+                 'pnglayeroffset': False,
+                 'pngresolution': True,
+                 'pngcreationtime': True,
+                 'pngcoloroftransp': False,
+                 'tifcompress': 0,    # 0: none, 1: lzw, 2: pack bits, 3: deflate, 4: jpeg.
+                 'tifcoloroftransp': False,
+                 'streaming': False,  # Write tif, png and bmp a strip at a time, rather than having GIMP save the whole page.
+                 'memorylimit': 256,  # Megabytes of strips to hold at once, when streaming.
+                 'profile': False,    # Time each stage of exporting every page, such as loading, flattening, scaling and saving.
+                 'profiletrace': "" } # CSV or JSON file to write those timings to, when profiling.
+
+    def __init__(self, options=None):
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.update(options)
+
+    def __getitem__(self, key):
+        return self.options[key]
+
+    def __setitem__(self, key, value):
+        self.update({ key: value })
+
+    def update(self, options):
+        # Set several options at once, refusing ones that don't exist.
+        for key, value in options.items():
+            if not key in self.DEFAULTS:
+                raise ValueError(_("Unknown export option: %s") % (key))
+            if key == 'format' and not value in self.FORMATS:
+                raise ValueError(_("Unknown export format: %s") % (value))
+            if key in [ 'nupcolumns', 'nuprows' ] and value < 1:
+                raise ValueError(_("Sheets need at least one row and column of pages."))
+            if key == 'container' and not value in self.CONTAINERS:
+                raise ValueError(_("Unknown export container: %s") % (value))
+            self.options[key] = value
+        if not self['format'] in self.CONTAINERS[self['container']]:
+            # TRANSLATORS: %(container)s is cbz or pdf, %(format)s an image format such as xcf
+            raise ValueError(_("%(format)s pages can't be packed into a %(container)s file.") % { 'format': self['format'], 'container': self['container'] })
+        if 'editions' in options or 'format' in options or 'container' in options:
+            outputs = []
+            for edition in self['editions']:
+                for key in edition:
+                    if not key in self.DEFAULTS:
+                        raise ValueError(_("Unknown export option: %s") % (key))
+                    if key in self.SHARED:
+                        raise ValueError(_("Editions can't have an export option of their own for %s.") % (key))
+                outputs.append((edition.get('subfolder', ""), edition.get('container', self['container']) or edition.get('format', self['format'])))
+            if len(set(outputs)) != len(outputs):
+                raise ValueError(_("Each edition needs a subfolder or file format of its own."))
+
+    def to_json(self):
+        return json.dumps(self.options, indent=4, sort_keys=True)
+
+    def editions(self):
+        # The settings of each edition to export, or just these if there are no editions.
+        if not self['editions']:
+            return [ self ]
+        editions = []
+        for edition in self['editions']:
+            options = dict(self.options)
+            options.update({ 'editions': [], 'subfolder': "", 'taghide': "", 'tagshow': "" })
+            options.update(edition)
+            editions.append(ExportSettings(options))
+        return editions
+
+    def hash(self):
+        # Hash of the options that change how pages turn out, leaving out where and which pages to export.
+        options = dict(self.options)
+        for key in [ 'dest', 'from', 'to', 'chapters', 'incremental', 'subfolder', 'editions', 'memorylimit', 'profile', 'profiletrace' ]:
+            del options[key]
+        return hashlib.sha1(json.dumps(options, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(utf8(json.loads(text)))
+
+    @classmethod
+    def load(cls, path):
+        # Read settings from a json file.
+        f = open(path, "r")
+        text = f.read()
+        f.close()
+        return cls.from_json(text)
+
+    def save(self, path):
+        # Write the settings to a json file.
+        f = open(path, "w")
+        f.write(self.to_json())
+        f.close()
+
+
+class StageProfile():
+    # Seconds spent in each stage of the export or thumbnail pipelines, such as loading, flattening, scaling and
+    # saving, per page and in total. Filled from the 'stages' batch jobs run with 'profile' report back.
+    def __init__(self):
+        self.pages = []                          # Dicts of page, seconds and stages, in the order they were done.
+        self.totals = collections.OrderedDict()  # Seconds by stage, over all pages.
+        self.counts = {}                         # Pages that went through each stage.
+
+    def add(self, page, stages, seconds=None):
+        # Count the stage timings of a page.
+        self.pages.append({ 'page': page, 'seconds': seconds, 'stages': stages })
+        for stage, spent in stages.items():
+            self.totals[stage] = self.totals.get(stage, 0.0) + spent
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def summary(self, stages=None):
+        # The stages of a page, or the totals, slowest first, for showing.
+        stages = self.totals if stages is None else stages
+        # TRANSLATORS: %(stage)s is an export stage such as load, scale or save, %(seconds).1f the time it took
+        return ", ".join([ _("%(stage)s %(seconds).1f s") % { 'stage': stage, 'seconds': stages[stage] }
+                           for stage in sorted(stages, key=lambda s: -stages[s]) ])
+
+    def save(self, path):
+        # Write the timings as a CSV file, with a column per stage and the totals last, or as JSON for any other extension.
+        partpath = path + '.part'
+        f = open(partpath, "wb" if path.lower().endswith('.csv') else "w")
+        if path.lower().endswith('.csv'):
+            out = csv.writer(f)
+            out.writerow([ "page", "seconds" ] + self.totals.keys())
+            for page in self.pages:
+                out.writerow([ page['page'], "" if page['seconds'] is None else "%.4f" % (page['seconds']) ] +
+                             [ "%.4f" % (page['stages'][stage]) if stage in page['stages'] else "" for stage in self.totals ])
+            out.writerow([ "total", "%.4f" % (sum([ p['seconds'] or 0 for p in self.pages ])) ] + [ "%.4f" % (self.totals[stage]) for stage in self.totals ])
+        else:
+            f.write(json.dumps({ 'pages': self.pages, 'totals': self.totals, 'counts': self.counts }, indent=4))
+        f.close()
+        replace_file(partpath, path)
+
+
+class ExportJob():
+    # Exports a book in the background, on a BatchPool, reporting back on the GTK main loop. Can be paused and cancelled.
+    # With several editions, each page is loaded once and saved for every edition that needs it.
+    def __init__(self, book, settings, pages=None, progress=None, done=None, skip=None, pagedone=None):
+        self.progress = progress # Called with (done, total, page name, seconds or None if it failed, peak memory in bytes or None,
+                                 # seconds by stage or None if not profiling) per page.
+        self.done = done         # Called with the list of errors, when all pages are done or the export is cancelled.
+        self.pagedone = pagedone # Called with (job, ok) per page, before progress. The job's 'key' identifies the page.
+        self.manifests = []      # ExportManifest of each edition, None if not incremental. Editions in the same folder share one.
+        self.archives = []       # CbzWriter or PdfWriter of each edition, None if exporting separate files.
+        self.hashes = []         # Settings hash of each edition.
+        self.errors = []
+        self.count = 0           # Pages done.
+        self.peakrss = None
+        self.over = False
+        self.cancelled = False
+        self.profile = StageProfile() if settings['profile'] else None
+        self.trace = settings['profiletrace']
+        skip = set(skip or []) # Keys of pages to leave out, as they were exported already.
+        if settings['container']:
+            skip = set() # Archives are written from scratch, so every page is needed again.
+        jobs = {} # Batch job by page number, with the files to save from it.
+        editions = settings.editions()
+        folders = {} # ExportManifest of each folder exported to incrementally.
+        keep = {}    # Settings hash, extension and files of each edition exported to those folders.
+        outfiles = []
+        for edition in editions:
+            outfiles.append(book.export_sheets(edition, pages))
+            outfolder = book.export_folder(edition)
+            if not os.path.isdir(outfolder):
+                os.makedirs(outfolder)
+            if edition['incremental'] and not edition['container']:
+                if not outfolder in folders:
+                    folders[outfolder] = ExportManifest(outfolder)
+                    keep[outfolder] = []
+                if edition['imposition']:
+                    # Sheets are grouped from the first page exported, so only the pages on them are checked.
+                    made = outfiles[-1]
+                    covered = [ p['page'] for f in made for p in f['sheet']['pages'] ]
+                else:
+                    everything = ExportSettings(edition.options)
+                    everything.update({ 'from': 0, 'to': None, 'chapters': [] })
+                    made = book.export_sheets(everything, pages)
+                    covered = None
+                keep[outfolder].append((edition.hash(), '.' + edition['format'], [ os.path.basename(f['file']) for f in made ], covered))
+        for outfolder in folders:
+            # Remove files of pages that are gone or renumbered, once the files of every edition in the folder are known.
+            folders[outfolder].remove_stale(pages if pages is not None else book.page_list(), keep[outfolder])
+        for e, edition in enumerate(editions):
+            outfolder = book.export_folder(edition)
+            manifest = None
+            archive = None
+            if edition['container']:
+                # The pages are packed into the archive as they're done, and then deleted.
+                archivepath = os.path.join(outfolder, book.bookname + "." + edition['container'])
+                if edition['container'] == "cbz":
+                    archive = CbzWriter(archivepath, book.comic_info())
+                else:
+                    archive = PdfWriter(archivepath, book.comic_info())
+            elif edition['incremental']:
+                # Leave out pages exported before with the same settings.
+                manifest = folders[outfolder]
+                outfiles[e] = [ f for f in outfiles[e] if manifest.is_stale(os.path.basename(f['file']), f['image'], edition.hash()) ]
+            self.manifests.append(manifest)
+            self.archives.append(archive)
+            self.hashes.append(edition.hash())
+            for f in outfiles[e]:
+                if not f['number'] in jobs:
+                    jobs[f['number']] = { 'task': 'export', 'page': f['page'], 'number': f['number'], 'image': f['image'], 'outputs': [],
+                                          'key': "%d %s" % (f['number'], f['page']), 'profile': settings['profile'] }
+                    if 'sheet' in f:
+                        jobs[f['number']].update({ 'task': 'sheet', 'sheet': f['sheet'] })
+                jobs[f['number']]['outputs'].append({ 'file': f['file'], 'settings': f['settings'], 'tagged': f['tagged'], 'edition': e })
+        self.jobs = [ jobs[n] for n in sorted(jobs) if not jobs[n]['key'] in skip ]
+        # Even a single page goes to a worker, as exporting it in-process blocks GIMP, and with it Pause and Cancel.
+        self.pool = BatchPool(self.finished, 1)
+
+    def start(self):
+        # Start handing the pages out to the workers.
+        if self.jobs:
+            self.pool.add(self.jobs)
+        else:
+            self.finish()
+
+    def running(self):
+        # True until all pages are done, or the export is cancelled.
+        return not self.over
+
+    def finished(self, job, ok, message):
+        # A page is done. Note it in the manifests of its editions.
+        self.count += 1
+        seconds = None
+        stages = None
+        if not ok:
+            self.errors.append("%s: %s" % (job['page'], message))
+        else:
+            for output in job['outputs']:
+                if self.manifests[output['edition']]:
+                    page = [ p['page'] for p in job['sheet']['pages'] ] if 'sheet' in job else job['page']
+                    self.manifests[output['edition']].update(os.path.basename(output['file']), page, job['result']['signature'], self.hashes[output['edition']])
+                if self.archives[output['edition']]:
+                    try:
+                        self.archives[output['edition']].add(output['file'], job['number'])
+                    except (IOError, OSError, ValueError), err:
+                        # The page is kept, so it isn't lost along with the archive.
+                        self.errors.append("%s: %s" % (job['page'], err))
+                    else:
+                        os.remove(output['file'])
+            self.peakrss = max(self.peakrss, job['result']['peakrss'])
+            seconds = job['result']['seconds']
+            if self.profile:
+                stages = job['result']['stages']
+                self.profile.add(job['page'], stages, seconds)
+        if self.pagedone:
+            self.pagedone(job, ok)
+        if self.progress:
+            self.progress(self.count, len(self.jobs), job['page'], seconds, self.peakrss, stages)
+        if self.count == len(self.jobs):
+            self.finish()
+
+    def pause(self):
+        # Stop exporting until resumed.
+        self.pool.pause()
+
+    def resume(self):
+        # Carry on exporting after a pause.
+        self.pool.resume()
+
+    def cancel(self):
+        # Stop exporting. Pages done so far are kept, and left out of the next incremental export.
+        if not self.over:
+            self.cancelled = True
+            self.errors.append(_("The export was cancelled."))
+            self.finish()
+
+    def finish(self):
+        # Stop the workers, save the manifests, finish the archives and report back.
+        self.over = True
+        self.pool.stop()
+        for manifest in set(self.manifests):
+            if manifest:
+                manifest.save()
+        for archive in self.archives:
+            if archive and self.cancelled:
+                archive.abort()
+            elif archive:
+                archive.close()
+        if self.profile and self.trace:
+            try:
+                self.profile.save(self.trace)
+            except (IOError, OSError), err:
+                self.errors.append(str(err))
+        if self.done:
+            self.done(self.errors)
+
+
+class ExportQueue():
+    # Exports waiting to run, saved next to the .book file with the pages done so far, so an export interrupted by a
+    # crash resumes from the first page that didn't finish. Queued exports are run one after another.
+    def __init__(self, bookfile):
+        self.path = os.path.join(os.path.dirname(bookfile), EXPORTQUEUE)
+        self.entries = []  # Dicts with an id, the export settings, state and keys of the pages done.
+        self.nextid = 1
+        self.book = None
+        self.pages = None
+        self.job = None    # The ExportJob running.
+        self.entry = None  # The entry it's running.
+        self.progress = None
+        self.done = None
+        self.errors = []
+        self.stopped = False
+        if os.path.exists(self.path):
+            try:
+                f = open(self.path, "r")
+                self.entries = utf8(json.loads(f.read()))['entries']
+                f.close()
+            except (IOError, ValueError, KeyError):
+                self.entries = []
+        for entry in self.entries:
+            self.nextid = max(self.nextid, entry['id'] + 1)
+
+    def save(self):
+        # Write the queue, after every page, so it's up to date if GIMP crashes.
+        partpath = self.path + '.part'
+        f = open(partpath, "w")
+        f.write(json.dumps({ 'version': 1, 'entries': self.entries }))
+        f.close()
+        replace_file(partpath, self.path)
+
+    def add(self, settings):
+        # Queue an export with ExportSettings. If the same export is queued already, that one is resumed instead.
+        options = json.dumps(settings.options, sort_keys=True)
+        for entry in self.pending():
+            if json.dumps(entry['settings'], sort_keys=True) == options:
+                return entry
+        entry = { 'id': self.nextid, 'settings': dict(settings.options), 'state': 'queued', 'done': [], 'failed': 0 }
+        self.nextid += 1
+        self.entries.append(entry)
+        self.save()
+        return entry
+
+    def remove(self, entryid):
+        # Drop an entry from the queue, unless it's running.
+        if self.entry and self.entry['id'] == entryid:
+            return
+        self.entries = [ e for e in self.entries if e['id'] != entryid ]
+        self.save()
+
+    def pending(self):
+        # Entries still to export, including interrupted ones.
+        return [ e for e in self.entries if e['state'] in [ 'queued', 'running' ] ]
+
+    def run(self, book, progress=None, done=None, pages=None):
+        # Export the pending entries one after another, calling progress as ExportJob does, and done with the
+        # errors of them all when the queue is empty or cancelled. Pages default to those in the pagestore.
+        self.book = book
+        self.pages = pages
+        self.progress = progress
+        self.done = done
+        self.errors = []
+        self.stopped = False
+        self.next()
+
+    def next(self):
+        # Start the next pending entry, or report back if there are none left.
+        pending = self.pending()
+        if self.stopped or not pending:
+            self.job = None
+            self.entry = None
+            if self.done:
+                self.done(self.errors)
+            return
+        self.entry = pending[0]
+        self.entry['state'] = 'running'
+        self.save()
+        try:
+            settings = ExportSettings(self.entry['settings'])
+        except ValueError, err:
+            self.errors.append(str(err))
+            self.entry['state'] = 'failed'
+            self.save()
+            self.next()
+            return
+        self.job = ExportJob(self.book, settings, self.pages, progress=self.progress, done=self.job_done, skip=self.entry['done'], pagedone=self.page_done)
+        self.job.start()
+
+    def page_done(self, job, ok):
+        # Note a page as done, so it's left out if the export is resumed.
+        if ok:
+            self.entry['done'].append(job['key'])
+        else:
+            self.entry['failed'] += 1
+        self.save()
+
+    def job_done(self, errors):
+        # An entry is done. Done entries are dropped, those with failed pages are kept to show what went wrong.
+        self.errors.extend(errors)
+        if self.job.cancelled:
+            self.entry['state'] = 'queued' # Resumes from here next time.
+            self.stopped = True
+        elif self.entry['failed']:
+            self.entry['state'] = 'failed'
+        else:
+            self.entries.remove(self.entry)
+        self.save()
+        self.next()
+
+    def running(self):
+        # True while exporting.
+        return self.job is not None
+
+    def paused(self):
+        return self.job is not None and self.job.pool.paused
+
+    def pause(self):
+        # Stop exporting until resumed.
+        if self.job:
+            self.job.pause()
+
+    def resume(self):
+        # Carry on exporting after a pause.
+        if self.job:
+            self.job.resume()
+
+    def cancel(self):
+        # Stop exporting. The running entry stays in the queue, and resumes where it stopped next time.
+        self.stopped = True
+        if self.job:
+            self.job.cancel()
+
+
 class ExportWin(gtk.Window):
     # Windows for exporting the book in various formats.
     def __init__(self, main):
         # Build the export window.
         self.main = main
+        self.queue = ExportQueue(main.book.bookfile)
         win = super(ExportWin, self).__init__()
         self.set_transient_for(main)
+        self.connect("destroy", self.destroyed)
         self.set_title(_("Export Book..."))
         self.set_size_request(500, 500)
         self.set_position(gtk.WIN_POS_CENTER)
         # Divide the window into two columns, as it doesn't fit on one 1024x768 screen. :)
         dtab = gtk.VBox()
+        etab = gtk.VBox()
         mtab = gtk.VBox()
         stab = gtk.VBox()
         ftab = gtk.VBox()
+        qtab = gtk.VBox()
         self.tabs = gtk.Notebook()
         dtabl = gtk.Label(_("Destination"))
         self.tabs.append_page(dtab, dtabl)
+        etabl = gtk.Label(_("Editions"))
+        self.tabs.append_page(etab, etabl)
         mtabl = gtk.Label(_("Margins"))
         self.tabs.append_page(mtab, mtabl)
         stabl = gtk.Label(_("Image Size"))
         self.tabs.append_page(stab, stabl)
         ftabl = gtk.Label(_("File Format"))
         self.tabs.append_page(ftab, ftabl)
+        qtabl = gtk.Label(_("Queue"))
+        self.tabs.append_page(qtab, qtabl)
         cont = gtk.VBox(False, 4)
         cont.add(self.tabs)
         self.add(cont)
@@ -414,7 +2174,7 @@ class ExportWin(gtk.Window):
         destframelabel.set_use_markup(True)
         destframe.set_label_widget(destframelabel)
         # Destination table
-        destt = gtk.Table(4, 5, False)
+        destt = gtk.Table(4, 6, False)
         destl = gtk.Label(_("Destination Folder:"))
         self.destdialog = gtk.FileChooserDialog(_("Export to"), self.main, gtk.FILE_CHOOSER_ACTION_SELECT_FOLDER, (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL, gtk.STOCK_OPEN, gtk.RESPONSE_OK))
         self.destdialog.set_default_response(gtk.RESPONSE_OK)
@@ -441,7 +2201,7 @@ class ExportWin(gtk.Window):
         self.namem.connect("changed", self.name_option_changed)
 
         # Page range
-        self.pagecount = len(self.main.book.pagestore)-1
+        self.pagecount = len(self.main.book.page_list())-1
         rangel = gtk.Label(_("Pages from/to:"))
         rangefroma = gtk.Adjustment(1, 0, self.pagecount, 1)
         self.rangefrom = gtk.SpinButton(rangefroma, 1, 1)
@@ -449,6 +2209,14 @@ class ExportWin(gtk.Window):
         rangetoa = gtk.Adjustment(self.pagecount, 0, self.pagecount, 1)
         self.rangeto = gtk.SpinButton(rangetoa, 1, 1,)
         self.rangeto.connect("changed", self.rangetochanged)
+        self.incremental = gtk.CheckButton(_("Only Export Pages Changed Since the Last Export"))
+        self.incremental.set_active(True)
+        chaptersl = gtk.Label(_("Only Chapters:"))
+        self.chapters = gtk.Entry(4048)
+        chapternames = [ c['name'] for c in self.main.book.chapter_list() ]
+        # TRANSLATORS: %s is a comma separated list of the chapters in the book
+        self.chapters.set_tooltip_text(_("Comma separated names of the chapters to export, leave empty for the whole book. Chapters: %s") % (", ".join(chapternames)))
+        self.chapters.set_sensitive(bool(chapternames))
 
         # Layer tagging frame
         tagf = gtk.Frame()
@@ -456,7 +2224,7 @@ class ExportWin(gtk.Window):
         tagfl = gtk.Label(_("<b>Layer Tags</b>"))
         tagfl.set_use_markup(True)
         tagf.set_label_widget(tagfl)
-        tagt = gtk.Table(2,3)
+        tagt = gtk.Table(2,4)
 
         tagshowl = gtk.Label(_("Show Layers Tagged With:"))
         self.tagshow = gtk.Entry(4048)
@@ -478,6 +2246,23 @@ class ExportWin(gtk.Window):
         tagt.attach(self.tagshow, 1,2,1,2)
         tagt.attach(tagunl, 0,1,2,3)
         tagt.attach(self.tagunm, 1,2,2,3)
+
+        # Tags used in the book, with the number of pages using them.
+        tagls = gtk.ListStore(str, int)
+        tagcounts = self.main.book.tag_index()
+        for tag in sorted(tagcounts):
+            tagls.append((tag, tagcounts[tag]))
+        taglist = gtk.TreeView(tagls)
+        taglist.append_column(gtk.TreeViewColumn(_("Tag"), gtk.CellRendererText(), text=0))
+        taglist.append_column(gtk.TreeViewColumn(_("Pages"), gtk.CellRendererText(), text=1))
+        taglist.set_tooltip_text(_("Double click a tag to show the layers tagged with it."))
+        taglist.connect("row-activated", self.tag_activated)
+        tagscroll = gtk.ScrolledWindow()
+        tagscroll.set_policy(gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC)
+        tagscroll.set_shadow_type(gtk.SHADOW_ETCHED_IN)
+        tagscroll.set_size_request(-1, 100)
+        tagscroll.add(taglist)
+        tagt.attach(tagscroll, 0,2,3,4)
         tagf.add(tagt)
 
         # Attach stuff to the table
@@ -490,10 +2275,52 @@ class ExportWin(gtk.Window):
         destt.attach(rangel, 0,2,3,4)
         destt.attach(self.rangefrom, 2,3,3,4)
         destt.attach(self.rangeto, 3,4,3,4)
-        destt.attach(tagf, 0,4,4,5)
+        destt.attach(chaptersl, 0,2,4,5)
+        destt.attach(self.chapters, 2,4,4,5)
+        destt.attach(self.incremental, 0,4,5,6)
+        destt.attach(tagf, 0,4,6,7)
         destframe.add(destt)
         dtab.add(destframe)
 
+        # Editions frame
+        edf = gtk.Frame()
+        edf.set_shadow_type(gtk.SHADOW_NONE)
+        edfl = gtk.Label(_("<b>Editions</b>"))
+        edfl.set_use_markup(True)
+        edf.set_label_widget(edfl)
+        edbox = gtk.VBox(False, 4)
+        edl = gtk.Label(_("Export several editions of the book at once, each with its own layer tags, into its own subfolder. Each page is only loaded once for all of them. Leave empty to export a single edition with the tags on the Destination tab. Editions can also have a file format, size and margins of their own, set them on the other tabs, and click Use Current Format."))
+        edl.set_line_wrap(True)
+        edbox.pack_start(edl, False, False, 0)
+        # editions columns = subfolder, hide tags, show tags, format summary, json of the edition's own options
+        self.editions = gtk.ListStore(str, str, str, str, str)
+        edlist = gtk.TreeView(self.editions)
+        for column, title in enumerate([ _("Subfolder"), _("Hide Tags"), _("Show Tags") ]):
+            edc = gtk.CellRendererText()
+            edc.set_property('editable', True)
+            edc.connect("edited", self.edition_edited, column)
+            edlist.append_column(gtk.TreeViewColumn(title, edc, text=column))
+        edlist.append_column(gtk.TreeViewColumn(_("Format"), gtk.CellRendererText(), text=3))
+        edscroll = gtk.ScrolledWindow()
+        edscroll.set_policy(gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC)
+        edscroll.set_shadow_type(gtk.SHADOW_ETCHED_IN)
+        edscroll.add(edlist)
+        edbox.pack_start(edscroll, True, True, 0)
+        edbuttons = gtk.HBox(True, 4)
+        edadd = gtk.Button(_("Add Edition"))
+        edadd.connect("clicked", self.add_edition)
+        edremove = gtk.Button(_("Remove Edition"))
+        edremove.connect("clicked", self.remove_edition, edlist)
+        edformat = gtk.Button(_("Use Current Format"))
+        edformat.set_tooltip_text(_("Give the selected edition the file format, size and margins now set on the other tabs."))
+        edformat.connect("clicked", self.edition_format, edlist)
+        edbuttons.pack_start(edadd)
+        edbuttons.pack_start(edremove)
+        edbuttons.pack_start(edformat)
+        edbox.pack_start(edbuttons, False, False, 0)
+        edf.add(edbox)
+        etab.add(edf)
+
 
         # Margin frame
         self.margf = gtk.Frame()
@@ -559,6 +2386,42 @@ class ExportWin(gtk.Window):
         margt.attach(margcolf,0,2,4,5)
         self.margf.add(margt)
 
+        # Layout frame
+        layoutf = gtk.Frame()
+        layoutf.set_shadow_type(gtk.SHADOW_NONE)
+        layoutfl = gtk.Label(_("<b>Layout</b>"))
+        layoutfl.set_use_markup(True)
+        layoutf.set_label_widget(layoutfl)
+        mtab.add(layoutf)
+        layoutt = gtk.Table(3,2)
+        layoutml = gtk.Label(_("Export:"))
+        layoutls = gtk.ListStore(gobject.TYPE_STRING)
+        for o in [ _("Single Pages"), _("Facing Pages as Spreads"), _("Several Pages per Sheet") ]:
+            layoutls.append([o])
+        self.layoutm = gtk.ComboBox(layoutls)
+        layoutc = gtk.CellRendererText()
+        self.layoutm.pack_start(layoutc, True)
+        self.layoutm.add_attribute(layoutc, 'text', 0)
+        self.layoutm.set_active(0)
+        self.layoutm.set_tooltip_text(_("Spreads and sheets follow the reading direction of the book."))
+        self.layoutm.connect("changed", self.layout_changed)
+        self.nupcolumnsl = gtk.Label(_("Pages Across:"))
+        nupcolumnsa = gtk.Adjustment(2, 1, 16, 1, 2)
+        self.nupcolumns = gtk.SpinButton(nupcolumnsa, 1, 0)
+        self.nupcolumns.set_numeric(True)
+        self.nuprowsl = gtk.Label(_("Pages Down:"))
+        nuprowsa = gtk.Adjustment(2, 1, 16, 1, 2)
+        self.nuprows = gtk.SpinButton(nuprowsa, 1, 0)
+        self.nuprows.set_numeric(True)
+        layoutt.attach(layoutml, 0,1,0,1)
+        layoutt.attach(self.layoutm, 1,2,0,1)
+        layoutt.attach(self.nupcolumnsl, 0,1,1,2)
+        layoutt.attach(self.nupcolumns, 1,2,1,2)
+        layoutt.attach(self.nuprowsl, 0,1,2,3)
+        layoutt.attach(self.nuprows, 1,2,2,3)
+        layoutf.add(layoutt)
+        self.layout_changed(self.layoutm)
+
         # Size frame
         self.templatew, self.templateh = self.main.book.get_template_size()
         self.wfactor = float(self.templateh) / float(self.templatew)
@@ -655,24 +2518,141 @@ class ExportWin(gtk.Window):
         formatt.attach(self.pngt, 0,2,1,2)
         formatt.attach(self.tift, 0,2,1,2)
         formatt.attach(self.bmpt, 0,2,1,2)
+        containerl = gtk.Label(_("Pack Pages Into:"))
+        containerls = gtk.ListStore(gobject.TYPE_STRING)
+        for containeroption in [ _("Separate Files"), _("Comic Book Archive (*.cbz)"), _("PDF Document (*.pdf)") ]:
+            containerls.append([containeroption])
+        self.containerm = gtk.ComboBox(containerls)
+        containerc = gtk.CellRendererText()
+        self.containerm.pack_start(containerc, True)
+        self.containerm.add_attribute(containerc, 'text', 0)
+        self.containerm.set_active(0)
+        self.containerm.set_tooltip_text(_("CBZ files can hold GIF, JPEG, PNG, TIFF and BMP pages, PDF files JPEG and PNG pages."))
+        formatt.attach(containerl, 0,1,2,3)
+        formatt.attach(self.containerm, 1,2,2,3)
         formatf.add(formatt)
 
+        # Memory frame
+        memf = gtk.Frame()
+        memf.set_shadow_type(gtk.SHADOW_NONE)
+        memfl = gtk.Label(_("<b>Memory</b>"))
+        memfl.set_use_markup(True)
+        memf.set_label_widget(memfl)
+        ftab.pack_start(memf, False, False, 0)
+        memt = gtk.Table(2,2)
+        self.streaming = gtk.CheckButton(_("Save TIFF, PNG and BMP in Strips, for Very Large Pages"))
+        self.streaming.connect("toggled", self.streaming_toggled)
+        memlimitl = gtk.Label(_("Memory Limit (MB):"))
+        memlimita = gtk.Adjustment(256, 16, 65536, 16, 128)
+        self.memlimit = gtk.SpinButton(memlimita, 1, 0)
+        self.memlimit.set_numeric(True)
+        self.memlimit.set_sensitive(False)
+        memt.attach(self.streaming, 0,2,0,1)
+        memt.attach(memlimitl, 0,1,1,2)
+        memt.attach(self.memlimit, 1,2,1,2)
+        memf.add(memt)
+
+        # Profiling frame
+        proff = gtk.Frame()
+        proff.set_shadow_type(gtk.SHADOW_NONE)
+        proffl = gtk.Label(_("<b>Profiling</b>"))
+        proffl.set_use_markup(True)
+        proff.set_label_widget(proffl)
+        ftab.pack_start(proff, False, False, 0)
+        proft = gtk.Table(2,2)
+        self.profile = gtk.CheckButton(_("Time Each Stage of Exporting a Page"))
+        self.profile.connect("toggled", self.profile_toggled)
+        tracel = gtk.Label(_("Save Timings to:"))
+        self.trace = gtk.Entry()
+        self.trace.set_tooltip_text(_("A .csv or .json file for the time each page spent loading, flattening, scaling and saving. Leave empty to only show the timings."))
+        self.trace.set_sensitive(False)
+        proft.attach(self.profile, 0,2,0,1)
+        proft.attach(tracel, 0,1,1,2)
+        proft.attach(self.trace, 1,2,1,2)
+        proff.add(proft)
+        self.stageprofile = StageProfile() # Stage timings of the pages exported, when profiling.
+
+        # Queue frame
+        queuef = gtk.Frame()
+        queuef.set_shadow_type(gtk.SHADOW_NONE)
+        queuefl = gtk.Label(_("<b>Export Queue</b>"))
+        queuefl.set_use_markup(True)
+        queuef.set_label_widget(queuefl)
+        qtab.add(queuef)
+        queuebox = gtk.VBox(False, 4)
+        # queuels columns = entry id, destination, format, state
+        self.queuels = gtk.ListStore(int, str, str, str)
+        self.queuelist = gtk.TreeView(self.queuels)
+        self.queuelist.append_column(gtk.TreeViewColumn(_("Destination"), gtk.CellRendererText(), text=1))
+        self.queuelist.append_column(gtk.TreeViewColumn(_("Format"), gtk.CellRendererText(), text=2))
+        self.queuelist.append_column(gtk.TreeViewColumn(_("State"), gtk.CellRendererText(), text=3))
+        queuescroll = gtk.ScrolledWindow()
+        queuescroll.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        queuescroll.set_shadow_type(gtk.SHADOW_ETCHED_IN)
+        queuescroll.add(self.queuelist)
+        queuebox.pack_start(queuescroll, True, True, 0)
+        queueb = gtk.HBox(True, 4)
+        queuerm = gtk.Button(_("Remove"))
+        queuerm.connect("clicked", self.remove_queued)
+        queuerun = gtk.Button(_("Run Queue"))
+        queuerun.connect("clicked", self.run_queue)
+        queueb.pack_start(queuerm)
+        queueb.pack_start(queuerun)
+        queuebox.pack_start(queueb, False, False, 0)
+        queuef.add(queuebox)
+        self.refresh_queue()
+
         # Done buttons
         self.doneb = gtk.HBox(True, 4)
         cancelb = gtk.Button(_("Cancel"))
         cancelb.connect("clicked", self.close)
+        saveb = gtk.Button(_("Save Settings..."))
+        saveb.connect("clicked", self.save_settings)
+        queueaddb = gtk.Button(_("Add to Queue"))
+        queueaddb.connect("clicked", self.add_queued)
         exportb = gtk.Button(_("Export Pages"))
         exportb.connect("clicked", self.export)
         self.doneb.pack_start(cancelb)
+        self.doneb.pack_start(saveb)
+        self.doneb.pack_start(queueaddb)
         self.doneb.pack_start(exportb)
+        if not find_gimp_console():
+            # Without gimp-console the pages are exported in-process, a page at a time between GTK events.
+            blockl = gtk.Label(_("No gimp-console was found to export the pages in the background. GIMP will not respond while each page is exported, and Pause and Cancel only take effect between pages. Add gimp-console to your PATH, or set GIMP_BOOK_GIMP to it, to export in the background."))
+            blockl.set_line_wrap(True)
+            cont.pack_start(blockl, False, False, 0)
         cont.add(self.doneb)
 
+        # Export controls, shown instead of the tabs while exporting.
+        self.runb = gtk.HBox(True, 4)
+        self.pauseb = gtk.Button(_("Pause"))
+        self.pauseb.connect("clicked", self.pause_export)
+        stopb = gtk.Button(_("Cancel Export"))
+        stopb.connect("clicked", self.cancel_export)
+        self.runb.pack_start(self.pauseb)
+        self.runb.pack_start(stopb)
+        cont.pack_end(self.runb, False, False, 0)
+
         # Progress bar.
         self.progress = gtk.ProgressBar()
         cont.pack_end(self.progress, False, False, 0)
 
+        # Time taken by each page exported, and by each stage when profiling.
+        self.timings = gtk.ListStore(str, str, str)
+        self.timingl = gtk.TreeView(self.timings)
+        self.timingl.append_column(gtk.TreeViewColumn(_("Page"), gtk.CellRendererText(), text=0))
+        self.timingl.append_column(gtk.TreeViewColumn(_("Time"), gtk.CellRendererText(), text=1))
+        self.timingl.append_column(gtk.TreeViewColumn(_("Stages"), gtk.CellRendererText(), text=2))
+        self.timingscroll = gtk.ScrolledWindow()
+        self.timingscroll.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        self.timingscroll.set_shadow_type(gtk.SHADOW_ETCHED_IN)
+        self.timingscroll.add(self.timingl)
+        cont.add(self.timingscroll)
+
         self.show_all()
         self.progress.hide()
+        self.runb.hide()
+        self.timingscroll.hide()
         self.format_changed(2)
 
     def ntdestdialog(self, input):
@@ -689,6 +2669,47 @@ class ExportWin(gtk.Window):
         else:
             self.namee.set_sensitive(False)
 
+    def add_edition(self, button):
+        # Add an edition, to be named and tagged in the list.
+        # TRANSLATORS: %d is the number of the edition
+        self.editions.append((_("Edition %d") % (len(self.editions) + 1), "", "", _("As Set"), "{}"))
+
+    def remove_edition(self, button, edlist):
+        # Remove the selected edition.
+        model, selected = edlist.get_selection().get_selected()
+        if selected:
+            model.remove(selected)
+
+    def edition_format(self, button, edlist):
+        # Give the selected edition the format, size and margins options set on the other tabs.
+        model, selected = edlist.get_selection().get_selected()
+        if not selected:
+            return
+        try:
+            settings = self.get_settings()
+        except ValueError, err:
+            show_error_msg(err)
+            return
+        ownkeys = [ 'subfolder', 'taghide', 'tagshow', 'tagun', 'incremental', 'name', 'customname' ] + ExportSettings.SHARED
+        options = dict([ (key, value) for key, value in settings.options.items() if not key in ownkeys ])
+        if settings['scalepixels']:
+            size = "%dx%d" % (settings['scalew'], settings['scaleh'])
+        else:
+            size = "%d%%" % (settings['scalew'])
+        model.set_value(selected, 3, "%s, %s" % (settings['container'] or settings['format'], size))
+        model.set_value(selected, 4, json.dumps(options))
+
+    def edition_edited(self, cell, path, text, column):
+        # Store the subfolder or tags of an edition.
+        self.editions[path][column] = text
+
+    def tag_activated(self, taglist, path, column):
+        # Add a tag from the list of tags in the book to the ones to show.
+        tag = taglist.get_model()[path][0]
+        tags = [ t.strip() for t in self.tagshow.get_text().split(',') if t.strip() ]
+        if not tag in tags:
+            self.tagshow.set_text(",".join(tags + [ tag ]))
+
     def rangefromchanged(self, sb):
         # Page from changed.
         if self.rangefrom.get_value() > self.rangeto.get_value():
@@ -867,6 +2888,19 @@ class ExportWin(gtk.Window):
         jpgt.attach(self.jpgcomment, 1,2,8,9)
         return jpgt
 
+    def layout_changed(self, layoutm):
+        # The number of pages across and down only matters for sheets.
+        for widget in [ self.nupcolumnsl, self.nupcolumns, self.nuprowsl, self.nuprows ]:
+            widget.set_sensitive(layoutm.get_active() == 2)
+
+    def streaming_toggled(self, streaming):
+        # The memory limit only matters when saving in strips.
+        self.memlimit.set_sensitive(streaming.get_active())
+
+    def profile_toggled(self, profile):
+        # The timings file only matters when profiling.
+        self.trace.set_sensitive(profile.get_active())
+
     def jpgrestartchecked(self, restartcheckbox):
         # JPG restart has been checked.
         if restartcheckbox.get_active():
@@ -962,59 +2996,412 @@ class ExportWin(gtk.Window):
         # BMP save options GUI.
         bmpt = gtk.Table(1,2)
         return bmpt
-        
+
+    def get_settings(self):
+        # Read the export options off the widgets, into ExportSettings.
+        ext = self.main.book.format_index_to_extension(self.formatm.get_active())
+        color = self.margcol.get_color()
+        settings = { 'dest': self.destbutton.get_filename(),
+                     'name': self.namem.get_active(),
+                     'customname': self.namee.get_text(),
+                     'from': int(self.rangefrom.get_value()),
+                     'to': int(self.rangeto.get_value()),
+                     'chapters': [ c.strip() for c in self.chapters.get_text().split(',') if c.strip() ],
+                     'incremental': self.incremental.get_active(),
+                     'taghide': self.taghide.get_text(),
+                     'tagshow': self.tagshow.get_text(),
+                     'tagun': self.tagunm.get_active(),
+                     'margtop': self.margtop.get_value(),
+                     'margbot': self.margbot.get_value(),
+                     'marginner': self.marginner.get_value(),
+                     'margouter': self.margouter.get_value(),
+                     'margcolor': self.margcolm.get_active(),
+                     'margcustom': (color.red/257, color.green/257, color.blue/257),
+                     'imposition': self.layoutm.get_active(),
+                     'nupcolumns': int(self.nupcolumns.get_value()),
+                     'nuprows': int(self.nuprows.get_value()),
+                     'scalepixels': self.scaletype.get_active(),
+                     'scalew': self.scalew.get_value(),
+                     'scaleh': self.scaleh.get_value(),
+                     'interp': self.interp.get_active(),
+                     'format': ext,
+                     'container': [ "", "cbz", "pdf" ][self.containerm.get_active()],
+                     'streaming': self.streaming.get_active(),
+                     'memorylimit': int(self.memlimit.get_value()),
+                     'profile': self.profile.get_active(),
+                     'profiletrace': self.trace.get_text() }
+        if ext == "gif":
+            settings.update({ 'gifgrayscale': self.gifgrayscale.get_active(),
+                              'gifdither': self.gifdith.get_active(),
+                              'gifcolors': self.gifcolors.get_value(),
+                              'gifinterlace': self.gifinterlace.get_active() })
+        elif ext == "xcf":
+            settings['flatten'] = self.xcfflatten.get_active()
+        elif ext == "jpg":
+            restartfreq = 0
+            if self.jpgrestart.get_active():
+                restartfreq = self.jpgfreq.get_value()
+            settings.update({ 'jpgquality': float(self.jpgquality.get_value() / 100),
+                              'jpgsmoothing': self.jpgsmoothing.get_value(),
+                              'jpgoptimize': self.jpgoptimize.get_active(),
+                              'jpgprogressive': self.jpgprogressive.get_active(),
+                              'jpgcomment': self.jpgcomment.get_text(),
+                              'jpgsubsampling': self.jpgsub.get_active(),
+                              'jpgrestart': restartfreq,
+                              'jpgdct': self.jpgdct.get_active() })
+        elif ext == "ora":
+            settings['flatten'] = self.oraflatten.get_active()
+        elif ext == "psd":
+            compress = 0
+            if self.psdlzw.get_active():
+                compress = 1
+            elif self.psdpackbits.get_active():
+                compress = 2
+            settings.update({ 'flatten': self.psdflatten.get_active(), 'psdcompress': compress })
+        elif ext == "png":
+            settings.update({ 'pnginterlacing': self.pnginterlacing.get_active(),
+                              'pngcompress': self.pngcompress.get_value(),
+                              'pngbgcolor': self.pngbgcolor.get_active(),
+                              'pnggamma': self.pnggamma.get_active(),
+                              'pnglayeroffset': self.pnglayeroffset.get_active(),
+                              'pngresolution': self.pngresolution.get_active(),
+                              'pngcreationtime': self.pngcreationtime.get_active(),
+                              'pngcoloroftransp': self.pngcoloroftransp.get_active() })
+        elif ext == "tif":
+            compress = 0
+            if self.tiflzw.get_active():
+                compress = 1
+            elif self.tifpackbits.get_active():
+                compress = 2
+            elif self.tifdeflate.get_active():
+                compress = 3
+            elif self.tifjpeg.get_active():
+                compress = 4
+            settings.update({ 'tifcompress': compress, 'tifcoloroftransp': self.tifcoloroftransp.get_active() })
+        settings['editions'] = []
+        for e in self.editions:
+            edition = utf8(json.loads(e[4]))
+            edition.update({ 'subfolder': e[0], 'taghide': e[1], 'tagshow': e[2] })
+            settings['editions'].append(edition)
+        chapternames = [ c['name'] for c in self.main.book.chapter_list() ]
+        for chapter in settings['chapters']:
+            if not chapter in chapternames:
+                # TRANSLATORS: %s is the name of a chapter to export
+                raise ValueError(_("The book has no chapter called %s.") % (chapter))
+        return ExportSettings(settings)
+
+    def save_settings(self, button):
+        # Save the export settings to a json file, for exporting from the command line.
+        savedialog = gtk.FileChooserDialog(_("Save Export Settings"), self, gtk.FILE_CHOOSER_ACTION_SAVE, (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL, gtk.STOCK_SAVE, gtk.RESPONSE_OK))
+        savedialog.set_default_response(gtk.RESPONSE_OK)
+        savedialog.set_do_overwrite_confirmation(True)
+        savedialog.set_current_name(self.main.book.bookname + ".json")
+        jsonfilter = gtk.FileFilter()
+        jsonfilter.set_name(_("Export Settings"))
+        jsonfilter.add_pattern("*.json")
+        savedialog.add_filter(jsonfilter)
+        if savedialog.run() == gtk.RESPONSE_OK:
+            try:
+                self.get_settings().save(savedialog.get_filename())
+            except Exception, err:
+                show_error_msg(err)
+        savedialog.destroy()
+
+    def refresh_queue(self):
+        # List the exports in the queue.
+        states = { 'queued': _("Queued"), 'running': _("Interrupted"), 'failed': _("Failed") }
+        self.queuels.clear()
+        for entry in self.queue.entries:
+            state = states[entry['state']]
+            if entry['done'] and entry['state'] != 'failed':
+                # TRANSLATORS: %(state)s is the state of a queued export, %(done)d the number of pages exported so far
+                state = _("%(state)s, %(done)d pages done") % { 'state': state, 'done': len(entry['done']) }
+            self.queuels.append((entry['id'], os.path.join(entry['settings']['dest'] or "", entry['settings']['subfolder']), entry['settings']['format'], state))
+
+    def add_queued(self, button):
+        # Add the export settings to the queue, to export later.
+        try:
+            self.queue.add(self.get_settings())
+        except ValueError, err:
+            show_error_msg(err)
+            return
+        self.refresh_queue()
+        self.tabs.set_current_page(self.tabs.get_n_pages() - 1)
+
+    def remove_queued(self, button):
+        # Remove the selected export from the queue.
+        model, selected = self.queuelist.get_selection().get_selected()
+        if selected:
+            self.queue.remove(model.get_value(selected, 0))
+            self.refresh_queue()
+
+    def export_errors(self, errors):
+        # Report pages that failed to export.
+        for error in errors:
+            show_error_msg(error)
+
+    def export_progress(self, done, total, page, seconds=None, peakrss=None, stages=None):
+        # Show how far the export has come, and how long the page and each of its stages took.
+        summary = ""
+        if stages:
+            self.stageprofile.add(page, stages, seconds)
+            summary = self.stageprofile.summary(stages)
+        if seconds is None:
+            self.timings.append((page, _("Failed"), summary))
+        else:
+            # TRANSLATORS: Time taken to export a page, in seconds
+            self.timings.append((page, _("%.1f s") % (seconds), summary))
+        self.timingl.scroll_to_cell(len(self.timings) - 1)
+        if peakrss:
+            # TRANSLATORS: %(page)s is the name of the page that was just exported, %(memory)d the most memory used in megabytes
+            self.progress.set_text(_("Exported %(page)s (peak memory %(memory)d MB)") % { 'page': page, 'memory': peakrss / 1048576 })
+        else:
+            # TRANSLATORS: %s is the name of the page that was just exported
+            self.progress.set_text(_("Exported %s") % (page))
+        self.progress.set_fraction(float(done) / total)
+
     def export(self, button):
-        # Pass self to Book, and tell it to export.
-        self.tabs.set_sensitive(False)
-        self.doneb.set_sensitive(False)
-        self.progress.set_fraction(0)
-        self.progress.set_text("")
+        # Queue the export, and start exporting the queue in the background.
+        try:
+            settings = self.get_settings()
+        except ValueError, err:
+            show_error_msg(err)
+            return
         outfolder = os.path.join(self.destbutton.get_filename(), self.main.book.bookname)
         if os.path.isdir(outfolder):
             # TRANSLATORS: %s is a previously exported book
             overwrite = gtk.MessageDialog(self.main, 0, gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO, _('"%s" exists, do you want to overwrite it?') % (outfolder))
             response = overwrite.run()
-            if response == gtk.RESPONSE_YES:
-                overwrite.hide()
-                self.progress.show()
-                self.main.book.export_book(self)
-                self.destroy()
-            else:
-                self.tabs.set_sensitive(True)
-                self.doneb.set_sensitive(True)
             overwrite.destroy()
+            if response != gtk.RESPONSE_YES:
+                return
+        self.queue.add(settings)
+        self.run_queue(button)
+
+    def run_queue(self, button):
+        # Export everything in the queue, one after another, in the background.
+        if not self.queue.pending():
+            return
+        self.tabs.hide()
+        self.doneb.hide()
+        self.progress.set_fraction(0)
+        self.progress.set_text("")
+        self.progress.show()
+        self.timingscroll.show()
+        self.runb.show()
+        self.main.set_sensitive(True) # The book can be browsed while it's exporting.
+        self.queue.run(self.main.book, self.export_progress, self.export_done)
+
+    def export_done(self, errors):
+        # The export is finished or cancelled. Show where the time went, when profiling.
+        self.export_errors(errors)
+        if self.stageprofile.pages:
+            # TRANSLATORS: %(pages)d is the number of pages exported, %(stages)s lists the export stages, such as load, scale and save, with the seconds spent in each
+            timings = gtk.MessageDialog(self.main, 0, gtk.MESSAGE_INFO, gtk.BUTTONS_OK, _("Time spent exporting %(pages)d pages: %(stages)s") %
+                                        { 'pages': len(self.stageprofile.pages), 'stages': self.stageprofile.summary() })
+            timings.run()
+            timings.destroy()
+        self.destroy()
+
+    def pause_export(self, button):
+        # Pause or resume the export.
+        if self.queue.paused():
+            self.queue.resume()
+            self.pauseb.set_label(_("Pause"))
         else:
-            self.progress.show()
-            self.tabs.set_sensitive(False)
-            self.doneb.set_sensitive(False)
-            self.main.book.export_book(self)
-            self.destroy()
+            self.queue.pause()
+            self.pauseb.set_label(_("Resume"))
+            self.progress.set_text(_("Paused"))
+
+    def cancel_export(self, button):
+        # Stop exporting, keeping the pages done so far. The export resumes from there when the queue is run again.
+        self.queue.cancel()
 
     def close(self, button):
         # Close the export window.
         self.destroy()
 
+    def destroyed(self, window):
+        # Closing the window cancels any export still running.
+        if self.queue.running():
+            self.queue.done = None
+            self.queue.cancel()
+        self.main.exportwin = None
+        self.main.set_sensitive(True)
+
     def __del__(self):
         # Destructor makes sure main window is sensitive.
         self.main.set_sensitive(True)
 
 
+class BookJournal():
+    # Append-only log of the changes made to a book since its *.book file was last written. Each line is a revision of
+    # the book, with the page operations that made it, so a change costs one short line rather than rewriting the whole
+    # file, and a book is recovered after a crash by replaying the lines newer than its *.book file.
+    def __init__(self, bookfile):
+        self.path = os.path.join(os.path.dirname(bookfile), BOOKJOURNAL)
+        self.file = None
+        self.lines = 0 # Revisions in the journal.
+
+    def append(self, revision, ops):
+        # Log a revision, making sure it's on disk before carrying on.
+        if not self.file:
+            self.file = open(self.path, "a")
+        self.file.write(json.dumps({ 'revision': revision, 'ops': ops }) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.lines += 1
+
+    def replay(self, metadata):
+        # Apply the revisions newer than the metadata read from the *.book file to it. A line cut short by a crash,
+        # and anything after it, is left out.
+        if not os.path.exists(self.path):
+            return
+        f = open(self.path, "r")
+        for line in f:
+            try:
+                entry = utf8(json.loads(line))
+            except ValueError:
+                break
+            self.lines += 1
+            if entry['revision'] > metadata.get('revision', 0):
+                apply_book_changes(metadata, entry['ops'])
+                metadata['revision'] = entry['revision']
+        f.close()
+
+    def clear(self):
+        # Start over, once the *.book file has all the changes.
+        if self.file:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.lines = 0
+
+
+class BookDatabase():
+    # Page list of a book kept in an SQLite database next to its *.book file, for books with thousands of pages.
+    # Pages are ordered by positions with gaps between them, so moving, adding or renaming a page writes its own row,
+    # rather than the whole list.
+    def __init__(self, bookfile):
+        self.path = os.path.join(os.path.dirname(bookfile), BOOKDATABASE)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages (id INTEGER PRIMARY KEY, position REAL NOT NULL, name TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pages_position ON pages (position)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pages_name ON pages (name)")
+        self.db.commit()
+        self.rows = [] # (id, position) of each page, in order.
+
+    def pages(self):
+        # The page names, in order.
+        cursor = self.db.execute("SELECT id, position, name FROM pages ORDER BY position")
+        self.rows = []
+        names = []
+        for rowid, position, name in cursor:
+            self.rows.append((rowid, position))
+            names.append(utf8(name))
+        return names
+
+    def replace(self, pages):
+        # Write a whole page list, spreading the positions out evenly.
+        self.db.execute("DELETE FROM pages")
+        self.db.executemany("INSERT INTO pages (position, name) VALUES (?, ?)", [ ((i + 1) * BOOKGAP, name.decode('utf-8')) for i, name in enumerate(pages) ])
+        self.db.commit()
+        self.pages()
+
+    def apply(self, ops):
+        # Write the page operations of book_changes in one transaction, touching only the rows they change.
+        # A page deleted and another inserted in its place is a rename, and updates the row. Returns the other operations.
+        rest = []
+        i = 0
+        while i < len(ops):
+            op = ops[i]
+            if op['op'] == 'delete':
+                after = ops[i + 1] if i + 1 < len(ops) else None
+                if after and after['op'] == 'insert' and after['index'] == op['index'] and len(after['pages']) == op['count']:
+                    for k, name in enumerate(after['pages']):
+                        self.db.execute("UPDATE pages SET name = ? WHERE id = ?", (name.decode('utf-8'), self.rows[op['index'] + k][0]))
+                    i += 1
+                else:
+                    gone = self.rows[op['index']:op['index'] + op['count']]
+                    self.db.executemany("DELETE FROM pages WHERE id = ?", [ (rowid,) for rowid, position in gone ])
+                    del self.rows[op['index']:op['index'] + op['count']]
+            elif op['op'] == 'insert':
+                self.insert(op['index'], op['pages'])
+            else:
+                rest.append(op)
+            i += 1
+        self.db.commit()
+        return rest
+
+    def insert(self, index, pages):
+        # Insert pages between the positions of their neighbours, spreading all positions out again if they're too close.
+        before = self.rows[index - 1][1] if index > 0 else 0.0
+        after = self.rows[index][1] if index < len(self.rows) else before + BOOKGAP * (len(pages) + 1)
+        step = (after - before) / (len(pages) + 1)
+        if before + step == before or before + step * len(pages) >= after:
+            self.respace()
+            self.insert(index, pages)
+            return
+        rows = []
+        for k, name in enumerate(pages):
+            cursor = self.db.execute("INSERT INTO pages (position, name) VALUES (?, ?)", (before + step * (k + 1), name.decode('utf-8')))
+            rows.append((cursor.lastrowid, before + step * (k + 1)))
+        self.rows[index:index] = rows
+
+    def respace(self):
+        # Spread the positions out evenly again, when there's no room left between two pages.
+        self.rows = [ (rowid, (i + 1) * BOOKGAP) for i, (rowid, position) in enumerate(self.rows) ]
+        self.db.executemany("UPDATE pages SET position = ? WHERE id = ?", [ (position, rowid) for rowid, position in self.rows ])
+
+    def close(self):
+        self.db.close()
+
+    def remove(self):
+        # Delete the database, once the pages are back in the *.book file.
+        self.close()
+        os.remove(self.path)
+
+
 class Book():
     # Stores and manages the data for the book.
     def __init__(self, main):
         # Defines basic variables to store.
-        # pagestore columns = pagename, thumb Pixbuf, thumb path
-        self.pagestore = gtk.ListStore(str, gtk.gdk.Pixbuf, str)
+        # pagestore columns = pagename ("" for chapters), thumb Pixbuf, thumb path, label, chapter name ("" for pages)
+        self.pagestore = gtk.ListStore(str, gtk.gdk.Pixbuf, str, str, str)
         self.main = main     # Main windows.
         self.bookfile = ""   # The *.book for this book.
         self.bookname = ""   # The name of the book.
         self.pagepath = ""   # Path to the pages subfolder.
         self.trashpath = ""  # Path to trash folder.
         self.thumbpath = ""  # Path to the thumbs folder.
+        self.thumbindex = None # ThumbIndex of the thumbs folder.
+        self.thumbpacks = {}   # ThumbPack of each thumb size, once it's been used.
+        self.info = {}       # ComicInfo fields from the *.book file, such as Series, Writer and Summary.
+        self.readingdirection = 0 # From the *.book file, when there is no window.
+        self.watcher = None  # PageWatcher of the pages folder.
         self.selected = 0    # Index of the currently selected page, -1 if none.
         self.thumbsize = 256 # Defautl thumbnail size.
         self.thumbwidth = 256
         self.aspect = 1      # The aspect ratio of the page (a width 7 and height 10 page, is 0.7 aspect)
+        self.thumbpool = BatchPool(self.thumb_finished) # Builds stale thumbs in the background.
+        self.building = set() # Paths of thumbs queued in the thumbpool.
+        self.buildtotal = 0   # Thumbs queued since the thumbpool was last idle.
+        self.thumbprofile = None # StageProfile of the thumbs built, while timing them.
+        self.importpool = BatchPool(self.import_finished) # Converts imported pages to .xcf in the background.
+        self.importing = None # The pages being imported, and where they go, until they're all done.
+        self.pixcache = collections.OrderedDict() # Decoded thumbs shown in the pagestore by thumb path, least recently used first.
+        self.pixbytes = 0     # Size of the decoded thumbs in pixcache.
+        self.placeholders = {} # Placeholder pixbufs by thumb size.
+        self.visible = (0, 0) # Range of pages last visible in the IconView.
+        self.bookdata = None  # What's in the *.book file, with the journaled changes.
+        self.revision = 0     # Revision of bookdata, counting up with each change journaled.
+        self.journal = None   # BookJournal of the changes not yet written to the *.book file.
+        self.journaltimer = None # Pending journal_changes, once the signals of an action are all in.
+        self.savetimer = None # Pending write of the *.book file, once the changes stop.
+        self.database = None  # BookDatabase of the pages, for books that keep them in SQLite.
+        self.pagenames = set() # Names of the pages, for checking new names are unique.
+        self.hidden = {}      # Pages of the collapsed chapters, by chapter name. They're only loaded once expanded.
 
     def make_book(self, dest, name, w, h, r, color, fill, top, bottom, sides, bleed):
         # Build the files and folders needed for the book.
@@ -1092,21 +3479,39 @@ class Book():
         pdb.gimp_vectors_stroke_new_from_points(vector, 0, 30, coords, True)
 
 
-    def load_book(self, bookfile, mainwin):
-        # Loads a selected book.
+    def read_book(self, bookfile):
+        # Set up the paths of a book, and return what's in its *.book file. Enough to export it without a window.
+        self.bookfile = bookfile
+        self.bookname = os.path.splitext(os.path.basename(self.bookfile))[0]
+        bookpath = os.path.dirname(self.bookfile)
+        self.pagepath = os.path.join(bookpath, "pages")
+        self.trashpath = os.path.join(bookpath, "trash")
+        self.thumbpath = os.path.join(bookpath, "thumbs")
+        self.thumbindex = ThumbIndex(self.thumbpath)
+        f = open(self.bookfile, "r")
+        metatext = f.read()
+        metadata = utf8(json.loads(metatext))
+        f.close()
+        if metadata.pop('store', None) == 'sqlite':
+            if not sqlite3:
+                raise RuntimeError(_("%s keeps its pages in an SQLite database, and this GIMP has no SQLite support.") % (self.bookfile))
+            self.database = BookDatabase(self.bookfile)
+            metadata['pages'] = self.database.pages()
+        self.journal = BookJournal(self.bookfile)
+        self.journal.replay(metadata) # Changes that didn't make it into the *.book file before a crash.
+        self.revision = metadata.pop('revision', 0)
+        self.bookdata = metadata
+        self.pagenames = set(metadata['pages'])
+        self.info = metadata.get('info', {})
+        self.readingdirection = metadata.get('readingdirection', 0)
+        return metadata
+
+    def load_book(self, bookfile, mainwin, database=None):
+        # Loads a selected book. With database True, its page list is moved into a BookDatabase, with False back
+        # into the *.book file, and with None it's left where it is.
         if os.path.exists(bookfile):
-            self.bookfile = bookfile
-            self.bookname = os.path.splitext(os.path.basename(self.bookfile))[0]
-            bookpath = os.path.dirname(self.bookfile)
-            self.pagepath = os.path.join(bookpath, "pages")
-            self.trashpath = os.path.join(bookpath, "trash")
-            self.thumbpath = os.path.join(bookpath, "thumbs")
+            metadata = self.read_book(bookfile)
             self.thumbsize = 256
-            # Load the pages.
-            f = open(self.bookfile, "r")
-            metatext = f.read()
-            metadata = json.loads(metatext)
-            f.close()
             if 'storyboardmode' in metadata:
                 if metadata['storyboardmode']:
                     self.main.storyboardm.set_active(1)
@@ -1130,27 +3535,333 @@ class Book():
                 self.thumbsize = metadata['thumbsize']
             progressstep = float(1.0 / len(metadata['pages']))
             progress = 0.0
-            for p in metadata['pages']:
+            placeholder = self.get_placeholder(metadata['pages'][0])
+            stale = []
+            chapters = metadata.get('chapters', [])
+            for c, chapter in enumerate(chapters):
+                if chapter['collapsed']:
+                    end = chapters[c + 1]['start'] if c + 1 < len(chapters) else len(metadata['pages'])
+                    self.hidden[chapter['name']] = metadata['pages'][chapter['start']:end]
+            c = 0
+            for i, p in enumerate(metadata['pages']):
+                while c < len(chapters) and chapters[c]['start'] <= i:
+                    self.pagestore.append(self.chapter_row(chapters[c]['name']))
+                    c += 1
+                if c and chapters[c - 1]['name'] in self.hidden:
+                    continue # Collapsed chapters show a single tile, their pages are only loaded once expanded.
                 mainwin.progress.show()
                 # TRANSLATORS: %s is the name of a page being loaded
                 mainwin.progress.set_text(_("Loading %s") % (p))
                 while gtk.events_pending():
                     gtk.main_iteration()
-                # Create a page object, and add to a list.
-                thumb = Thumb(os.path.join(self.pagepath, p), self.thumbsize, self.main)
-                self.pagestore.append((p, thumb.thumbpix, thumb.path))
+                # All pages start out as placeholders. Thumbs are decoded as they scroll into view,
+                # and stale ones are built in the background.
+                thumb = Thumb(os.path.join(self.pagepath, p), self.thumbsize, self.main, False, self.thumbindex)
+                if thumb.is_stale():
+                    stale.append(thumb)
+                self.pagestore.append(self.page_row(p, placeholder, thumb.path))
                 progress = progress + progressstep
                 if progress > 1.0:
                     progress = 1.0
                 mainwin.progress.set_fraction(progress)
                 while gtk.events_pending():
                     gtk.main_iteration()
+            for chapter in chapters[c:]:
+                self.pagestore.append(self.chapter_row(chapter['name'])) # Chapters without pages, at the end.
+            self.build_thumbs(stale)
             self.pagestore.connect("row-deleted", self.row_deleted)
             self.pagestore.connect("row-inserted", self.row_inserted)
             self.pagestore.connect("row-changed", self.row_changed)
-            mainwin.progress.hide()
+            if self.journal.lines:
+                self.flush() # Fold the changes recovered from the journal into the *.book file.
+            if database is not None:
+                self.use_database(database)
+            self.thumbindex.save()
+            if not self.building:
+                gobject.idle_add(self.pack_thumbs) # Up to date, but perhaps not packed yet.
+            self.watcher = PageWatcher(self.pagepath, self.page_names, self.pages_changed)
+            if not self.building:
+                mainwin.progress.hide()
             return True
 
+    def get_placeholder(self, page=None):
+        # A plain pixbuf shown for pages whose thumb isn't decoded, shared by all pages. Sized like the thumb of
+        # the first page (the template), which is read without decoding it.
+        if not self.thumbsize in self.placeholders:
+            width = height = self.thumbsize
+            if page is None:
+                page = self.template()
+            info = gtk.gdk.pixbuf_get_file_info(os.path.join(self.thumbpath, str(self.thumbsize), page+'.png'))
+            if info:
+                width, height = info[1], info[2]
+            placeholder = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, width, height)
+            placeholder.fill(0xd8d8d8ff)
+            self.placeholders[self.thumbsize] = placeholder
+        self.thumbwidth = self.placeholders[self.thumbsize].get_width()
+        return self.placeholders[self.thumbsize]
+
+    def chapter_tile(self):
+        # A plain, darker strip heading expanded chapters, as wide as the placeholder.
+        key = ('chapter', self.thumbsize)
+        if not key in self.placeholders:
+            placeholder = self.get_placeholder()
+            tile = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, placeholder.get_width(), max(1, placeholder.get_height() / 4))
+            tile.fill(0x808080ff)
+            self.placeholders[key] = tile
+        return self.placeholders[key]
+
+    def page_row(self, page, pix, thumbpath):
+        # A pagestore row showing a page.
+        return (page, pix, thumbpath, page, "")
+
+    def chapter_row(self, name):
+        # A pagestore row heading a chapter. A collapsed chapter is a single tile, with the thumb of its first page
+        # and the number of pages in it.
+        if name in self.hidden:
+            pages = self.hidden[name]
+            thumbpath = os.path.join(self.thumbpath, str(self.thumbsize), pages[0]+'.png') if pages else ""
+            # TRANSLATORS: %(chapter)s is the name of a collapsed chapter, %(pages)d the number of pages in it
+            label = _("%(chapter)s (%(pages)d pages)") % { 'chapter': name, 'pages': len(pages) }
+            return ("", self.get_placeholder(), thumbpath, label, name)
+        return ("", self.chapter_tile(), "", name, name)
+
+    def page_list(self):
+        # The names of all the pages in the book in order, those in collapsed chapters included.
+        pages = []
+        for p in self.pagestore:
+            if p[0]:
+                pages.append(p[0])
+            elif p[4] in self.hidden:
+                pages.extend(self.hidden[p[4]])
+        return pages
+
+    def template(self):
+        # The name of the template, the first page of the book. Chapter headings can be dragged ahead of it.
+        return self.page_list()[0]
+
+    def page_number(self, row):
+        # The number of the page at a pagestore row, the template being 0, and the pages of collapsed chapters
+        # counted. Chapter headings get the number of their first page.
+        number = 0
+        for i, p in enumerate(self.pagestore):
+            if i == row:
+                break
+            if p[0]:
+                number += 1
+            else:
+                number += len(self.hidden.get(p[4], []))
+        return number
+
+    def chapter_list(self):
+        # The chapters in order, each with its name, the index in page_list of its first page, and if it's collapsed.
+        chapters = []
+        count = 0
+        for p in self.pagestore:
+            if p[0]:
+                count += 1
+            elif p[4]:
+                chapters.append({ 'name': p[4], 'start': count, 'collapsed': p[4] in self.hidden })
+                count += len(self.hidden.get(p[4], []))
+        return chapters
+
+    def chapter_pages(self, names):
+        # The pages in the chapters of the given names, as last saved. Works without a window too.
+        pages = self.bookdata['pages']
+        chapters = self.bookdata.get('chapters', [])
+        selected = set()
+        for c, chapter in enumerate(chapters):
+            if chapter['name'] in names:
+                end = chapters[c + 1]['start'] if c + 1 < len(chapters) else len(pages)
+                selected.update(pages[chapter['start']:end])
+        return selected
+
+    def add_chapter(self, name, dest):
+        # Start a chapter at the row at dest. It runs up to the next chapter.
+        if name in self.hidden or name in [ p[4] for p in self.pagestore ]:
+            show_error_msg(_("Chapter names must be unique"))
+            return False
+        self.pagestore.insert(dest, self.chapter_row(name))
+        return True
+
+    def toggle_chapter(self, index):
+        # Collapse the chapter headed by the row at index into a single tile, or expand it again, loading its pages.
+        name = self.pagestore[index][4]
+        if name in self.hidden:
+            pages = self.hidden.pop(name)
+            placeholder = self.get_placeholder()
+            stale = []
+            for k, p in enumerate(pages):
+                thumb = Thumb(os.path.join(self.pagepath, p), self.thumbsize, self.main, False, self.thumbindex)
+                if thumb.is_stale():
+                    stale.append(thumb)
+                self.pagestore.insert(index + 1 + k, self.page_row(p, placeholder, thumb.path))
+            self.build_thumbs(stale)
+        else:
+            pages = []
+            while index + 1 < len(self.pagestore) and self.pagestore[index + 1][0]:
+                pages.append(self.pagestore[index + 1][0])
+                self.forget_pix(self.pagestore[index + 1][2])
+                self.pagestore.remove(self.pagestore.get_iter(index + 1))
+            self.hidden[name] = pages
+        self.pagestore[index] = self.chapter_row(name)
+        self.load_visible()
+
+    def remove_chapter(self, index):
+        # Drop the chapter heading at index. Its pages are kept, and join the chapter before it.
+        if self.pagestore[index][4] in self.hidden:
+            self.toggle_chapter(index)
+        self.pagestore.remove(self.pagestore.get_iter(index))
+
+    def load_visible(self, first=None, last=None):
+        # Decode the thumbs of the visible pages, and of as many pages on either side. Once over THUMBCACHE,
+        # the least recently seen thumbs outside of that range are dropped, and replaced with the placeholder.
+        if first is None:
+            first, last = self.visible
+        self.visible = (first, last)
+        margin = last - first + 1
+        lo = max(0, first - margin)
+        hi = min(len(self.pagestore) - 1, last + margin)
+        keep = set()
+        for i in range(lo, hi + 1):
+            row = self.pagestore[i]
+            if not row[2]:
+                continue # An expanded chapter, or an empty one.
+            keep.add(row[2])
+            if row[2] in self.pixcache:
+                self.pixcache[row[2]] = self.pixcache.pop(row[2])
+                continue
+            pix = self.thumb_pack().pixbuf(row[2])
+            try:
+                if not pix:
+                    pix = gtk.gdk.pixbuf_new_from_file(row[2])
+            except gobject.GError:
+                # Not built yet, or gone missing since it was indexed. Collapsed chapters wait for their first page's.
+                thumb = Thumb(os.path.join(self.pagepath, row[0]), self.thumbsize, self.main, False)
+                if row[0] and os.path.exists(thumb.imagepath):
+                    self.build_thumbs([ thumb ])
+                continue
+            self.pixcache[row[2]] = pix
+            self.pixbytes += pix.get_rowstride() * pix.get_height()
+            row[1] = pix
+        if self.pixbytes > THUMBCACHE:
+            rows = dict((p[2], i) for i, p in enumerate(self.pagestore))
+            placeholder = self.get_placeholder()
+            for path in list(self.pixcache):
+                if self.pixbytes <= THUMBCACHE:
+                    break
+                if not path in keep:
+                    self.forget_pix(path)
+                    if path in rows:
+                        self.pagestore[rows[path]][1] = placeholder
+
+    def thumb_pack(self):
+        # The ThumbPack of the current thumb size, mapped the first time it's needed.
+        if not self.thumbsize in self.thumbpacks:
+            self.thumbpacks[self.thumbsize] = ThumbPack(os.path.join(self.thumbpath, str(self.thumbsize)), self.thumbsize, self.thumbindex)
+        return self.thumbpacks[self.thumbsize]
+
+    def pack_thumbs(self):
+        # Bring the ThumbPack of the current size up to date, once there are no thumbs left to build.
+        if self.thumbindex and not self.building:
+            self.thumb_pack().update(self.page_list())
+        return False
+
+    def forget_pix(self, path):
+        # Drop a decoded thumb from the pixcache.
+        pix = self.pixcache.pop(path, None)
+        if pix:
+            self.pixbytes -= pix.get_rowstride() * pix.get_height()
+
+    def remember_pix(self, path, pix):
+        # Add a decoded thumb shown in the pagestore to the pixcache.
+        self.forget_pix(path)
+        self.pixcache[path] = pix
+        self.pixbytes += pix.get_rowstride() * pix.get_height()
+
+    def build_thumbs(self, thumbs):
+        # Queue thumbs for building in the thumbpool, skipping those already on their way.
+        jobs = []
+        for thumb in thumbs:
+            if not thumb.path in self.building:
+                self.building.add(thumb.path)
+                job = thumb.job()
+                job['profile'] = self.thumbprofile is not None
+                jobs.append(job)
+        if jobs:
+            self.buildtotal += len(jobs)
+            self.thumbpool.add(jobs)
+            self.thumb_progress()
+
+    def thumb_finished(self, job, ok, message):
+        # The thumbpool is done with a thumb, swap it in for the placeholder.
+        self.building.discard(job['thumb'])
+        if ok:
+            self.thumbindex.update(job['image'], job['result'])
+            if self.thumbprofile and 'stages' in job['result']:
+                self.thumbprofile.add(os.path.basename(job['image']), job['result']['stages'])
+            # Only decode it if the page is in view, or has been seen recently.
+            for i, row in enumerate(self.pagestore):
+                if row[2] == job['thumb'] and (row[2] in self.pixcache or self.visible[0] <= i <= self.visible[1]):
+                    thumb = Thumb(job['image'], job['size'], self.main, False)
+                    if thumb.load_thumb():
+                        row[1] = thumb.thumbpix
+                        self.remember_pix(thumb.path, thumb.thumbpix)
+        else:
+            show_error_msg(message)
+        self.thumb_progress()
+
+    def thumb_progress(self):
+        # Show how far the thumbpool has come.
+        left = len(self.building)
+        if left:
+            self.main.progress.show()
+            # TRANSLATORS: %d is the number of thumbnails still being generated
+            self.main.progress.set_text(_("Generating thumbnails, %d left") % (left))
+            self.main.progress.set_fraction(1.0 - float(left) / self.buildtotal)
+        else:
+            self.buildtotal = 0
+            self.thumbindex.save()
+            self.pack_thumbs()
+            self.main.progress.hide()
+            self.main.progress.set_text("")
+            self.main.progress.set_fraction(0.0)
+
+    def page_names(self):
+        # The names of the pages in the book, those in collapsed chapters left out until they're expanded.
+        return [ p[0] for p in self.pagestore if p[0] ]
+
+    def pages_changed(self, names):
+        # The watcher saw pages being written to, rebuild their thumbs if they are stale.
+        if names is None:
+            self.update_thumbs()
+            return
+        stale = []
+        for p in self.pagestore:
+            if p[0] in names:
+                thumb = Thumb(os.path.join(self.pagepath, p[0]), self.thumbsize, self.main, False, self.thumbindex)
+                if thumb.is_stale():
+                    stale.append(thumb)
+        self.build_thumbs(stale)
+
+    def close(self):
+        # Stop any background work on the book.
+        if self.watcher:
+            self.watcher.stop()
+        self.thumbpool.stop()
+        self.building.clear()
+        self.importpool.stop()
+        self.importing = None
+        self.flush()
+        if self.database:
+            self.database.close()
+            self.database = None
+        if self.thumbindex:
+            self.thumbindex.save()
+            self.pack_thumbs()
+        for pack in self.thumbpacks.values():
+            pack.close()
+        self.thumbpacks = {}
+
     def row_deleted(self, pagestore, destination_index):
         self.save()
 
@@ -1163,35 +3874,102 @@ class Book():
     def open_page(self, iconview, number):
         # Open the page the user clicked in GIMP.
         number = number[0]
+        if not self.pagestore[number][0]:
+            self.toggle_chapter(number) # Chapters open and close instead.
+            return
         pagetoopen = os.path.join(self.pagepath, self.pagestore[number][0])
         img = pdb.gimp_file_load(pagetoopen, pagetoopen)
         img.clean_all()
         gimp.Display(img)
 
     def save(self):
-        # Dump the pagestore to the *.book file, saving the book.
-        metadata = []
-        for p in self.pagestore:
-            if p[0]:
-                metadata.append(p[0])
-        savetofile = json.dumps({ 'storyboardmode': self.main.storyboardmode, 'readingdirection': self.main.readingdirection, 'thumbsize': self.thumbsize, 'pages': metadata }, indent=4)
-        bookfile = open(self.bookfile, "w")
-        bookfile.write(savetofile)
+        # Note that the book changed. The signals fired by one action, such as dragging a page, are journaled
+        # together once they're all in, and the *.book file is rewritten once the changes stop.
+        if not self.journaltimer:
+            self.journaltimer = gobject.idle_add(self.journal_changes)
+
+    def journal_changes(self):
+        # Log what changed since the last revision to the journal, and put off rewriting the *.book file.
+        self.journaltimer = None
+        metadata = self.page_list()
+        book = { 'storyboardmode': self.main.storyboardmode, 'readingdirection': self.main.readingdirection, 'thumbsize': self.thumbsize, 'pages': metadata }
+        if self.info:
+            book['info'] = self.info
+        chapters = self.chapter_list()
+        if chapters or 'chapters' in self.bookdata:
+            book['chapters'] = chapters
+        ops = book_changes(self.bookdata, book)
+        self.bookdata = book
+        self.pagenames = set(metadata)
+        if self.database:
+            ops = self.database.apply(ops) # Page changes go straight to their rows.
+        if not ops:
+            return False # Only a thumb was swapped in the pagestore, or the changes are in the database already.
+        self.revision += 1
+        self.journal.append(self.revision, ops)
+        if self.savetimer:
+            gobject.source_remove(self.savetimer)
+        self.savetimer = gobject.timeout_add(BOOKSAVEDELAY, self.flush)
+        return False
+
+    def flush(self):
+        # Write the book with all its changes to the *.book file now, through a temp file so a crash never leaves
+        # it half written, and start a new journal.
+        if self.journaltimer:
+            gobject.source_remove(self.journaltimer)
+            self.journal_changes()
+        if self.savetimer:
+            gobject.source_remove(self.savetimer)
+            self.savetimer = None
+        if self.journal and self.journal.lines:
+            self.write_book()
+        return False
+
+    def write_book(self):
+        # Write the *.book file through a temp file, so a crash never leaves it half written, and start a new journal.
+        book = dict(self.bookdata)
+        book['revision'] = self.revision
+        if self.database:
+            del book['pages']
+            book['store'] = 'sqlite'
+        partpath = self.bookfile + '.part'
+        bookfile = open(partpath, "w")
+        bookfile.write(json.dumps(book, indent=4))
+        bookfile.flush()
+        os.fsync(bookfile.fileno())
         bookfile.close()
+        replace_file(partpath, self.bookfile)
+        self.journal.clear()
+
+    def use_database(self, use):
+        # Move the page list from the *.book file to a BookDatabase next to it, or back. The new copy is written
+        # before the book points to it, and the old one is dropped after.
+        self.flush()
+        if use and not self.database:
+            self.database = BookDatabase(self.bookfile)
+            self.database.replace(self.bookdata['pages'])
+            self.write_book()
+        elif not use and self.database:
+            database = self.database
+            self.database = None
+            self.write_book()
+            database.remove()
+
+    def has_page(self, name):
+        # True if the book has a page of that name.
+        return name in self.pagenames
 
     def add_page(self, p, dest):
         # Copy the template to a new page.
         try:
             p = p+'.xcf'
-            unique = True
-            for a in self.pagestore:
-                if a[0] == p:
-                    unique = False
-            if unique:
-                template = os.path.join(self.pagepath, self.pagestore[0][0])
+            if not self.has_page(p):
+                template = os.path.join(self.pagepath, self.template())
                 shutil.copy(template, os.path.join(self.pagepath, p))
-                thumb = Thumb(os.path.join(self.pagepath, p), self.thumbsize, self.main)
-                self.pagestore.insert(dest, ( p, thumb.thumbpix, thumb.path))
+                thumb = Thumb(os.path.join(self.pagepath, p), self.thumbsize, self.main, True, self.thumbindex)
+                self.pagestore.insert(dest, self.page_row(p, thumb.thumbpix, thumb.path))
+                self.pagenames.add(p)
+                self.remember_pix(thumb.path, thumb.thumbpix)
                 return True
             else:
                 show_error_msg(_("Page names must be unique"))
@@ -1199,28 +3977,79 @@ class Book():
             show_error_msg(err)
 
     def import_page(self, plist, dest):
-        # Import a page from an external source.
+        # Import pages from external sources. They're loaded, saved as .xcf and thumbnailed by the importpool,
+        # and added at dest together once they're all done.
         # TODO! Add support for format specific import settings, such as svg and pdf resolution.
-        plist.sort(reverse=True)
+        if self.importing:
+            show_error_msg(_("Pages are still being imported."))
+            return False
+        plist.sort()
+        names = set()
+        jobs = []
         for p in plist:
             name,ext = os.path.splitext(os.path.basename(p))
             name = name+'.xcf'
-            unique = True
-            for a in  self.pagestore:
-                if a[0] == name:
-                    unique = False
-            if unique:
-                img = pdb.gimp_file_load(p, p)
-                pdb.gimp_xcf_save(0, img, None, os.path.join(self.pagepath, name) , name)
-                thumb = Thumb(os.path.join(self.pagepath, p), self.thumbsize, self.main)
-                self.pagestore.insert(dest, (name, thumb.thumbpix, thumb.path))
+            if not self.has_page(name) and not name in names:
+                names.add(name)
+                thumb = Thumb(os.path.join(self.pagepath, name), self.thumbsize, self.main, False)
+                job = thumb.job()
+                job.update({ 'task': 'import', 'source': p, 'profile': self.thumbprofile is not None })
+                jobs.append(job)
             else:
                 show_error_msg(_("Page name is not unique."))
+        if jobs:
+            self.importing = { 'dest': dest, 'jobs': jobs, 'left': len(jobs) }
+            self.importpool.add(jobs)
+            self.import_progress()
+        return True
+
+    def import_finished(self, job, ok, message):
+        # The importpool is done with a page. Once all of them are, the pages imported are added in one go,
+        # so the book is only saved once.
+        if ok:
+            job['imported'] = True
+            self.thumbindex.update(job['image'], job['result'])
+            if self.thumbprofile and 'stages' in job['result']:
+                self.thumbprofile.add(os.path.basename(job['image']), job['result']['stages'])
+        else:
+            show_error_msg(message)
+        self.importing['left'] -= 1
+        if not self.importing['left']:
+            dest = min(self.importing['dest'], len(self.pagestore))
+            placeholder = self.get_placeholder()
+            for job in [ j for j in self.importing['jobs'] if j.get('imported') ]:
+                name = os.path.basename(job['image'])
+                self.pagestore.insert(dest, self.page_row(name, placeholder, job['thumb']))
+                self.pagenames.add(name)
+                dest += 1
+            self.importing = None
+            self.thumbindex.save()
+            self.pack_thumbs()
+            self.load_visible()
+            self.main.update_title()
+        self.import_progress()
+
+    def import_progress(self):
+        # Show how far the importpool has come.
+        if self.importing:
+            left = self.importing['left']
+            total = len(self.importing['jobs'])
+            self.main.progress.show()
+            # TRANSLATORS: %(left)d is the number of pages still being imported, out of %(total)d
+            self.main.progress.set_text(_("Importing pages, %(left)d of %(total)d left") % { 'left': left, 'total': total })
+            self.main.progress.set_fraction(1.0 - float(left) / total)
+        elif not self.building:
+            self.main.progress.hide()
+            self.main.progress.set_text("")
+            self.main.progress.set_fraction(0.0)
 
 
     def open_page(self, iconview, number):
         # Open the page the user clicked in GIMP.
         number = number[0]
+        if not self.pagestore[number][0]:
+            self.toggle_chapter(number) # Chapters open and close instead.
+            return
         pagetoopen = os.path.join(self.pagepath, self.pagestore[number][0])
         img = pdb.gimp_file_load(pagetoopen, pagetoopen)
         img.clean_all()
@@ -1228,18 +4057,18 @@ class Book():
 
     def dupli_page(self, p, dest):
         # Copy the template to a new page.
+        if not self.pagestore[dest][0]:
+            show_error_msg(_("Only pages can be duplicated, not chapters."))
+            return False
         try:
             p = p+'.xcf'
-            unique = True
-            for a in self.pagestore:
-                if a[0] == p:
-                    unique = False
-            if unique:
-                template = os.path.join(self.pagepath, self.pagestore[0][0])
+            if not self.has_page(p):
                 src = os.path.join(self.pagepath, self.pagestore[dest][0])
                 shutil.copy(src, os.path.join(self.pagepath, p))
-                thumb = Thumb(os.path.join(self.pagepath, p), self.thumbsize, self.main)
-                self.pagestore.insert(dest, ( p, thumb.thumbpix, thumb.path))
+                thumb = Thumb(os.path.join(self.pagepath, p), self.thumbsize, self.main, True, self.thumbindex)
+                self.pagestore.insert(dest, self.page_row(p, thumb.thumbpix, thumb.path))
+                self.pagenames.add(p)
+                self.remember_pix(thumb.path, thumb.thumbpix)
                 return True
             else:
                 show_error_msg(_("Page names must be unique"))
@@ -1247,32 +4076,44 @@ class Book():
             show_error_msg(err)
 
     def rename_page(self, p):
-        # Rename a page.
+        # Rename a page, or the chapter selected.
+        chapter = self.pagestore[self.selected][4]
+        if chapter:
+            if p != chapter and (p in self.hidden or p in [ row[4] for row in self.pagestore ]):
+                show_error_msg(_("Chapter names must be unique"))
+                return False
+            if chapter in self.hidden:
+                self.hidden[p] = self.hidden.pop(chapter)
+            self.pagestore[self.selected] = self.chapter_row(p)
+            return True
         p = p+".xcf"
-        unique = True
-        for a in self.pagestore:
-            if a[0] == p:
-                unique = False
-            if unique:
-                try:
-                    oldthumb = self.pagestore[self.selected][0]
-                    shutil.move(os.path.join(self.pagepath, self.pagestore[self.selected][0]), os.path.join(self.pagepath, p))
-                    thumb = Thumb(os.path.join(self.pagepath,p), self.thumbsize, self.main)
-                    self.pagestore[self.selected] = ((p, thumb.thumbpix, thumb.path))
-                    self.delete_thumb(oldthumb)
-                    return True
-                except Exception, err:
-                    show_error_msg(err)
-            else:
-                show_error_msg(_("Page names must be unique"))
+        if not self.has_page(p):
+            try:
+                oldthumb = self.pagestore[self.selected][0]
+                shutil.move(os.path.join(self.pagepath, self.pagestore[self.selected][0]), os.path.join(self.pagepath, p))
+                thumb = Thumb(os.path.join(self.pagepath,p), self.thumbsize, self.main, True, self.thumbindex)
+                self.pagestore[self.selected] = self.page_row(p, thumb.thumbpix, thumb.path)
+                self.pagenames.discard(oldthumb)
+                self.pagenames.add(p)
+                self.remember_pix(thumb.path, thumb.thumbpix)
+                self.delete_thumb(oldthumb)
+                return True
+            except Exception, err:
+                show_error_msg(err)
+        else:
+            show_error_msg(_("Page names must be unique"))
             
     def delete_page(self):
-        # Delete the selected page.
+        # Delete the selected page. Deleting a chapter keeps its pages.
+        if self.pagestore[self.selected][4]:
+            self.remove_chapter(self.selected)
+            return True
         try:
             p = self.pagestore[self.selected][0]
             shutil.move(os.path.join(self.pagepath, p), os.path.join(self.trashpath,strftime("%Y%m%d_%H%M%S_")+p))
             piter = self.pagestore.get_iter_from_string(str(self.selected))
             self.pagestore.remove(piter)
+            self.pagenames.discard(p)
             self.delete_thumb(p)
             return True
         except Exception, err:
@@ -1280,14 +4121,17 @@ class Book():
 
     def delete_thumb(self, pagename):
         # Delete all sizes of a thumbnail by name
-        for i in [ 32, 64, 128, 256, 512, 1024 ]:
+        for i in THUMBSIZES:
             oldthumb = os.path.join(self.thumbpath, str(i), pagename+".png")
+            self.forget_pix(oldthumb)
             if os.path.isfile(oldthumb):
                 os.remove(oldthumb)
+        self.thumbindex.remove(pagename)
+        self.thumbindex.save()
 
     def get_template_size(self):
         # Return the size of the template in pixels x,y
-        template = os.path.join(self.pagepath, self.pagestore[0][0])
+        template = os.path.join(self.pagepath, self.template())
         img = pdb.gimp_file_load(template, template)
         return img.width, img.height
 
@@ -1313,14 +4157,61 @@ class Book():
             show_error_msg(_("Format index out of range"))
 
 
-    def export_book(self, expwin):
-        # Export the entire book.
-        outfolder = os.path.join(expwin.destbutton.get_filename(), self.bookname)
-        namei = expwin.namem.get_active() # Index of type of name to use, book, page, number or custom.
-        if not os.path.isdir(outfolder):
-            os.makedirs(outfolder)
+    def export_book(self, settings, progress=None, pages=None):
+        # Export the book with ExportSettings, waiting for it to finish. See ExportJob for progress. Returns a list of errors.
+        job = ExportJob(self, settings, pages, progress)
+        job.start()
+        # Runs the main loop by hand, so this also works without a GTK main loop, in batch mode.
+        context = gobject.main_context_default()
+        while job.running():
+            context.iteration(True)
+        return job.errors
+
+    def comic_info(self):
+        # Metadata for CBZ and PDF exports. A Title in the *.book file's info overrides the book name.
+        if self.main:
+            righttoleft = self.main.readingdirection
+        else:
+            righttoleft = self.readingdirection
+        return { 'title': self.info.get('Title', self.bookname), 'righttoleft': bool(righttoleft), 'info': self.info }
+
+    def export_folder(self, settings):
+        # The folder to export to, named after the book, with a subfolder for editions.
+        return os.path.join(settings['dest'], self.bookname, settings['subfolder'])
+
+    def tag_index(self):
+        # Map each layer tag in the book to the number of pages using it, template left out. Tags come from the thumb
+        # index, only pages that have changed since their thumbs were built are read, and only their XCF headers at that.
+        counts = {}
+        for i, p in enumerate(self.page_list()):
+            if i == 0:
+                continue
+            imagepath = os.path.join(self.pagepath, p)
+            tags = self.thumbindex.tags(imagepath)
+            if tags is None:
+                try:
+                    xcf = XcfReader(imagepath)
+                except (XcfError, IOError, OSError):
+                    continue
+                tags = layer_tags(xcf_layers(xcf))
+                xcf.close()
+                self.thumbindex.set_tags(imagepath, tags)
+            for tag in tags:
+                counts[tag] = counts.get(tag, 0) + 1
+        self.thumbindex.save()
+        return counts
+
+    def export_files(self, settings, pages=None):
+        # The file to export for each page in the export range, named and numbered by its place in the book.
+        # Pages default to all those in the book, template first. With chapters set, only their pages are exported.
+        if pages is None:
+            pages = self.page_list()
+        outfolder = self.export_folder(settings)
+        last = settings['to']
+        if last is None:
+            last = len(pages) - 1
         # Page number padding needed.
-        pagecount = len(self.pagestore)
+        pagecount = len(pages)
         padding = 1
         if pagecount > 999:  # Damn...you've made a 1000+ page long comic book....nice work.
             padding = 4
@@ -1328,181 +4219,108 @@ class Book():
             padding = 3
         elif pagecount > 9:
             padding = 2
-        progress = 0.0
-        progressstep = float(1.0 / (expwin.rangeto.get_value() - expwin.rangefrom.get_value() + 1))
-        # Find file extension.
-        ext = self.format_index_to_extension(expwin.formatm.get_active())
-        # Loop through pages
-        for i,p in enumerate(self.pagestore):
-            if i >= expwin.rangefrom.get_value() and i <= expwin.rangeto.get_value():
-                # Figure out the page name.
-                original = os.path.join(self.pagepath, p[0])
-                # TRANSLATORS: %s is the name of the page being exported
-                expwin.progress.set_text(_("Exporting %s") % (p[0]))
-                while gtk.events_pending():
-                    gtk.main_iteration()
+        ext = settings['format']
+        tags = tag_filter(settings)
+        if settings['chapters']:
+            inchapters = self.chapter_pages(settings['chapters'])
+        files = []
+        for i,p in enumerate(pages):
+            if i >= settings['from'] and i <= last and (not settings['chapters'] or p in inchapters):
                 pagenr = str(i).zfill(padding)
                 name=""
-                if namei == 0: # Book Name
+                if settings['name'] == 0: # Book Name
                     name = pagenr+"_"+self.bookname+"."+ext
-                elif namei == 1: # Page Names
-                    name = pagenr+"_"+os.path.splitext(p[0])[0]+"."+ext
-                elif namei == 2: # Page Number
+                elif settings['name'] == 1: # Page Names
+                    name = pagenr+"_"+os.path.splitext(p)[0]+"."+ext
+                elif settings['name'] == 2: # Page Number
                     name = pagenr+"."+ext
-                elif namei == 3: # Custom Name
-                    name = pagenr+"_"+expwin.namee.get_text()+"."+ext
-                fullname = os.path.join(outfolder, name)
-                img = pdb.gimp_file_load(original, original)
-                # Show and hide tagged layers.
-                hidetags = expwin.taghide.get_text().split(',')
-                showtags = expwin.tagshow.get_text().split(',')
-                regex = re.compile("\[(.*?)\]")
-                for i in range(pdb.gimp_image_get_layers(img)[0]):
-                    # Show and hide layers. Hide wins over show, if layer has two matching tags.
-                    layername = pdb.gimp_layer_get_name(img.layers[i])
-                    layertags = regex.findall(layername)
-                    if set(hidetags) & set(layertags):
-                        pdb.gimp_layer_set_visible(img.layers[i],False)
-                    elif set(showtags) & set(layertags):
-                        pdb.gimp_layer_set_visible(img.layers[i], True)
-                    elif expwin.tagunm.get_active() == 1: # Show all by default.
-                        pdb.gimp_layer_set_visible(img.layers[i], True)
-                    elif expwin.tagunm.get_active() == 2: # Hide all by default.
-                        pdb.gimp_layer_set_visible(img.layers[i], False)
-                # Process image.
-                if ext == "xcf" and not expwin.xcfflatten.get_active():
-                    pass
-                elif ext == "ora" and not expwin.oraflatten.get_active():
-                    pass
-                elif ext == "psd" and not expwin.psdflatten.get_active():
-                    pass
+                elif settings['name'] == 3: # Custom Name
+                    name = pagenr+"_"+settings['customname']+"."+ext
+                f = { 'page': p,
+                      'number': i,
+                      'image': os.path.join(self.pagepath, p),
+                      'file': os.path.join(outfolder, name),
+                      'settings': settings.options,
+                      'tagged': True }
+                if tags.active() and not tags.untagged and self.thumbindex:
+                    # No need to look at the layers, if the tag index knows none of them match.
+                    pagetags = self.thumbindex.tags(f['image'])
+                    if pagetags is not None and not set(pagetags) & (tags.hide | tags.show):
+                        f['tagged'] = False
+                files.append(f)
+        return files
+
+    def export_sheets(self, settings, pages=None):
+        # The files of export_files, grouped onto sheets when the settings have an imposition. Spreads pair each
+        # left hand page with the right hand page after it, and sheets are filled with pages in reading order.
+        # Sheets are named after their first and last page, with the image of each of their pages, and a sheet
+        # dict of the columns and rows, and the pages with their column, row and side.
+        files = self.export_files(settings, pages)
+        if not settings['imposition']:
+            return files
+        righttoleft = self.comic_info()['righttoleft']
+        if settings['imposition'] == 1:
+            groups = []
+            for f in files:
+                if groups and f['number'] % 2 == 1 and groups[-1][-1]['number'] == f['number'] - 1:
+                    groups[-1].append(f)
                 else:
-                    img.flatten()
-                drw = pdb.gimp_image_get_active_layer(img)
-                # Add/Remove margins.
-                top = expwin.margtop.get_value()
-                bottom = expwin.margbot.get_value()
-                inner = expwin.marginner.get_value()
-                outer = expwin.margouter.get_value()
-                w = inner + outer + img.width
-                h = top + bottom + img.height
-                x = 0
-                y = top
-                if i%2 == 0: # Left hand page.
-                    x = outer
-                else: # Right hand page.
-                    x = inner
-                if not top == 0 or not bottom == 0 or not inner == 0 or not outer == 0:
-                    if expwin.margcolm.get_active() == 1: # Black
-                        pdb.gimp_context_set_background((0,0,0))
-                    elif expwin.margcolm.get_active() == 2: # White
-                        pdb.gimp_context_set_background((255,255,255))
-                    elif expwin.margcolm.get_active() == 3: # Custom color
-                        color = expwin.margcol.get_color()
-                        pdb.gimp_context_set_background((color.red/257, color.green/257, color.blue/257))
-                    pdb.gimp_image_resize(img, w, h, x, y)
-                    pdb.gimp_layer_resize_to_image_size(drw)
-                # Scale the image.
-                nw = 0 
-                nh = 0
-                if expwin.scaletype.get_active(): # Pixel
-                    nw = int(expwin.scalew.get_value())
-                    nh = int(expwin.scaleh.get_value())
-                else: # Percent
-                    nw = int((expwin.scalew.get_value() / 100) * img.width)
-                    nh = int((expwin.scaleh.get_value() / 100) * img.height)
-                if not nw == img.width or not nh == img.height:
-                    pdb.gimp_image_scale_full(img, nw, nh, expwin.interp.get_active())
-                # Save the image.
-                if ext == "gif":
-                    # Convert to grayscale
-                    if expwin.gifgrayscale.get_active():
-                        pdb.gimp_image_convert_grayscale(img)
-                    else:
-                        # TODO! Maybe support custom palettes and other GIF options...but not for now.
-                        pdb.gimp_image_convert_indexed(img,
-                                                       expwin.gifdith.get_active(),
-                                                       0,
-                                                       expwin.gifcolors.get_value(),
-                                                       False,
-                                                       False,
-                                                       "")
-                        pdb.file_gif_save(img, drw, fullname, name,
-                                          expwin.gifinterlace.get_active(),
-                                          0,0,0)
-                elif ext == "xcf":
-                    pdb.gimp_file_save(img, drw, fullname, name)
-                elif ext == "jpg":
-                    quality = float(expwin.jpgquality.get_value() / 100)
-                    restartfreq = 0
-                    if expwin.jpgrestart.get_active():
-                        restartfreq = expwin.jpgfreq.get_value()
-                    pdb.file_jpeg_save(img, drw, fullname, name, quality,
-                                       expwin.jpgsmoothing.get_value(),
-                                       expwin.jpgoptimize.get_active(),
-                                       expwin.jpgprogressive.get_active(),
-                                       expwin.jpgcomment.get_text(),
-                                       expwin.jpgsub.get_active(),
-                                       0,
-                                       restartfreq,
-                                       expwin.jpgdct.get_active())
-                elif ext == "ora":
-                    pdb.file_openraster_save(img, drw, fullname, name)
-                elif ext == "psd":
-                    compress = 0
-                    if expwin.psdlzw.get_active():
-                        compress = 1
-                    elif expwin.psdpackbits.get_active():
-                        compress = 2
-                    pdb.file_psd_save(img, drw, fullname, name, compress, 0)
-                elif ext == "png":
-                    pdb.file_png_save2(img, drw, fullname, name,
-                                       expwin.pnginterlacing.get_active(),
-                                       expwin.pngcompress.get_value(),
-                                       expwin.pngbgcolor.get_active(),
-                                       expwin.pnggamma.get_active(),
-                                       expwin.pnglayeroffset.get_active(),
-                                       expwin.pngresolution.get_active(),
-                                       expwin.pngcreationtime.get_active(),
-                                       1,
-                                       expwin.pngcoloroftransp.get_active())
-                elif ext == "tif":
-                    compress = 0
-                    if expwin.tiflzw.get_active():
-                        compress = 1
-                    elif expwin.tifpackbits.get_active():
-                        compress = 2
-                    elif expwin.tifdeflate.get_active():
-                        compress = 3
-                    elif expwin.tifjpeg.get_active():
-                        compress = 4
-                    pdb.file_tiff_save2(img, drw, fullname, name, compress, expwin.tifcoloroftransp.get_active())
-                elif ext == "bmp":
-                    pdb.file_bmp_save(img, drw, fullname, name)
-                pdb.gimp_image_delete(img)
-                progress = progress + progressstep
-                expwin.progress.set_fraction(progress)
-                while gtk.events_pending():
-                    gtk.main_iteration()
-
-
-    def update_thumbs(self):
-        # Update all thumbnails that have changed.
-        progress = 0.0
-        self.main.progress.set_fraction(progress)
-        self.main.progress.set_text("")
-        pagecount = len(self.pagestore)
+                    groups.append([ f ])
+        else:
+            count = settings['nupcolumns'] * settings['nuprows']
+            groups = [ files[g:g+count] for g in range(0, len(files), count) ]
+        sheets = []
+        for group in groups:
+            if settings['imposition'] == 1:
+                columns = len(group)
+                rows = 1
+            else:
+                columns = settings['nupcolumns']
+                rows = settings['nuprows']
+            placed = []
+            for k, f in enumerate(group):
+                column = k % columns
+                if righttoleft:
+                    column = columns - 1 - column
+                placed.append({ 'page': f['page'], 'number': f['number'], 'image': f['image'], 'column': column, 'row': k / columns,
+                                'right': (f['number'] % 2 == 1) != righttoleft }) # The inner margin faces the spine.
+            name = os.path.basename(group[0]['file'])
+            if len(group) > 1:
+                first = re.match(r'\d+', name).group(0)
+                last = re.match(r'\d+', os.path.basename(group[-1]['file'])).group(0)
+                name = first + "-" + last + name[len(first):]
+            sheets.append({ 'page': " ".join([ f['page'] for f in group ]),
+                            'number': group[0]['number'],
+                            'image': [ f['image'] for f in group ],
+                            'file': os.path.join(os.path.dirname(group[0]['file']), name),
+                            'settings': settings.options,
+                            'tagged': [ f['tagged'] for f in group ],
+                            'sheet': { 'columns': columns, 'rows': rows, 'pages': placed } })
+        return sheets
+
+    def update_thumbs(self, check=True):
+        # Update all thumbnails that have changed, stale ones are rebuilt in the background.
+        # Without check, only the index is used, which is enough when zooming.
+        stale = []
+        placeholder = None
         for i,p in enumerate(self.pagestore):
             if p[0]:
-                self.main.progress.set_text("Generating thumbnail for %s" % p[0])
-                thumb = Thumb(os.path.join(self.pagepath,p[0]), self.thumbsize, self.main)
-                self.thumbwidth = thumb.thumbpix.get_width()
-                self.pagestore[i] = ((p[0], thumb.thumbpix, thumb.path))
-            progress = float(i) / pagecount
-            self.main.progress.set_fraction(progress)
-        self.main.progress.hide()
-        self.main.progress.set_text("")
-        self.main.progress.set_fraction(0.0)
+                thumb = Thumb(os.path.join(self.pagepath,p[0]), self.thumbsize, self.main, False, self.thumbindex)
+                if thumb.is_stale(check):
+                    stale.append(thumb)
+                if p[2] != thumb.path:
+                    # Zoomed, so show placeholders until the visible thumbs of the new size are decoded.
+                    if not placeholder:
+                        placeholder = self.get_placeholder(p[0])
+                    self.forget_pix(p[2])
+                    self.pagestore[i] = self.page_row(p[0], placeholder, thumb.path)
+            elif p[4] in self.hidden:
+                self.pagestore[i] = self.chapter_row(p[4]) # The tile's thumb, in the new size.
+        self.build_thumbs(stale)
+        self.load_visible()
+        self.thumbindex.save()
+        if not self.building:
+            gobject.idle_add(self.pack_thumbs)
 
 
 class Main(gtk.Window):
@@ -1513,10 +4331,10 @@ class Main(gtk.Window):
         self.set_default_size(570, 400)
         self.set_position(gtk.WIN_POS_CENTER)
         self.loaded = False  # If there is a book loaded in the interface.
-        self.connect('notify::is-active', self.update_thumbs)
         self.set_icon_name('gimp')
         self.storyboardmode = 0
         self.readingdirection = 0 # LTR
+        self.exportwin = None # The ExportWin, while open.
 
         # Main menu
         mb = gtk.MenuBar()
@@ -1610,6 +4428,21 @@ class Main(gtk.Window):
         self.zoominm.connect("activate", self.zoomin)
         self.viewmenu.append(self.zoominm)
 
+        self.refreshm = gtk.ImageMenuItem(gtk.STOCK_REFRESH, agr)
+        self.refreshm.set_label(_("Refresh Thumbnails"))
+        key, mod = gtk.accelerator_parse("F5")
+        self.refreshm.add_accelerator("activate", agr, key, mod, gtk.ACCEL_VISIBLE)
+        self.refreshm.set_sensitive(False)
+        self.refreshm.connect("activate", self.update_thumbs)
+        self.viewmenu.append(self.refreshm)
+
+        self.thumbtimingm = gtk.CheckMenuItem()
+        self.thumbtimingm.set_label(_("Time Thumbnail Stages"))
+        self.thumbtimingm.set_active(False)
+        self.thumbtimingm.set_sensitive(False)
+        self.thumbtimingm.connect("activate", self.toggle_thumb_timing)
+        self.viewmenu.append(self.thumbtimingm)
+
         # Pages Menu
         self.pagemenu = gtk.Menu()
         i_page = gtk.MenuItem(_("Pages"))
@@ -1660,6 +4493,13 @@ class Main(gtk.Window):
         self.pagemenu.append(self.renamepage)
         self.renamepage.show()
 
+        self.addchapter = gtk.MenuItem()
+        self.addchapter.set_sensitive(False)
+        self.addchapter.set_label(_("Add Chapter"))
+        self.addchapter.connect("activate", self.ask_add_chapter)
+        self.pagemenu.append(self.addchapter)
+        self.addchapter.show()
+
         self.deletepage = gtk.MenuItem()
         self.deletepage.set_sensitive(False)
         self.deletepage.set_label(_("Delete"))
@@ -1750,7 +4590,7 @@ class Main(gtk.Window):
         self.vbox.pack_start(self.toolbar, False, False, 0)
 
         self.thumbs = gtk.IconView()
-        self.thumbs.set_text_column(0)
+        self.thumbs.set_text_column(3)
         self.thumbs.set_pixbuf_column(1)
         self.thumbs.set_reorderable(True)
         self.thumbs.set_columns(2)
@@ -1758,6 +4598,9 @@ class Main(gtk.Window):
         self.scroll.set_shadow_type(gtk.SHADOW_ETCHED_IN)
         self.scroll.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
         self.scroll.add(self.thumbs)
+        self.scroll.get_vadjustment().connect("value-changed", self.thumbs_scrolled)
+        self.scroll.get_vadjustment().connect("changed", self.thumbs_scrolled)
+        self.scrollidle = None
         self.vbox.pack_start(self.scroll, True, True, 0)
 
         self.progress = gtk.ProgressBar()
@@ -1794,11 +4637,37 @@ class Main(gtk.Window):
         else:
             self.toolbar.hide()
 
-    def update_thumbs(self, widget, arg):
-        # Tell Book to update the thumbnails on window receiving focus.
-        if self.is_active() and self.loaded:
+    def update_thumbs(self, widget):
+        # Tell Book to check all thumbnails. Changes are normally picked up by the page watcher, but not
+        # changes made from other machines to books on network folders.
+        if self.loaded:
             self.book.update_thumbs()
 
+    def toggle_thumb_timing(self, widget):
+        # Start timing each stage of building thumbnails, or stop and offer to save the timings as a CSV or JSON file.
+        if widget.get_active():
+            self.book.thumbprofile = StageProfile()
+            return
+        profile = self.book.thumbprofile
+        self.book.thumbprofile = None
+        if not profile or not profile.pages:
+            return
+        s = gtk.FileChooserDialog(_("Save Thumbnail Timings"), self, gtk.FILE_CHOOSER_ACTION_SAVE, (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL, gtk.STOCK_SAVE, gtk.RESPONSE_OK))
+        s.set_default_response(gtk.RESPONSE_OK)
+        s.set_do_overwrite_confirmation(True)
+        s.set_current_name("thumbnails.csv")
+        # TRANSLATORS: %(pages)d is the number of thumbnails built, %(stages)s the seconds spent in each stage, such as load, scale and save
+        summary = gtk.Label(_("Time spent building %(pages)d thumbnails: %(stages)s") % { 'pages': len(profile.pages), 'stages': profile.summary() })
+        summary.set_line_wrap(True)
+        s.set_extra_widget(summary)
+        response = s.run()
+        if response == gtk.RESPONSE_OK:
+            try:
+                profile.save(s.get_filename())
+            except (IOError, OSError), err:
+                show_error_msg(err)
+        s.destroy()
+
     def new_book(self, widget):
         # Helper for opening up the New Book window.
         nb = NewBookWin(self)
@@ -1811,13 +4680,33 @@ class Main(gtk.Window):
         f.set_name(_("GIMP Book"))
         f.add_pattern("*.book")
         o.add_filter(f)
+        storem = None
+        if sqlite3:
+            storebox = gtk.HBox(False, 4)
+            storel = gtk.Label(_("Keep Page List in:"))
+            storels = gtk.ListStore(gobject.TYPE_STRING)
+            # TRANSLATORS: The last one is an SQLite database file, for books with thousands of pages
+            for store in [ _("As Saved"), _("The .book File"), _("A Database, for Very Long Books") ]:
+                storels.append([store])
+            storem = gtk.ComboBox(storels)
+            storec = gtk.CellRendererText()
+            storem.pack_start(storec, False)
+            storem.add_attribute(storec, 'text', 0)
+            storem.set_active(0)
+            storebox.pack_start(storel, False, False, 0)
+            storebox.pack_start(storem, False, False, 0)
+            storebox.show_all()
+            o.set_extra_widget(storebox)
         response = o.run()
         # filename = o.get_fielname()
         if response == gtk.RESPONSE_OK:
             o.hide()
             self.close_book()
             self.book = Book(self)
-            self.book.load_book(o.get_filename(), self)
+            database = None
+            if storem and storem.get_active() > 0:
+                database = storem.get_active() == 2
+            self.book.load_book(o.get_filename(), self, database)
             self.show_book()
             self.loaded = True
             self.enable_controls()
@@ -1836,19 +4725,33 @@ class Main(gtk.Window):
         self.thumbs.connect("item-activated", self.book.open_page)
         self.thumbs.connect("button-press-event", self.button_press, self.pagemenu)
         self.thumbs.set_model(self.book.pagestore)
-        self.book.update_thumbs()
         self.zoomoutm.set_sensitive(True)
         self.zoominm.set_sensitive(True)
         self.thumbs.set_item_width(self.book.thumbwidth + 10)
         self.thumbs.select_path(0)
         self.update_title()
+        self.thumbs_scrolled(None)
+
+    def thumbs_scrolled(self, adjustment):
+        # Pages have scrolled into view, or the layout changed. Decode their thumbs once things settle.
+        if self.scrollidle is None:
+            self.scrollidle = gobject.idle_add(self.load_visible)
+
+    def load_visible(self):
+        # Let the book decode the thumbs of the pages in view.
+        self.scrollidle = None
+        if self.loaded:
+            visible = self.thumbs.get_visible_range()
+            if visible:
+                self.book.load_visible(visible[0][0], visible[1][0])
+        return False
 
     def update_title(self):
         # Update the title bar.
 
         # TRANSLATORS: The %s(book_title)s, %s(selected_page)s and %(page_count)s need to be left in.
         # You can put them in a different order if needed.
-        self.set_title(_("GIMP Book - %(book_title)s (page %(selected_page)s of %(page_count)s)") % { 'book_title': self.book.bookname, 'selected_page': self.book.selected, 'page_count': len(self.book.pagestore)-1 })
+        self.set_title(_("GIMP Book - %(book_title)s (page %(selected_page)s of %(page_count)s)") % { 'book_title': self.book.bookname, 'selected_page': self.book.page_number(self.book.selected) if self.book.selected >= 0 else self.book.selected, 'page_count': len(self.book.pagenames)-1 })
 
     def button_press(self, widget, event, menu):
         # Capture buttons presses on thumbs.
@@ -1860,9 +4763,12 @@ class Main(gtk.Window):
             pass
         
     def export_win(self, widget):
-        # Settings for exporting the book.
+        # Settings for exporting the book, or the export running.
+        if self.exportwin:
+            self.exportwin.present()
+            return
         self.set_sensitive(False)
-        exportWin = ExportWin(self)
+        self.exportwin = ExportWin(self)
 
     def select_page(self, thumbs):
         # A page has been selected.
@@ -1888,6 +4794,16 @@ class Main(gtk.Window):
         else:
             show_error_msg(_("You need to create or load a book, before adding pages to it."))
 
+    def ask_add_chapter(self, widget):
+        # Start a chapter at the selected page, or at the end of the book.
+        dest = self.book.selected
+        if self.book.selected < 1:
+            dest = len(self.book.pagestore)
+        if self.loaded:
+            response, text = self.name_dialog(_("Add a Chapter"), _("Enter Chapter Name: "))
+            if response == gtk.RESPONSE_ACCEPT and text.strip():
+                self.book.add_chapter(text.strip(), dest)
+
     def open_page(self, widget):
         # Open page from right click menu.
         if self.book.selected < 0:
@@ -1967,8 +4883,13 @@ class Main(gtk.Window):
         if self.book.selected < 0:
             show_error_msg(_("No page selected to delete."))
             return False
-        # TRANSLATORS: %s is the name of the page to be deleted
-        areyousure = gtk.MessageDialog(self, 0, gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO, _('Delete page "%s"?') % (self.book.pagestore[self.book.selected][0]))
+        chapter = self.book.pagestore[self.book.selected][4]
+        if chapter:
+            # TRANSLATORS: %s is the name of the chapter to be removed
+            areyousure = gtk.MessageDialog(self, 0, gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO, _('Remove chapter "%s"? Its pages are kept.') % (chapter))
+        else:
+            # TRANSLATORS: %s is the name of the page to be deleted
+            areyousure = gtk.MessageDialog(self, 0, gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO, _('Delete page "%s"?') % (self.book.pagestore[self.book.selected][0]))
         response = areyousure.run()
         if response == gtk.RESPONSE_YES:
             self.book.delete_page()
@@ -2036,6 +4957,10 @@ class Main(gtk.Window):
         self.file_export.set_sensitive(True)
         self.storyboardm.set_sensitive(True)
         self.readingdirectionm.set_sensitive(True)
+        self.refreshm.set_sensitive(True)
+        self.thumbtimingm.set_sensitive(True)
+        if self.thumbtimingm.get_active() and not self.book.thumbprofile:
+            self.book.thumbprofile = StageProfile() # Keep timing the thumbnails of another book.
         if self.book.thumbsize >= THUMBMAX:
             self.zoomoutm.set_sensitive(True)
             self.zoominm.set_sensitive(False)
@@ -2050,6 +4975,7 @@ class Main(gtk.Window):
             self.deletepage.set_sensitive(True)
         self.openpage.set_sensitive(True)
         self.addpage.set_sensitive(True)
+        self.addchapter.set_sensitive(True)
         self.duplipage.set_sensitive(True)
         self.renamepage.set_sensitive(True)
         self.deletepage.set_sensitive(True)
@@ -2081,7 +5007,7 @@ class Main(gtk.Window):
             self.book.thumbsize = int(self.book.thumbsize * 2)
         if self.book.thumbsize >= THUMBMAX:
             self.zoominm.set_sensitive(False)
-        self.book.update_thumbs()
+        self.book.update_thumbs(False)
         self.zoomoutm.set_sensitive(True)
         self.thumbs.set_item_width(self.book.thumbwidth + 10)
         self.book.save()
@@ -2092,13 +5018,17 @@ class Main(gtk.Window):
             self.book.thumbsize = int(self.book.thumbsize / 2.0)
         if self.book.thumbsize <= THUMBMIN:
             self.zoomoutm.set_sensitive(False)
-        self.book.update_thumbs()
+        self.book.update_thumbs(False)
         self.zoominm.set_sensitive(True)
         self.thumbs.set_item_width(self.book.thumbwidth + 10)
         self.book.save()
 
     def close_book(self):
+        if self.exportwin:
+            # Cancels any export still running, stopping its workers, so it resumes from where it was next time.
+            self.exportwin.destroy()
         if self.loaded:
+            self.book.close()
             self.thumbs.set_model()
             del self.book
             self.loaded = False
@@ -2107,6 +5037,821 @@ def show_book():
     # Display the book window.
     r = Main()
     gtk.main()
+    r.close_book()
+
+def find_gimp_console():
+    # Find a GIMP binary that can run batch jobs headless, or None.
+    gimpbin = os.environ.get('GIMP_BOOK_GIMP')
+    if gimpbin:
+        return gimpbin
+    names = [ 'gimp-console-2.10', 'gimp-console-2.8', 'gimp-console', 'gimp-2.10', 'gimp-2.8', 'gimp' ]
+    dirs = os.environ.get('PATH', '').split(os.pathsep)
+    if os.name == 'nt':
+        # The Python used by GIMP on Windows lives next to, or below, GIMP's bin folder.
+        names = [ n + '.exe' for n in names ]
+        pydir = os.path.dirname(sys.executable)
+        dirs = [ pydir, os.path.join(pydir, '..', 'bin'), os.path.join(pydir, '..', '..', '..', '..', 'bin') ] + dirs
+    for name in names:
+        for d in dirs:
+            gimpbin = os.path.join(d, name)
+            if os.path.isfile(gimpbin) and os.access(gimpbin, os.X_OK):
+                return os.path.abspath(gimpbin)
+    return None
+
+def cpu_count():
+    # Number of cores to spread batch work over.
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def script_fu_string(s):
+    # Quote a string for use in a Script-Fu batch command.
+    return '"%s"' % (s.replace('\\', '\\\\').replace('"', '\\"'))
+
+def pdf_string(text):
+    # Quote a string for a PDF, as UTF-16 if it isn't plain ASCII.
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    try:
+        text = text.encode('ascii')
+    except UnicodeEncodeError:
+        return "<%s>" % (('\xfe\xff' + text.encode('utf-16-be')).encode('hex'))
+    return "(%s)" % (text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)'))
+
+def utf8_text(value):
+    # A value as utf-8 encoded text, be it unicode, text that's utf-8 encoded already, or a number.
+    if isinstance(value, str):
+        return value
+    return unicode(value).encode('utf-8')
+
+def utf8(data):
+    # Turn the unicode strings json gives back into utf-8 encoded ones, the way GTK and the PDB hand them out.
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    elif isinstance(data, list):
+        return [ utf8(d) for d in data ]
+    elif isinstance(data, dict):
+        return dict((utf8(k), utf8(v)) for k, v in data.items())
+    return data
+
+def book_changes(old, new):
+    # The operations turning the metadata of a book into new metadata, for the BookJournal. Pages are inserted and
+    # deleted in runs, so moving a page is two operations whatever the size of the book. Other keys are set whole.
+    ops = []
+    for key in sorted(new):
+        if key != 'pages' and old.get(key) != new[key]:
+            ops.append({ 'op': 'set', 'key': key, 'value': new[key] })
+    oldpages = old.get('pages', [])
+    # From the end, so each operation leaves the positions of those before it be.
+    for tag, i1, i2, j1, j2 in reversed(difflib.SequenceMatcher(None, oldpages, new['pages'], False).get_opcodes()):
+        if tag in [ 'delete', 'replace' ]:
+            ops.append({ 'op': 'delete', 'index': i1, 'count': i2 - i1 })
+        if tag in [ 'insert', 'replace' ]:
+            ops.append({ 'op': 'insert', 'index': i1, 'pages': new['pages'][j1:j2] })
+    return ops
+
+def apply_book_changes(metadata, ops):
+    # Apply operations from book_changes to the metadata of a book.
+    for op in ops:
+        if op['op'] == 'set':
+            metadata[op['key']] = op['value']
+        elif op['op'] == 'delete':
+            del metadata['pages'][op['index']:op['index'] + op['count']]
+        elif op['op'] == 'insert':
+            metadata['pages'][op['index']:op['index']] = op['pages']
+
+def replace_file(src, dst):
+    # Move src over dst, also on Windows where rename won't overwrite.
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+def rle_decode(src, pos, count):
+    # Decode count bytes of XCF RLE data from src at pos. Returns the bytes and the position after them.
+    out = bytearray()
+    end = len(src)
+    while len(out) < count:
+        if pos >= end:
+            raise XcfError("Truncated RLE data")
+        n = src[pos]
+        pos += 1
+        if n == 127 or n == 128: # Long run, with its length in the next two bytes.
+            if pos + 2 > end:
+                raise XcfError("Truncated RLE data")
+            length = src[pos] * 256 + src[pos+1]
+            pos += 2
+        elif n > 128:
+            length = 256 - n
+        else:
+            length = n + 1
+        if n >= 128: # Run of different bytes.
+            if pos + length > end:
+                raise XcfError("Truncated RLE data")
+            out += src[pos:pos+length]
+            pos += length
+        else: # Run of identical bytes.
+            if pos >= end:
+                raise XcfError("Truncated RLE data")
+            out += src[pos:pos+1] * length
+            pos += 1
+    if len(out) != count:
+        raise XcfError("RLE run past the end of the tile")
+    return out, pos
+
+def file_signature(path):
+    # The mtime, size and content hash of a file.
+    st = os.stat(path)
+    sha = hashlib.sha1()
+    f = open(path, "rb")
+    chunk = f.read(1048576)
+    while chunk:
+        sha.update(chunk)
+        chunk = f.read(1048576)
+    f.close()
+    return { 'mtime': st.st_mtime, 'size': st.st_size, 'hash': sha.hexdigest() }
+
+def thumb_size(width, height, size):
+    # The size of a thumb of a width x height image, fitting within size x size.
+    w = int(size) if width > height else int(float(width) / height * size)
+    h = int(size) if height > width else int(float(height) / width * size)
+    return w, h
+
+def make_thumbs(imagepath, thumbroot, sizes=THUMBSIZES, img=None):
+    # Save scaled down pngs of an image, in thumbroot/size/ for each size, from a single load of the image.
+    # Returns the signature of the image they were built from, along with its layer tags. Writes to temp files first,
+    # so a half written thumb is never read. With img, they're made from that image, already loaded in GIMP, and
+    # it's deleted once done.
+    sizes = sorted(sizes, reverse=True)
+    name = os.path.basename(imagepath)
+    paths = []
+    for size in sizes:
+        thumbdir = os.path.join(thumbroot, str(size))
+        if not os.path.isdir(thumbdir):
+            try:
+                os.makedirs(thumbdir)
+            except OSError:
+                if not os.path.isdir(thumbdir): # Another worker may have beaten us to it.
+                    raise
+        paths.append(os.path.join(thumbdir, name+'.png'))
+    partpaths = [ path + '.part' for path in paths ]
+    signature = timed('signature', file_signature, imagepath) # Before building, in case the page is saved meanwhile.
+    if img:
+        layers = make_thumbs_gimp(imagepath, partpaths, sizes, img)
+    else:
+        try:
+            layers = make_thumbs_xcf(imagepath, partpaths, sizes)
+        except XcfError:
+            layers = make_thumbs_gimp(imagepath, partpaths, sizes)
+    for partpath, path in zip(partpaths, paths):
+        replace_file(partpath, path)
+    signature['tags'] = layer_tags(layers) # For the tag index, while the page is at hand anyway.
+    return signature
+
+def make_thumbs_xcf(imagepath, paths, sizes):
+    # Build thumbs straight from the XCF file, without loading it in GIMP. Sizes go from large to small,
+    # each scaled down from the one before. Returns the layers of the page, like page_layers.
+    if not imagepath.lower().endswith('.xcf'):
+        raise XcfError("%s is not an XCF file" % (imagepath))
+    xcf = timed('load', XcfReader, imagepath)
+    try:
+        pix = timed('composite', xcf.thumbnail, sizes[0])
+        for path, size in zip(paths, sizes):
+            width, height = thumb_size(xcf.width, xcf.height, size)
+            if pix.get_width() != width or pix.get_height() != height:
+                pix = timed('scale', pix.scale_simple, width, height, gtk.gdk.INTERP_HYPER)
+            timed('save', pix.save, path, 'png')
+        return timed('tags', xcf_layers, xcf)
+    finally:
+        xcf.close()
+
+def make_thumbs_gimp(imagepath, paths, sizes, img=None):
+    # Build thumbs by loading the image in GIMP, unless it's given loaded already. Sizes go from large to small,
+    # each scaled down from the one before. Returns the layers of the page, like page_layers.
+    if not img:
+        img = timed('load', pdb.gimp_file_load, imagepath, imagepath)
+    layers = timed('tags', gimp_layers, img.layers, [])
+    timed('flatten', img.flatten)
+    for path, size in zip(paths, sizes):
+        width, height = thumb_size(img.width, img.height, size)
+        timed('scale', pdb.gimp_image_scale_full, img, width, height, 2)
+        drw = pdb.gimp_image_get_active_layer(img)
+        thumbname = os.path.split(path)[1]
+        timed('save', pdb.file_png_save, img, drw, path, thumbname, False, 9, False, False, False, True, True)
+    pdb.gimp_image_delete(img)
+    return layers
+
+def thumb_task(job):
+    # Batch task building all sizes of a thumb.
+    return make_thumbs(job['image'], job['thumbs'])
+
+def import_task(job):
+    # Batch task importing an image as a page. It's saved as .xcf, and its thumbs are made from the image while it's
+    # loaded, rather than loading the .xcf again. Pages that are .xcf already are simply copied.
+    partpath = job['image'] + '.part'
+    if job['source'].lower().endswith('.xcf'):
+        timed('save', shutil.copy, job['source'], partpath)
+        replace_file(partpath, job['image'])
+        return make_thumbs(job['image'], job['thumbs'])
+    img = timed('load', pdb.gimp_file_load, job['source'], job['source'])
+    timed('save', pdb.gimp_xcf_save, 0, img, None, partpath, os.path.basename(job['image']))
+    replace_file(partpath, job['image'])
+    return make_thumbs(job['image'], job['thumbs'], THUMBSIZES, img)
+
+def page_layers(imagepath, img):
+    # The (path, name, visible) of every layer in a page, nested ones included. Read from the XCF file in one go
+    # where possible, rather than asking GIMP for each layer.
+    try:
+        xcf = XcfReader(imagepath)
+    except XcfError:
+        return gimp_layers(img.layers, [])
+    layers = xcf_layers(xcf)
+    xcf.close()
+    return layers
+
+def gimp_layers(items, path):
+    # The (path, name, visible) of GIMP layers and everything in them, for pages that aren't XCF files.
+    layers = []
+    for i, layer in enumerate(items):
+        layers.append((path + [ i ], layer.name, layer.visible))
+        if pdb.gimp_item_is_group(layer):
+            layers.extend(gimp_layers(layer.children, path + [ i ]))
+    return layers
+
+def apply_tags(img, changes):
+    # Set the visibility of layers by path, as worked out by TagFilter.resolve.
+    if not changes:
+        return
+    top = img.layers
+    for path, visible in changes.items():
+        layer = top[path[0]]
+        for i in path[1:]:
+            layer = layer.children[i]
+        pdb.gimp_item_set_visible(layer, visible)
+
+def strip_writer(settings):
+    # The class for saving in strips with the format and options of ExportSettings, or None if GIMP has to save it.
+    ext = settings['format']
+    if ext == "png" and not settings['pnginterlacing']:
+        return PngStripWriter
+    elif ext == "tif" and settings['tifcompress'] in [ 0, 3 ]: # None or deflate.
+        return TiffStripWriter
+    elif ext == "bmp":
+        return BmpStripWriter
+    return None
+
+def export_strips(img, drw, settings, number, fullname):
+    # Save a flattened page a strip at a time, adding margins on the fly instead of resizing the canvas, so
+    # memory holds the scaled page and a strip of settings['memorylimit'] megabytes, rather than several copies.
+    # The page is scaled first and the margins with it, so sizes can differ a pixel from exporting it in one go.
+    top = settings['margtop']
+    bottom = settings['margbot']
+    inner = settings['marginner']
+    outer = settings['margouter']
+    w = inner + outer + img.width
+    h = top + bottom + img.height
+    x = outer if number%2 == 0 else inner # Left or right hand page.
+    if settings['scalepixels']:
+        nw = int(settings['scalew'])
+        nh = int(settings['scaleh'])
+    else:
+        nw = int((settings['scalew'] / 100) * w)
+        nh = int((settings['scaleh'] / 100) * h)
+    sx = float(nw) / w
+    sy = float(nh) / h
+    cw = max(1, int(round(img.width * sx)))
+    ch = max(1, int(round(img.height * sy)))
+    if cw != img.width or ch != img.height:
+        pdb.gimp_image_scale_full(img, cw, ch, settings['interp'])
+        drw = pdb.gimp_image_get_active_layer(img)
+    left = int(round(x * sx))
+    up = int(round(top * sy))
+    set_margin_color(settings)
+    bg = pdb.gimp_context_get_background()
+    rgb = [ int(round(c * 255)) for c in (bg.r, bg.g, bg.b) ]
+    channels = drw.bpp
+    if channels == 1:
+        fill = chr(gray_level(rgb))
+    else:
+        fill = "".join([ chr(c) for c in rgb ])
+    # The part of the scaled page that ends up within the canvas, and the margins on either side of it.
+    c0 = max(0, -left)
+    c1 = min(cw, nw - left)
+    blankrow = fill * nw
+    if c1 > c0:
+        leftfill = fill * max(0, left)
+        rightfill = fill * (nw - max(0, left) - (c1 - c0))
+    rowbytes = (c1 - c0) * channels
+    band = max(1, min(nh, settings['memorylimit'] * 1048576 / (nw * channels * 4)))
+    rgn = drw.get_pixel_rgn(0, 0, cw, ch, False, False)
+    writer = strip_writer(settings)(fullname, nw, nh, channels, pdb.gimp_image_get_resolution(img)[0], settings, rgb)
+    try:
+        for y0 in range(0, nh, band):
+            y1 = min(nh, y0 + band)
+            s0 = min(max(0, y0 - up), ch)
+            s1 = max(min(ch, y1 - up), s0)
+            above = min(max(0, up - y0), y1 - y0)
+            rows = [ blankrow ] * above
+            if s1 > s0 and c1 > c0:
+                data = rgn[c0:c1, s0:s1]
+                rows.extend([ leftfill + data[r:r+rowbytes] + rightfill for r in range(0, len(data), rowbytes) ])
+            else:
+                rows.extend([ blankrow ] * (s1 - s0))
+            rows.extend([ blankrow ] * (y1 - y0 - len(rows)))
+            writer.write("".join(rows))
+    finally:
+        writer.close()
+
+def peak_rss():
+    # Peak resident memory in bytes of this plug-in and the GIMP running it, where it can be found out.
+    peak = 0
+    pids = [ os.getpid() ]
+    if hasattr(os, 'getppid'):
+        pids.append(os.getppid())
+    for pid in pids:
+        try:
+            f = open("/proc/%d/status" % (pid), "r")
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    peak += int(line.split()[1]) * 1024
+            f.close()
+        except (IOError, ValueError):
+            pass
+    if not peak:
+        try:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except (ImportError, AttributeError):
+            return None
+    return peak or None
+
+def export_page(job):
+    # Batch task exporting one page of a book, to each of its outputs with their own ExportSettings options.
+    # The page is loaded once, and run through the export stages shared by its outputs. Returns the signature
+    # of the page, from before it was loaded, the seconds it took and the peak memory used so far.
+    start = time.time()
+    signature = timed('signature', file_signature, job['image'])
+    img = timed('load', pdb.gimp_file_load, job['image'], job['image'])
+    pdb.gimp_image_undo_disable(img) # No need to keep the layers around for undo, when flattening and scaling.
+    targets = []
+    for output in job['outputs']:
+        settings = output['settings']
+        targets.append({ 'output': output,
+                         'settings': settings,
+                         'tagged': output['tagged'],
+                         'flatten': not settings['format'] in [ "xcf", "ora", "psd" ] or settings['flatten'],
+                         'strips': bool(settings['streaming'] and strip_writer(settings)) })
+    def finish(img, target):
+        # Save the page, as it's ready for this output.
+        settings = target['settings']
+        drw = pdb.gimp_image_get_active_layer(img)
+        if target['strips']:
+            if pdb.gimp_image_base_type(img) == INDEXED:
+                # Strips are gray or RGB, so a flattened indexed page is written as RGB, rather than its indices.
+                pdb.gimp_image_convert_rgb(img)
+                drw = pdb.gimp_image_get_active_layer(img)
+            timed('strips', export_strips, img, drw, settings, job['number'], target['output']['file'])
+            pdb.gimp_image_delete(img)
+        else:
+            timed('save', save_image, img, drw, settings, target['output']['file'])
+    export_stages(img, targets, { 'image': job['image'], 'right': job['number']%2 == 1, 'layers': None }, finish)
+    return { 'signature': signature, 'seconds': time.time() - start, 'peakrss': peak_rss() }
+
+def export_sheet(job):
+    # Batch task compositing the pages of a sheet of facing pages, or n-up pages, to each of its outputs.
+    # Each page is loaded once, and run through the export stages shared by the outputs, before its layer is
+    # copied onto each output's sheet. Returns the signatures of the pages, like export_page.
+    start = time.time()
+    sheet = job['sheet']
+    outputs = job['outputs']
+    signatures = []
+    sheets = [ None ] * len(outputs) # The sheet image of each output, with the size of its cells.
+    for p, page in enumerate(sheet['pages']):
+        signatures.append(timed('signature', file_signature, page['image']))
+        img = timed('load', pdb.gimp_file_load, page['image'], page['image'])
+        pdb.gimp_image_undo_disable(img)
+        targets = [ { 'output': output, 'settings': output['settings'], 'tagged': output['tagged'][p], 'flatten': True, 'strips': False, 'index': k }
+                    for k, output in enumerate(outputs) ]
+        def finish(copy, target):
+            # Copy the page onto the sheet of this output.
+            k = target['index']
+            if pdb.gimp_image_base_type(copy) == INDEXED:
+                pdb.gimp_image_convert_rgb(copy)
+            drw = pdb.gimp_image_get_active_layer(copy)
+            if not sheets[k]:
+                # Cells are the size of the first page, as the pages of a book share the template's size.
+                width = copy.width * sheet['columns']
+                height = copy.height * sheet['rows']
+                if pdb.gimp_image_base_type(copy) == GRAY:
+                    sheetimg = pdb.gimp_image_new(width, height, GRAY)
+                    bglayer = gimp.Layer(sheetimg, "Background", width, height, GRAY_IMAGE, 100, NORMAL_MODE)
+                else:
+                    sheetimg = pdb.gimp_image_new(width, height, RGB)
+                    bglayer = gimp.Layer(sheetimg, "Background", width, height, RGB_IMAGE, 100, NORMAL_MODE)
+                pdb.gimp_image_undo_disable(sheetimg)
+                pdb.gimp_image_set_resolution(sheetimg, *pdb.gimp_image_get_resolution(copy))
+                set_margin_color(target['settings'])
+                bglayer.fill(BACKGROUND_FILL)
+                sheetimg.add_layer(bglayer, 0)
+                sheets[k] = (sheetimg, copy.width, copy.height)
+            sheetimg, cellw, cellh = sheets[k]
+            layer = pdb.gimp_layer_new_from_drawable(drw, sheetimg)
+            sheetimg.add_layer(layer, 0)
+            layer.set_offsets(page['column'] * cellw, page['row'] * cellh)
+            pdb.gimp_image_delete(copy)
+        export_stages(img, targets, { 'image': page['image'], 'right': page['right'], 'layers': None },
+                      lambda copy, target: timed('composite', finish, copy, target))
+    for k, output in enumerate(outputs):
+        sheetimg = sheets[k][0]
+        timed('flatten', sheetimg.flatten)
+        timed('save', save_image, sheetimg, pdb.gimp_image_get_active_layer(sheetimg), output['settings'], output['file'])
+    return { 'signature': signatures, 'seconds': time.time() - start, 'peakrss': peak_rss() }
+
+EXPORTSTAGES = [ ('tags', [ 'taghide', 'tagshow', 'tagun' ]),
+                 ('flatten', []),
+                 ('margins', [ 'margtop', 'margbot', 'marginner', 'margouter', 'margcolor', 'margcustom' ]),
+                 ('scale', [ 'scalepixels', 'scalew', 'scaleh', 'interp' ]) ] # Export stages, and the options they depend on.
+
+def export_stages(img, targets, page, finish, stage=0):
+    # Run a loaded page through the export stages for several targets, each a dict of an output, its settings and
+    # what it needs from the page. Targets that agree on a stage share it, and the image is only duplicated where
+    # they part ways, so one flatten can feed several scales feeding several encoders. finish is called with the
+    # image ready for each target, and has to delete it. The page is a dict of its image path and side.
+    if stage == len(EXPORTSTAGES):
+        groups = [ [ target ] for target in targets ] # Every target saves its own.
+    else:
+        groups = collections.OrderedDict()
+        for target in targets:
+            groups.setdefault(stage_key(stage, target), []).append(target)
+        groups = groups.values()
+    for g, group in enumerate(groups):
+        if g < len(groups) - 1:
+            copy = timed('duplicate', pdb.gimp_image_duplicate, img)
+            pdb.gimp_image_undo_disable(copy)
+        else:
+            copy = img
+        if stage == len(EXPORTSTAGES):
+            finish(copy, group[0])
+        else:
+            timed(EXPORTSTAGES[stage][0], apply_stage, stage, copy, group[0], page)
+            export_stages(copy, group, page, finish, stage + 1)
+
+def stage_key(stage, target):
+    # What targets need to agree on to share an export stage.
+    name, options = EXPORTSTAGES[stage]
+    settings = target['settings']
+    if name == 'tags':
+        return json.dumps([ settings[o] for o in options ]) if target['tagged'] and tag_filter(settings).active() else None
+    elif name == 'flatten':
+        return target['flatten']
+    elif target['strips']:
+        return None # Saving in strips does the margins and scaling itself.
+    return json.dumps([ settings[o] for o in options ])
+
+def apply_stage(stage, img, target, page):
+    # Do an export stage to a page, as the settings of the target want it.
+    name = EXPORTSTAGES[stage][0]
+    settings = target['settings']
+    if name == 'tags':
+        tags = tag_filter(settings)
+        if target['tagged'] and tags.active():
+            if page['layers'] is None:
+                page['layers'] = page_layers(page['image'], img)
+            apply_tags(img, tags.resolve(page['layers']))
+    elif name == 'flatten':
+        if target['flatten']:
+            img.flatten()
+    elif target['strips']:
+        pass
+    elif name == 'margins':
+        add_margins(img, settings, page['right'])
+    elif name == 'scale':
+        scale_image(img, settings)
+
+def gray_level(rgb):
+    # The luma of an 8 bit RGB color, for filling and tagging grayscale pages with it.
+    return int(round(0.299 * rgb[0] + 0.587 * rgb[1] + 0.114 * rgb[2]))
+
+def set_margin_color(settings):
+    # Make the margin color of the settings the background color, leaving it be for the page's background color.
+    if settings['margcolor'] == 1: # Black
+        pdb.gimp_context_set_background((0,0,0))
+    elif settings['margcolor'] == 2: # White
+        pdb.gimp_context_set_background((255,255,255))
+    elif settings['margcolor'] == 3: # Custom color
+        pdb.gimp_context_set_background(tuple(settings['margcustom']))
+
+def add_margins(img, settings, right):
+    # Add or remove the margins of a left or right hand page.
+    top = settings['margtop']
+    bottom = settings['margbot']
+    inner = settings['marginner']
+    outer = settings['margouter']
+    w = inner + outer + img.width
+    h = top + bottom + img.height
+    x = 0
+    y = top
+    if right: # Right hand page.
+        x = inner
+    else: # Left hand page.
+        x = outer
+    if not top == 0 or not bottom == 0 or not inner == 0 or not outer == 0:
+        set_margin_color(settings)
+        pdb.gimp_image_resize(img, w, h, x, y)
+        pdb.gimp_layer_resize_to_image_size(pdb.gimp_image_get_active_layer(img))
+
+def scale_image(img, settings):
+    # Scale a page, by pixels or percent.
+    nw = 0
+    nh = 0
+    if settings['scalepixels']: # Pixel
+        nw = int(settings['scalew'])
+        nh = int(settings['scaleh'])
+    else: # Percent
+        nw = int((settings['scalew'] / 100) * img.width)
+        nh = int((settings['scaleh'] / 100) * img.height)
+    if not nw == img.width or not nh == img.height:
+        pdb.gimp_image_scale_full(img, nw, nh, settings['interp'])
+
+def save_image(img, drw, settings, fullname):
+    # Save an image to fullname in the format of the settings, and delete it.
+    name = os.path.basename(fullname)
+    ext = settings['format']
+    if ext == "gif":
+        # Convert to grayscale
+        if settings['gifgrayscale']:
+            pdb.gimp_image_convert_grayscale(img)
+        else:
+            # TODO! Maybe support custom palettes and other GIF options...but not for now.
+            pdb.gimp_image_convert_indexed(img,
+                                           settings['gifdither'],
+                                           0,
+                                           settings['gifcolors'],
+                                           False,
+                                           False,
+                                           "")
+        pdb.file_gif_save(img, drw, fullname, name,
+                          settings['gifinterlace'],
+                          0,0,0)
+    elif ext == "xcf":
+        pdb.gimp_file_save(img, drw, fullname, name)
+    elif ext == "jpg":
+        pdb.file_jpeg_save(img, drw, fullname, name, settings['jpgquality'],
+                           settings['jpgsmoothing'],
+                           settings['jpgoptimize'],
+                           settings['jpgprogressive'],
+                           settings['jpgcomment'],
+                           settings['jpgsubsampling'],
+                           0,
+                           settings['jpgrestart'],
+                           settings['jpgdct'])
+    elif ext == "ora":
+        pdb.file_openraster_save(img, drw, fullname, name)
+    elif ext == "psd":
+        pdb.file_psd_save(img, drw, fullname, name, settings['psdcompress'], 0)
+    elif ext == "png":
+        pdb.file_png_save2(img, drw, fullname, name,
+                           settings['pnginterlacing'],
+                           settings['pngcompress'],
+                           settings['pngbgcolor'],
+                           settings['pnggamma'],
+                           settings['pnglayeroffset'],
+                           settings['pngresolution'],
+                           settings['pngcreationtime'],
+                           1,
+                           settings['pngcoloroftransp'])
+    elif ext == "tif":
+        pdb.file_tiff_save2(img, drw, fullname, name, settings['tifcompress'], settings['tifcoloroftransp'])
+    elif ext == "bmp":
+        pdb.file_bmp_save(img, drw, fullname, name)
+    pdb.gimp_image_delete(img)
+
+STAGETIMES = None # Seconds by stage of the batch job running, when it asked for profiling.
+
+def timed(stage, function, *args):
+    # Call a function, adding the time it takes to the stage in STAGETIMES when profiling.
+    if STAGETIMES is None:
+        return function(*args)
+    start = time.time()
+    try:
+        return function(*args)
+    finally:
+        STAGETIMES[stage] = STAGETIMES.get(stage, 0.0) + time.time() - start
+
+def run_task(job):
+    # Do a batch job. Jobs with 'profile' set get the seconds spent in each stage added to their result, as 'stages'.
+    global STAGETIMES
+    if job.get('profile'):
+        STAGETIMES = collections.OrderedDict()
+    try:
+        result = BATCHTASKS[job['task']](job)
+        if STAGETIMES is not None:
+            result['stages'] = STAGETIMES
+        return result
+    finally:
+        STAGETIMES = None
+
+BATCHTASKS = { 'thumb': thumb_task, 'import': import_task, 'export': export_page, 'sheet': export_sheet }
+
+def benchmark_thumbs(bookfile, size, resultfile):
+    # Time building thumbs straight from the XCF files, against loading them in GIMP, for every page in a book.
+    f = open(bookfile, "r")
+    pages = json.loads(f.read())['pages']
+    f.close()
+    pagepath = os.path.join(os.path.dirname(bookfile), "pages")
+    tmpdir = tempfile.mkdtemp(prefix='book_benchmark_')
+    results = []
+    try:
+        for p in pages:
+            imagepath = os.path.join(pagepath, p)
+            result = { 'page': p, 'size': size, 'bytes': os.path.getsize(imagepath), 'gimp': None, 'xcf': None }
+            try:
+                xcf = XcfReader(imagepath)
+                result['width'] = xcf.width
+                result['height'] = xcf.height
+                result['layers'] = len(xcf.layers)
+                xcf.close()
+            except XcfError:
+                pass
+            start = time.time()
+            make_thumbs_gimp(imagepath, [ os.path.join(tmpdir, 'gimp.png') ], [ size ])
+            result['gimp'] = time.time() - start
+            try:
+                start = time.time()
+                make_thumbs_xcf(imagepath, [ os.path.join(tmpdir, 'xcf.png') ], [ size ])
+                result['xcf'] = time.time() - start
+            except XcfError, err:
+                result['fallback'] = str(err)
+            results.append(result)
+    finally:
+        shutil.rmtree(tmpdir)
+    gimptotal = sum([ r['gimp'] for r in results if r['xcf'] is not None ])
+    xcftotal = sum([ r['xcf'] for r in results if r['xcf'] is not None ])
+    summary = { 'book': bookfile, 'pages': len(results), 'xcf_pages': len([ r for r in results if r['xcf'] is not None ]),
+                'gimp_seconds': gimptotal, 'xcf_seconds': xcftotal, 'speedup': gimptotal / xcftotal if xcftotal else None, 'results': results }
+    f = open(resultfile, "w")
+    f.write(json.dumps(summary, indent=4))
+    f.close()
+
+BENCHTAGS = [ "en", "de", "fr", "sketch", "inks" ] # Tags given to layers of synthetic books.
+
+def make_synthetic_book(main, dest, name, pages, width, height, layers, tagdensity, seed=0):
+    # Generate a book for benchmarking, with make_book and add_page. Every page, the template included, is drawn
+    # by make_synthetic_page from the same seeded random numbers, so each has content and tags of its own, and
+    # the same seed always makes the same book. Returns the Book, loaded.
+    rand = random.Random(seed)
+    book = Book(main)
+    if not book.make_book(dest, name, width, height, 72, 0, 2, 0, 0, 0, 0):
+        raise RuntimeError(_("Could not create a book in %s") % (dest))
+    make_synthetic_page(os.path.join(book.pagepath, "Template.xcf"), layers, tagdensity, rand)
+    for i in range(int(pages)):
+        book.add_page("Page %d" % (i + 1), len(book.pagestore))
+        make_synthetic_page(os.path.join(book.pagepath, "Page %d.xcf" % (i + 1)), layers, tagdensity, rand)
+    book.flush()
+    return book
+
+def make_synthetic_page(imagepath, layers, tagdensity, rand):
+    # Draw a page of a synthetic book, over the copy of the template it starts out as. It gets a plasma background,
+    # and layers-1 more layers with a filled rectangle each, tagdensity (0.0-1.0) of them tagged with one of BENCHTAGS.
+    img = pdb.gimp_file_load(imagepath, imagepath)
+    for layer in img.layers[:-1]:
+        pdb.gimp_image_remove_layer(img, layer) # Those the template got, if this is a copy of it.
+    pdb.plug_in_plasma(img, img.layers[0], rand.randint(0, 2**31 - 1), 1.0)
+    for l in range(1, int(layers)):
+        layername = "Layer %d" % (l)
+        if rand.random() < tagdensity:
+            layername = "%s [%s]" % (layername, rand.choice(BENCHTAGS))
+        layer = gimp.Layer(img, layername, img.width, img.height, RGBA_IMAGE, 100, NORMAL_MODE)
+        img.add_layer(layer, 0)
+        x = rand.randint(0, img.width - 1)
+        y = rand.randint(0, img.height - 1)
+        pdb.gimp_image_select_rectangle(img, CHANNEL_OP_REPLACE, x, y, rand.randint(1, img.width - x), rand.randint(1, img.height - y))
+        pdb.gimp_context_set_foreground((rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255)))
+        pdb.gimp_edit_fill(layer, FOREGROUND_FILL)
+        pdb.gimp_selection_none(img)
+    pdb.gimp_xcf_save(0, img, None, imagepath, os.path.basename(imagepath))
+    pdb.gimp_image_delete(img)
+
+def wait_for_thumbs(book):
+    # Run the main loop until the book has no thumbs left to build.
+    context = gobject.main_context_default()
+    while book.thumbpool.pending():
+        context.iteration(True)
+
+def benchmark_book(dest, pages, width, height, layers, tagdensity, resultfile):
+    # Generate a synthetic book in dest, and time loading it with and without thumbs, zooming, and exporting it
+    # to each format. The results are written as json to resultfile, for comparing across versions.
+    # Needs a display, so run it with gimp -b, not gimp -i.
+    name = "Benchmark %s" % (strftime("%Y%m%d%H%M%S"))
+    results = { 'version': version, 'gimp': pdb.gimp_version(), 'cores': cpu_count(), 'date': strftime("%Y-%m-%d %H:%M:%S"),
+                'pages': pages, 'width': width, 'height': height, 'layers': layers, 'tagdensity': tagdensity,
+                'timings': {}, 'errors': {} }
+    timings = results['timings']
+    main = Main()
+    start = time.time()
+    book = make_synthetic_book(main, dest, name, pages, width, height, layers, tagdensity)
+    wait_for_thumbs(book)
+    timings['generate'] = time.time() - start
+    bookfile = book.bookfile
+    book.close()
+    # Cold load, building every thumb.
+    shutil.rmtree(book.thumbpath)
+    os.makedirs(book.thumbpath)
+    book = Book(main)
+    start = time.time()
+    book.load_book(bookfile, main)
+    wait_for_thumbs(book)
+    timings['cold_load'] = time.time() - start
+    book.close()
+    # Warm load, with all thumbs up to date.
+    book = Book(main)
+    start = time.time()
+    book.load_book(bookfile, main)
+    wait_for_thumbs(book)
+    book.load_visible(0, min(len(book.pagestore), 20) - 1)
+    timings['warm_load'] = time.time() - start
+    # Zoom in and out, and read the thumbs of the first screenful of pages.
+    for zoom, size in [ ('zoom_in', book.thumbsize * 2), ('zoom_out', book.thumbsize) ]:
+        start = time.time()
+        book.thumbsize = size
+        book.update_thumbs(False)
+        wait_for_thumbs(book)
+        timings[zoom] = time.time() - start
+    # Export to each format, with a tag to hide and one to show.
+    exportdir = os.path.join(dest, name + " Export")
+    for ext in ExportSettings.FORMATS:
+        settings = ExportSettings({ 'dest': os.path.join(exportdir, ext), 'format': ext, 'incremental': False,
+                                    'taghide': BENCHTAGS[1], 'tagshow': BENCHTAGS[0] })
+        start = time.time()
+        errors = book.export_book(settings)
+        timings['export_' + ext] = time.time() - start
+        if errors:
+            results['errors'][ext] = errors
+    book.close()
+    f = open(resultfile, "w")
+    f.write(json.dumps(results, indent=4, sort_keys=True))
+    f.close()
+
+def run_batch(jobfile):
+    # Work through a job file written by BatchWorker, reporting on each job in the status file.
+    f = open(jobfile, "r")
+    batch = utf8(json.loads(f.read()))
+    f.close()
+    status = open(batch['status'], "a")
+    for job in batch['jobs']:
+        try:
+            result = { 'id': job['id'], 'ok': True, 'message': "", 'result': run_task(job) }
+        except Exception, err:
+            result = { 'id': job['id'], 'ok': False, 'message': str(err), 'result': None }
+        status.write(json.dumps(result) + "\n")
+        status.flush()
+    status.close()
+
+def export_book_file(bookfile, settings, dest):
+    # Export a book without opening the Book window, for running from the command line:
+    # gimp -i -b '(python-fu-book-export RUN-NONINTERACTIVE "MyBook/MyBook.book" "web.json" "/out")' -b '(gimp-quit 0)'
+    # Settings is a json file saved from ExportSettings, or the json itself. Dest, if given, overrides the one in the settings.
+    # The export is added to the book's ExportQueue, and run after any exports already queued or interrupted there, so
+    # running the same command again after a crash resumes it. With no settings, only the queue is run.
+    bookfile = os.path.abspath(bookfile)
+    queue = ExportQueue(bookfile)
+    if settings:
+        if settings.lstrip().startswith('{'):
+            settings = ExportSettings.from_json(settings)
+        else:
+            settings = ExportSettings.load(settings)
+        if dest:
+            settings['dest'] = dest
+        if not settings['dest']:
+            raise ValueError(_("No destination folder to export to."))
+        queue.add(settings)
+    book = Book(None)
+    pages = book.read_book(bookfile)['pages']
+    profile = StageProfile()
+    def progress(done, total, page, seconds, peakrss, stages):
+        if seconds is None:
+            print "%d/%d %s failed" % (done, total, page)
+        elif peakrss:
+            print "%d/%d %s %.1fs (peak memory %d MB)" % (done, total, page, seconds, peakrss / 1048576)
+        else:
+            print "%d/%d %s %.1fs" % (done, total, page, seconds)
+        if stages:
+            profile.add(page, stages, seconds)
+            print "    " + profile.summary(stages)
+    queue.run(book, progress, pages=pages)
+    context = gobject.main_context_default()
+    while queue.running():
+        context.iteration(True)
+    book.thumbpool.stop()
+    if book.database:
+        book.database.close()
+    if profile.pages:
+        print "total " + profile.summary()
+    if queue.errors:
+        raise RuntimeError("\n".join(queue.errors))
 
 def show_error_msg( msg ):
     # Output error messages to the GIMP error console.
@@ -2132,5 +5877,79 @@ register(
     show_book,
 )
 
+register(
+    "python_fu_book_batch",
+    "Work through a job file written by GIMP Book. Used by GIMP Book to run jobs in headless GIMP workers.",
+    "GNU GPL v3 or later.",
+    "Ragnar Brynjúlfsson",
+    "Ragnar Brynjúlfsson",
+    "October 2026",
+    "",
+    "",
+    [
+        (PF_STRING, "jobfile", "Job file to work through", ""),
+    ],
+    [],
+    run_batch,
+)
+
+register(
+    "python_fu_book_benchmark_thumbs",
+    "Time building thumbnails straight from the XCF files against loading the pages in GIMP, and write the results to a JSON file.",
+    "GNU GPL v3 or later.",
+    "Ragnar Brynjúlfsson",
+    "Ragnar Brynjúlfsson",
+    "October 2026",
+    "",
+    "",
+    [
+        (PF_STRING, "bookfile", "The .book file to benchmark", ""),
+        (PF_INT, "size", "Thumbnail size", 256),
+        (PF_STRING, "resultfile", "JSON file to write the results to", ""),
+    ],
+    [],
+    benchmark_thumbs,
+)
+
+register(
+    "python_fu_book_benchmark",
+    "Generate a synthetic book, and time loading, zooming and exporting it to each format. Needs a display, so run it with gimp -b rather than gimp -i.",
+    "GNU GPL v3 or later.",
+    "Ragnar Brynjúlfsson",
+    "Ragnar Brynjúlfsson",
+    "October 2026",
+    "",
+    "",
+    [
+        (PF_STRING, "dest", "Folder to generate the book in", ""),
+        (PF_INT, "pages", "Number of pages", 50),
+        (PF_INT, "width", "Page width in pixels", 2480),
+        (PF_INT, "height", "Page height in pixels", 3508),
+        (PF_INT, "layers", "Layers per page", 8),
+        (PF_FLOAT, "tagdensity", "Share of layers that are tagged, 0.0-1.0", 0.5),
+        (PF_STRING, "resultfile", "JSON file to write the results to", ""),
+    ],
+    [],
+    benchmark_book,
+)
+
+register(
+    "python_fu_book_export",
+    "Export a book without opening the Book window, with export settings saved as JSON.",
+    "GNU GPL v3 or later.",
+    "Ragnar Brynjúlfsson",
+    "Ragnar Brynjúlfsson",
+    "October 2026",
+    "",
+    "",
+    [
+        (PF_STRING, "bookfile", "The .book file to export", ""),
+        (PF_STRING, "settings", "JSON file with the export settings, or the JSON itself. Empty to only run the export queue", ""),
+        (PF_STRING, "dest", "Folder to export to, overriding the one in the settings", ""),
+    ],
+    [],
+    export_book_file,
+)
+
 
 main()
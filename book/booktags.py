@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# GIMP Book
+#  by Ragnar Brynjúlfsson
+#
+# DESCRIPTION
+#   Layer tags for book.py. Works out which layers to show and hide on export, from the [tags] in their names.
+#   Needs nothing from GIMP, so it can be tested on its own.
+#
+# LICENSE
+#   GNU General Public License version 3 or later, see book.py.
+
+import re
+
+
+class TagFilter():
+    # Works out which layers to show and hide on export, from the [tags] in their names. The tag lists are parsed
+    # once, and layers are plain (path, name, visible) tuples, where path holds the layer's index within each
+    # group down to it. So nested groups are covered, and it all works without GIMP.
+    PATTERN = re.compile(r"\[(.*?)\]")
+
+    def __init__(self, hide, show, untagged=0):
+        self.hide = self.parse(hide)
+        self.show = self.parse(show)
+        self.untagged = untagged # For layers not matching any tag, 0: don't touch, 1: show, 2: hide.
+        self.names = {}          # Visibility by layer name, as pages tend to share layer names.
+
+    def parse(self, tags):
+        # Split a comma separated list of tags.
+        return frozenset([ t.strip() for t in tags.split(',') if t.strip() ])
+
+    def active(self):
+        # False if no layer will ever be touched.
+        return bool(self.hide or self.show or self.untagged)
+
+    def visibility(self, name):
+        # True to show a layer, False to hide it, and None to leave it. Hide wins over show, if a layer has two matching tags.
+        if not name in self.names:
+            tags = set([ t.strip() for t in self.PATTERN.findall(name) ])
+            if tags & self.hide:
+                self.names[name] = False
+            elif tags & self.show:
+                self.names[name] = True
+            elif self.untagged == 1: # Show all by default.
+                self.names[name] = True
+            elif self.untagged == 2: # Hide all by default.
+                self.names[name] = False
+            else:
+                self.names[name] = None
+        return self.names[name]
+
+    def resolve(self, layers):
+        # Map the path of each layer whose visibility needs changing to its new visibility, in one pass.
+        changes = {}
+        for path, name, visible in layers:
+            show = self.visibility(name)
+            if show is not None and show != visible:
+                changes[tuple(path)] = show
+        return changes
+
+TAGFILTERS = {} # TagFilter by tag settings, so a worker parses them once per export.
+
+def tag_filter(settings):
+    # The TagFilter for the tag options of ExportSettings.
+    key = (settings['taghide'], settings['tagshow'], settings['tagun'])
+    if not key in TAGFILTERS:
+        TAGFILTERS[key] = TagFilter(*key)
+    return TAGFILTERS[key]
+
+def xcf_layers(xcf):
+    # The (path, name, visible) of every layer in an XcfReader.
+    layers = []
+    top = 0
+    for layer in xcf.layers:
+        if layer['floating']:
+            continue
+        path = layer['path']
+        if not path: # Only layers within groups have their path saved.
+            path = [ top ]
+            top += 1
+        layers.append((path, layer['name'], layer['visible']))
+    return layers
+
+def layer_tags(layers):
+    # Map each tag in the names of (path, name, visible) layers to the layers tagged with it, as "Group/Layer" paths.
+    names = dict((tuple(path), name) for path, name, visible in layers)
+    tags = {}
+    for path, name, visible in layers:
+        for tag in TagFilter.PATTERN.findall(name):
+            tag = tag.strip()
+            if tag:
+                tags.setdefault(tag, []).append("/".join([ names.get(tuple(path[:i+1]), "") for i in range(len(path)) ]))
+    return tags
@@ -0,0 +1,68 @@
+# Loads book.py for the tests, outside of GIMP. book.py is written for GIMP's Python 2, so the tests of it need
+# Python 2.7, and are skipped on Python 3:
+#   python -m unittest discover tests
+# GIMP's modules can only be imported inside GIMP, and GTK may not be installed, so stand-ins good enough to import
+# book.py are registered for those missing. Only the parts of book.py that need neither GIMP nor GTK are tested.
+import os
+import re
+import sys
+import types
+
+BOOKDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'book')
+
+
+class Anything(object):
+    # Stands in for any GTK class or value used while importing book.py.
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return Anything()
+
+    def __call__(self, *args, **kwargs):
+        return Anything()
+
+
+class StandIn(types.ModuleType):
+    # A module with whatever attribute is asked of it.
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Anything
+
+
+def stand_in(name, **attributes):
+    # Register a stand-in module, unless the real one can be imported.
+    try:
+        __import__(name)
+        return
+    except Exception:
+        pass
+    module = StandIn(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+
+
+def load_book():
+    # The book module, or None on Python 3.
+    if sys.version_info[0] > 2:
+        return None
+    if 'book' in sys.modules:
+        return sys.modules['book']
+    import imp
+    path = os.path.join(BOOKDIR, 'book.py')
+    f = open(path)
+    source = f.read()
+    f.close()
+    # The plug-in's register calls and star imports need the PF_ constants, and main, to exist.
+    gimpfu = dict((name, 0) for name in set(re.findall(r'\bPF_[A-Z]+\b', source)))
+    gimpfu.update({ 'register': lambda *args, **kwargs: None, 'main': lambda: None, 'pdb': Anything(), '__all__': None })
+    gimpfu['__all__'] = [ name for name in gimpfu if name != '__all__' ]
+    stand_in('gimp', directory=os.path.join(BOOKDIR, '..'), Layer=Anything, Display=Anything)
+    stand_in('gimpfu', **gimpfu)
+    stand_in('gimpenums', __all__=[])
+    stand_in('gobject', GError=type('GError', (Exception,), {}))
+    stand_in('gtk', Window=object, Button=object, gdk=Anything())
+    if not BOOKDIR in sys.path:
+        sys.path.insert(0, BOOKDIR)
+    return imp.load_source('book', path)
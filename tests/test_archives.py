@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Tests for packing exported pages into CBZ and PDF files. Needs Python 2.7, see load_book.py.
+import os
+import re
+import shutil
+import struct
+import tempfile
+import unittest
+import zipfile
+import zlib
+
+from load_book import load_book
+
+book = load_book()
+
+
+def png_chunk(ctype, data):
+    return struct.pack('>I', len(data)) + ctype + data + struct.pack('>I', zlib.crc32(ctype + data) & 0xffffffff)
+
+def rgb_png(width=2, height=2):
+    # A plain black RGB PNG.
+    rows = ('\0' + '\0' * width * 3) * height
+    return ('\x89PNG\r\n\x1a\n' + png_chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            png_chunk('IDAT', zlib.compress(rows)) + png_chunk('IEND', ''))
+
+def jpeg(channels):
+    # The headers of a baseline JPEG with the given number of components, enough for PdfWriter.
+    segment = struct.pack('>BHHB', 8, 2, 2, channels) + '\x01\x11\x00' * channels
+    return '\xff\xd8\xff\xc0' + struct.pack('>H', len(segment) + 2) + segment + '\xff\xd9'
+
+
+@unittest.skipIf(book is None, "book.py needs Python 2")
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='book_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def page(self, name, data):
+        path = os.path.join(self.folder, name)
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        return path
+
+    def info(self, title=u"Book", **fields):
+        return { 'title': title, 'righttoleft': False, 'info': fields }
+
+
+class CbzWriterTest(ArchiveTest):
+    def test_unicode_comic_info(self):
+        # Fields come back from json as unicode, or utf-8 encoded from utf8(), and may not be ASCII.
+        info = self.info(u"Sögur", Writer=u"Ragnar Brynjúlfsson", Summary="Um b\xc3\xb3k", Number=3)
+        cbz = book.CbzWriter(os.path.join(self.folder, "book.cbz"), info)
+        cbz.add(self.page("1_book.png", rgb_png()), 1)
+        cbz.close()
+        archive = zipfile.ZipFile(os.path.join(self.folder, "book.cbz"))
+        xml = archive.read('ComicInfo.xml').decode('utf-8')
+        self.assertTrue(u"<Title>Sögur</Title>" in xml)
+        self.assertTrue(u"<Writer>Ragnar Brynjúlfsson</Writer>" in xml)
+        self.assertTrue(u"<Summary>Um bók</Summary>" in xml)
+        self.assertTrue(u"<Number>3</Number>" in xml)
+        self.assertEqual(archive.namelist(), [ "1_book.png", "ComicInfo.xml" ])
+
+    def test_comic_info_is_escaped(self):
+        cbz = book.CbzWriter(os.path.join(self.folder, "book.cbz"), self.info(u"Cats & <Dogs>"))
+        cbz.close()
+        xml = zipfile.ZipFile(os.path.join(self.folder, "book.cbz")).read('ComicInfo.xml')
+        self.assertTrue("<Title>Cats &amp; &lt;Dogs&gt;</Title>" in xml)
+
+
+class PdfWriterTest(ArchiveTest):
+    def check_xref(self, path):
+        # Every offset in the cross reference table points at the object of its number.
+        data = open(path, "rb").read()
+        xref = data[data.rindex("\nxref\n") + 1:].splitlines()
+        count = int(xref[1].split()[1])
+        for number, line in enumerate(xref[3:3 + count - 1]):
+            offset = int(line[:10])
+            self.assertTrue(line.endswith(" n "))
+            self.assertTrue(data[offset:].startswith("%d 0 obj" % (number + 1)))
+        return data
+
+    def test_pages_in_book_order(self):
+        pdf = book.PdfWriter(os.path.join(self.folder, "book.pdf"), self.info(u"Bók", Writer=u"Ragnar Brynjúlfsson"))
+        pdf.add(self.page("2.png", rgb_png(4, 2)), 2)
+        pdf.add(self.page("1.jpg", jpeg(3)), 1)
+        pdf.close()
+        data = self.check_xref(os.path.join(self.folder, "book.pdf"))
+        kids = re.search(r"/Kids \[(.*?)\]", data).group(1)
+        self.assertEqual(kids, "%d 0 R %d 0 R" % (pdf.pages[1], pdf.pages[2]))
+
+    def test_broken_pages_roll_back(self):
+        # Broken pages raise ValueError, and leave the PDF as it was, so it can still be finished.
+        path = os.path.join(self.folder, "book.pdf")
+        pdf = book.PdfWriter(path, self.info())
+        pdf.add(self.page("1.png", rgb_png()), 1)
+        pdf.file.flush()
+        size = os.path.getsize(path)
+        broken = [ rgb_png()[:40], rgb_png()[:-12], "\xff\xd8\xff\xe0\x00", jpeg(2), "not an image" ]
+        for n, data in enumerate(broken):
+            self.assertRaises(ValueError, pdf.add, self.page("broken%d" % (n), data), 2)
+            pdf.file.flush()
+            self.assertEqual(os.path.getsize(path), size)
+        pdf.add(self.page("3.png", rgb_png()), 3)
+        pdf.close()
+        self.assertFalse(None in pdf.offsets[1:]) # Object 0 is the head of the free list.
+        self.check_xref(path)
+        self.assertEqual(sorted(pdf.pages), [ 1, 3 ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Tests for logging changes to a book in its journal, and keeping its pages in a database. Needs Python 2.7, see load_book.py.
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from load_book import load_book
+
+book = load_book()
+
+
+def changed(old, new):
+    # Apply book_changes of old and new to a copy of old.
+    metadata = json.loads(json.dumps(old))
+    book.apply_book_changes(metadata, book.book_changes(old, new))
+    return metadata
+
+
+@unittest.skipIf(book is None, "book.py needs Python 2")
+class BookChangesTest(unittest.TestCase):
+    def test_round_trip(self):
+        old = { 'name': "Book", 'pages': [ "a", "b", "c", "d", "e" ] }
+        for pages in [ [ "a", "b", "c", "d", "e" ],
+                       [ "b", "c", "d", "e", "a" ],
+                       [ "a", "c", "d", "e" ],
+                       [ "x", "a", "b", "c", "d", "e", "y" ],
+                       [ "a", "b", "renamed", "d", "e" ],
+                       [ "e", "d", "c", "b", "a" ],
+                       [] ]:
+            new = { 'name': "Book", 'pages': pages }
+            self.assertEqual(changed(old, new), new)
+
+    def test_moving_a_page_is_two_operations(self):
+        pages = [ "p%d" % (n) for n in range(1000) ]
+        moved = pages[:10] + pages[11:500] + pages[10:11] + pages[500:]
+        ops = book.book_changes({ 'pages': pages }, { 'pages': moved })
+        self.assertEqual(len(ops), 2)
+
+    def test_other_keys(self):
+        old = { 'name': "Book", 'righttoleft': False, 'pages': [ "a" ] }
+        new = { 'name': "Bók", 'righttoleft': True, 'pages': [ "a" ] }
+        ops = book.book_changes(old, new)
+        self.assertEqual(sorted([ op['key'] for op in ops ]), [ 'name', 'righttoleft' ])
+        self.assertEqual(changed(old, new), new)
+
+
+@unittest.skipIf(book is None, "book.py needs Python 2")
+class BookFileTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='book_test_')
+        self.bookfile = os.path.join(self.folder, "Book.book")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+class BookJournalTest(BookFileTest):
+    def log(self, revisions):
+        # Journal each revision of the pages, and return the metadata they end up at.
+        journal = book.BookJournal(self.bookfile)
+        metadata = { 'pages': [ "a", "b" ] }
+        for revision, pages in enumerate(revisions):
+            new = { 'pages': pages }
+            journal.append(revision + 1, book.book_changes(metadata, new))
+            metadata = new
+        journal.file.close()
+        return metadata
+
+    def test_replay(self):
+        final = self.log([ [ "a", "b", "c" ], [ "c", "a", "b" ], [ "c", "b" ] ])
+        metadata = { 'revision': 0, 'pages': [ "a", "b" ] }
+        journal = book.BookJournal(self.bookfile)
+        journal.replay(metadata)
+        self.assertEqual(metadata, { 'revision': 3, 'pages': final['pages'] })
+        self.assertEqual(journal.lines, 3)
+
+    def test_replay_newer_revisions_only(self):
+        # The *.book file was written at revision 2, so only the last revision is applied.
+        self.log([ [ "a", "b", "c" ], [ "c", "a", "b" ], [ "c", "b" ] ])
+        metadata = { 'revision': 2, 'pages': [ "c", "a", "b" ] }
+        book.BookJournal(self.bookfile).replay(metadata)
+        self.assertEqual(metadata['pages'], [ "c", "b" ])
+
+    def test_replay_stops_at_a_line_cut_short(self):
+        self.log([ [ "a", "b", "c" ], [ "c", "a", "b" ], [ "c", "b" ] ])
+        path = os.path.join(self.folder, book.BOOKJOURNAL)
+        lines = open(path).read().splitlines(True)
+        f = open(path, "w")
+        f.write(lines[0] + lines[1][:len(lines[1]) / 2] + "\n" + lines[2])
+        f.close()
+        metadata = { 'revision': 0, 'pages': [ "a", "b" ] }
+        journal = book.BookJournal(self.bookfile)
+        journal.replay(metadata)
+        self.assertEqual(metadata, { 'revision': 1, 'pages': [ "a", "b", "c" ] })
+        self.assertEqual(journal.lines, 1)
+
+    def test_clear(self):
+        self.log([ [ "a" ] ])
+        journal = book.BookJournal(self.bookfile)
+        journal.clear()
+        self.assertFalse(os.path.exists(os.path.join(self.folder, book.BOOKJOURNAL)))
+        metadata = { 'pages': [ "a", "b" ] }
+        journal.replay(metadata)
+        self.assertEqual(metadata, { 'pages': [ "a", "b" ] })
+
+
+class BookDatabaseTest(BookFileTest):
+    def setUp(self):
+        BookFileTest.setUp(self)
+        self.db = book.BookDatabase(self.bookfile)
+        self.pages = [ "a", "b", "Síða", "d" ]
+        self.db.replace(self.pages)
+
+    def tearDown(self):
+        self.db.close()
+        BookFileTest.tearDown(self)
+
+    def change(self, pages):
+        # Apply the changes to the database, and check it has the new pages, also when opened again.
+        rest = self.db.apply(book.book_changes({ 'pages': self.pages }, { 'pages': pages }))
+        self.assertEqual(rest, [])
+        self.pages = pages
+        self.assertEqual(self.db.pages(), pages)
+        db = book.BookDatabase(self.bookfile)
+        self.assertEqual(db.pages(), pages)
+        db.close()
+
+    def ids(self):
+        self.db.pages()
+        return [ rowid for rowid, position in self.db.rows ]
+
+    def test_rename_updates_the_row(self):
+        ids = self.ids()
+        self.change([ "a", "b", "Önnur síða", "d" ])
+        self.assertEqual(self.ids(), ids)
+
+    def test_move(self):
+        ids = self.ids()
+        self.change([ "d", "a", "b", "Síða" ])
+        self.assertEqual(sorted(self.ids()), sorted(ids))
+        self.change([ "a", "b", "Síða", "d" ])
+
+    def test_insert_and_delete(self):
+        self.change([ "new", "a", "Síða", "d", "end" ])
+        self.change([ "new", "d" ])
+        self.change([])
+
+    def test_inserting_in_the_same_gap_respaces(self):
+        pages = list(self.pages)
+        for n in range(80):
+            pages.insert(1, "p%d" % (n))
+            self.change(list(pages))
+
+    def test_other_operations_are_returned(self):
+        rest = self.db.apply([ { 'op': 'set', 'key': 'name', 'value': "Book" } ])
+        self.assertEqual(rest, [ { 'op': 'set', 'key': 'name', 'value': "Book" } ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# Tests for the layer tags in booktags.py, which run without GIMP:
+#   python -m pytest tests
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'book'))
+
+from booktags import TagFilter, tag_filter, layer_tags, xcf_layers
+
+
+class TagFilterTest(unittest.TestCase):
+    def test_hide_and_show(self):
+        tags = TagFilter("de", "en")
+        self.assertEqual(tags.visibility("Text [en]"), True)
+        self.assertEqual(tags.visibility("Text [de]"), False)
+        self.assertEqual(tags.visibility("Background"), None)
+
+    def test_hide_wins_over_show(self):
+        tags = TagFilter("draft", "en")
+        self.assertEqual(tags.visibility("Text [en] [draft]"), False)
+        self.assertEqual(tags.visibility("Text [draft][en]"), False)
+
+    def test_untagged_show(self):
+        tags = TagFilter("de", "en", 1)
+        self.assertEqual(tags.visibility("Background"), True)
+        self.assertEqual(tags.visibility("Text [fr]"), True)
+        self.assertEqual(tags.visibility("Text [de]"), False)
+
+    def test_untagged_hide(self):
+        tags = TagFilter("de", "en", 2)
+        self.assertEqual(tags.visibility("Background"), False)
+        self.assertEqual(tags.visibility("Text [en]"), True)
+
+    def test_whitespace_is_stripped(self):
+        tags = TagFilter(" de , draft ,, ", " en ")
+        self.assertEqual(tags.hide, frozenset([ "de", "draft" ]))
+        self.assertEqual(tags.show, frozenset([ "en" ]))
+        self.assertEqual(tags.visibility("Text [ en ]"), True)
+        self.assertEqual(tags.visibility("Sketch [draft ]"), False)
+
+    def test_active(self):
+        self.assertFalse(TagFilter("", " , ").active())
+        self.assertTrue(TagFilter("", "", 2).active())
+        self.assertTrue(TagFilter("de", "").active())
+
+    def test_resolve_nested_groups(self):
+        # Only layers whose visibility changes are listed, by their path through the groups.
+        layers = [ ([ 0 ], "Text", True),
+                   ([ 0, 0 ], "Speech [en]", False),
+                   ([ 0, 1 ], "Speech [de]", True),
+                   ([ 0, 2 ], "Inner", True),
+                   ([ 0, 2, 0 ], "Caption [de]", True),
+                   ([ 0, 2, 1 ], "Caption [en]", True),
+                   ([ 1 ], "Background", True) ]
+        changes = TagFilter("de", "en").resolve(layers)
+        self.assertEqual(changes, { (0, 0): True, (0, 1): False, (0, 2, 0): False })
+
+    def test_tag_filter_is_shared(self):
+        settings = { 'taghide': "de", 'tagshow': "en", 'tagun': 0 }
+        self.assertTrue(tag_filter(settings) is tag_filter(dict(settings)))
+
+
+class LayerTagsTest(unittest.TestCase):
+    def test_nested_paths(self):
+        layers = [ ([ 0 ], "Text", True),
+                   ([ 0, 0 ], "Inner", True),
+                   ([ 0, 0, 0 ], "Caption [ en ]", True),
+                   ([ 1 ], "Sketch [draft] [en]", False),
+                   ([ 2 ], "Empty []", True) ]
+        self.assertEqual(layer_tags(layers), { "en": [ "Text/Inner/Caption [ en ]", "Sketch [draft] [en]" ],
+                                               "draft": [ "Sketch [draft] [en]" ] })
+
+    def test_xcf_layers(self):
+        # Top level layers have no saved path, and are numbered in order. Floating selections are left out.
+        class Xcf():
+            layers = [ { 'floating': False, 'path': [], 'name': "Group", 'visible': True },
+                       { 'floating': False, 'path': [ 0, 0 ], 'name': "In [en]", 'visible': False },
+                       { 'floating': True, 'path': [], 'name': "Floating", 'visible': True },
+                       { 'floating': False, 'path': [], 'name': "Background", 'visible': True } ]
+        self.assertEqual(xcf_layers(Xcf()), [ ([ 0 ], "Group", True), ([ 0, 0 ], "In [en]", False), ([ 1 ], "Background", True) ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# Tests for the export manifest, and removing the files of deleted and renumbered pages. Needs Python 2.7, see load_book.py.
+import os
+import shutil
+import tempfile
+import unittest
+
+from load_book import load_book
+
+book = load_book()
+
+
+@unittest.skipIf(book is None, "book.py needs Python 2")
+class RemoveStaleTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='book_test_')
+        self.manifest = book.ExportManifest(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def export(self, name, page, settingshash='png'):
+        # Write a file, and record it as exported from the page, or list of pages.
+        f = open(os.path.join(self.folder, name), "w")
+        f.write(name)
+        f.close()
+        if isinstance(page, list):
+            signature = [ { 'mtime': 0, 'size': 0, 'hash': p } for p in page ]
+        else:
+            signature = { 'mtime': 0, 'size': 0, 'hash': page }
+        self.manifest.update(name, page, signature, settingshash)
+
+    def files(self):
+        return sorted([ name for name in os.listdir(self.folder) if name != book.EXPORTMANIFEST ])
+
+    def test_deleted_pages(self):
+        self.export("1_a.png", "a")
+        self.export("2_b.png", "b")
+        self.export("3_c.png", "c")
+        self.manifest.remove_stale([ "a", "b" ], [ ('png', '.png', [ "1_a.png", "2_b.png" ], None) ])
+        self.assertEqual(self.files(), [ "1_a.png", "2_b.png" ])
+        self.assertEqual(sorted(self.manifest.files), [ "1_a.png", "2_b.png" ])
+        self.assertTrue(self.manifest.dirty)
+
+    def test_renumbered_pages(self):
+        # A page inserted before b moves it to page 3, so its old file is replaced.
+        self.export("1_a.png", "a")
+        self.export("2_b.png", "b")
+        self.manifest.remove_stale([ "a", "new", "b" ], [ ('png', '.png', [ "1_a.png", "2_new.png", "3_b.png" ], None) ])
+        self.assertEqual(self.files(), [ "1_a.png" ])
+
+    def test_renumbered_with_other_settings(self):
+        # Changing the settings gives the files a new settings hash, but the extension still says they're replaced.
+        self.export("2_b.png", "b", 'old')
+        self.manifest.remove_stale([ "a", "b" ], [ ('new', '.png', [ "1_a.png", "3_b.png" ], None) ])
+        self.assertEqual(self.files(), [])
+
+    def test_other_formats_are_kept(self):
+        self.export("2_b.jpg", "b", 'jpg')
+        self.export("2_b.png", "b", 'png')
+        self.manifest.remove_stale([ "a", "b" ], [ ('png', '.png', [ "1_a.png", "3_b.png" ], None) ])
+        self.assertEqual(self.files(), [ "2_b.jpg" ])
+
+    def test_pages_out_of_range_are_kept(self):
+        # Exporting pages 1 to 2 leaves the files of the pages after them be, even though the edition doesn't make them.
+        self.export("1_a.png", "a")
+        self.export("3_c.png", "c")
+        self.manifest.remove_stale([ "a", "b", "c" ], [ ('png', '.png', [ "1_a.png", "2_b.png" ], [ "a", "b" ]) ])
+        self.assertEqual(self.files(), [ "1_a.png", "3_c.png" ])
+
+    def test_sheets(self):
+        self.export("02-03_book.png", [ "b", "c" ])
+        self.export("04-05_book.png", [ "d", "e" ])
+        self.export("06-07_book.png", [ "f", "g" ])
+        # Sheets from before the pages were recorded can't be checked, and are kept.
+        self.export("08-09_book.png", [ "h", "i" ])
+        del self.manifest.files["08-09_book.png"]['pages']
+        self.manifest.remove_stale([ "a", "b", "c", "d", "f", "g" ],
+                                   [ ('png', '.png', [ "02-03_book.png", "04-05_book.png" ], [ "b", "c", "d", "f" ]) ])
+        self.assertEqual(self.files(), [ "02-03_book.png", "06-07_book.png", "08-09_book.png" ])
+
+    def test_files_not_in_the_manifest_are_kept(self):
+        f = open(os.path.join(self.folder, "notes.txt"), "w")
+        f.close()
+        self.manifest.remove_stale([], [ ('png', '.png', [], None) ])
+        self.assertEqual(self.files(), [ "notes.txt" ])
+
+    def test_saved(self):
+        self.export(u"1_S\xf6gur.png".encode('utf-8'), u"S\xf6gur".encode('utf-8'))
+        self.manifest.save()
+        self.assertFalse(self.manifest.dirty)
+        manifest = book.ExportManifest(self.folder)
+        self.assertEqual(manifest.files.keys(), [ u"1_S\xf6gur.png" ])
+        self.assertEqual(manifest.files[u"1_S\xf6gur.png"]['page'], u"S\xf6gur")
+        manifest.remove_stale([ u"S\xf6gur".encode('utf-8') ], [ ('png', '.png', [ u"1_S\xf6gur.png".encode('utf-8') ], None) ])
+        self.assertFalse(manifest.dirty)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# Tests for saving pages a strip of rows at a time. Needs Python 2.7, see load_book.py.
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from load_book import load_book
+
+book = load_book()
+
+SETTINGS = { 'pnggamma': False, 'pngbgcolor': True, 'pngresolution': True, 'pnglayeroffset': False,
+             'pngcreationtime': False, 'pngcompress': 9, 'tifcompress': 0 }
+
+
+def png_chunks(data):
+    # The type and data of each chunk of a PNG, checking their CRCs.
+    chunks = []
+    pos = 8
+    while pos < len(data):
+        length, ctype = struct.unpack('>I4s', data[pos:pos+8])
+        body = data[pos+8:pos+8+length]
+        crc, = struct.unpack('>I', data[pos+8+length:pos+12+length])
+        assert crc == zlib.crc32(ctype + body) & 0xffffffff
+        chunks.append((ctype, body))
+        pos += 12 + length
+    return chunks
+
+
+@unittest.skipIf(book is None, "book.py needs Python 2")
+class StripWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='book_test_')
+        self.path = os.path.join(self.folder, "page")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, cls, width, height, channels, rows, settings=SETTINGS, background=(255, 0, 0)):
+        # Write the rows in strips of two rows, and return the file.
+        writer = cls(self.path, width, height, channels, 300.0, settings, list(background))
+        strip = width * channels * 2
+        for r in range(0, len(rows), strip):
+            writer.write(rows[r:r+strip])
+        writer.close()
+        return open(self.path, "rb").read()
+
+    def test_gray_level(self):
+        self.assertEqual(book.gray_level([ 0, 0, 0 ]), 0)
+        self.assertEqual(book.gray_level([ 255, 255, 255 ]), 255)
+        self.assertEqual(book.gray_level([ 255, 0, 0 ]), 76)
+
+    def test_png_rgb(self):
+        rows = "".join([ chr(i % 256) for i in range(3 * 3 * 5) ])
+        chunks = png_chunks(self.write(book.PngStripWriter, 3, 5, 3, rows))
+        self.assertEqual(chunks[0], ('IHDR', struct.pack('>IIBBBBB', 3, 5, 8, 2, 0, 0, 0)))
+        self.assertEqual(dict(chunks)['bKGD'], struct.pack('>HHH', 255, 0, 0))
+        pixels = zlib.decompress("".join([ body for ctype, body in chunks if ctype == 'IDAT' ]))
+        self.assertEqual(pixels, "".join([ '\0' + rows[r:r+9] for r in range(0, len(rows), 9) ]))
+        self.assertEqual(chunks[-1], ('IEND', ''))
+
+    def test_png_gray_background_is_luma(self):
+        # Gray pages are filled with the luma of the margin color, and so tagged with it, not its red value.
+        chunks = png_chunks(self.write(book.PngStripWriter, 2, 2, 1, "\0\1\2\3"))
+        self.assertEqual(chunks[0], ('IHDR', struct.pack('>IIBBBBB', 2, 2, 8, 0, 0, 0, 0)))
+        self.assertEqual(dict(chunks)['bKGD'], struct.pack('>H', 76))
+
+    def test_tiff_strips(self):
+        rows = "".join([ chr(i) for i in range(4 * 5) ])
+        data = self.write(book.TiffStripWriter, 4, 5, 1, rows)
+        self.assertEqual(data[:4], 'II*\0')
+        ifd, = struct.unpack('<I', data[4:8])
+        count, = struct.unpack('<H', data[ifd:ifd+2])
+        entries = {}
+        for e in range(count):
+            tag, ftype, n, value = struct.unpack('<HHII', data[ifd+2+e*12:ifd+14+e*12])
+            entries[tag] = (n, value)
+        self.assertEqual(entries[256][1], 4)
+        self.assertEqual(entries[257][1], 5)
+        self.assertEqual(entries[278][1], 2) # Rows per strip.
+        offsets = struct.unpack('<3I', data[entries[273][1]:entries[273][1]+12])
+        counts = struct.unpack('<3I', data[entries[279][1]:entries[279][1]+12])
+        self.assertEqual("".join([ data[o:o+c] for o, c in zip(offsets, counts) ]), rows)
+
+    def test_bmp_gray_is_written_as_rgb(self):
+        data = self.write(book.BmpStripWriter, 2, 2, 1, "\0\1\2\3")
+        self.assertEqual(struct.unpack('<ii', data[18:26]), (2, -2))
+        # Rows of 6 bytes, padded to 8.
+        self.assertEqual(data[54:], "\0\0\0\1\1\1\0\0" + "\2\2\2\3\3\3\0\0")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# Tests for reading XCF files without GIMP. Needs Python 2.7, see load_book.py.
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from load_book import load_book
+
+book = load_book()
+
+
+def prop(ptype, data):
+    return struct.pack('>II', ptype, len(data)) + data
+
+def xcf(layers, basetype=0):
+    # A version 0 XCF file with the given (name, visible, offsets) layers, and no pixels.
+    header = 'gimp xcf file\0' + struct.pack('>III', 100, 50, basetype)
+    header += prop(17, '\1') + prop(0, '')
+    start = len(header) + 4 * (len(layers) + 2) # After the layer and channel pointer lists.
+    data = ""
+    pointers = []
+    for name, visible, offsets in layers:
+        pointers.append(start + len(data))
+        data += struct.pack('>III', 10, 10, 1) + struct.pack('>I', len(name) + 1) + name + '\0'
+        data += prop(8, struct.pack('>I', visible)) + prop(15, struct.pack('>ii', *offsets)) + prop(0, '')
+        data += struct.pack('>II', 0, 0) # No hierarchy or mask.
+    return header + struct.pack('>%dI' % (len(pointers) + 2), *(pointers + [ 0, 0 ])) + data
+
+
+@unittest.skipIf(book is None, "book.py needs Python 2")
+class RleDecodeTest(unittest.TestCase):
+    def test_runs(self):
+        # A run of 3 identical bytes, 2 different ones, and long runs of each kind.
+        src = bytearray('\x02a' + '\xfexy' + '\x7f\x00\x04b' + '\x80\x00\x03pqr' + 'tail')
+        out, pos = book.rle_decode(src, 0, 3 + 2 + 4 + 3)
+        self.assertEqual(str(out), 'aaaxybbbbpqr')
+        self.assertEqual(pos, len(src) - 4)
+
+    def test_truncated(self):
+        # Cut short anywhere, the data raises XcfError rather than IndexError.
+        for src in [ '', '\x02', '\x7f', '\x7f\x00', '\x7f\x00\x04', '\x80\x00', '\x80\x00\x03pq', '\xfex', '\x02a' ]:
+            self.assertRaises(book.XcfError, book.rle_decode, bytearray(src), 0, 12)
+
+    def test_run_past_the_tile(self):
+        self.assertRaises(book.XcfError, book.rle_decode, bytearray('\x05a'), 0, 3)
+
+
+@unittest.skipIf(book is None, "book.py needs Python 2")
+class XcfReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='book_test_')
+        self.path = os.path.join(self.folder, "page.xcf")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def reader(self, data):
+        f = open(self.path, "wb")
+        f.write(data)
+        f.close()
+        return book.XcfReader(self.path)
+
+    def test_layers(self):
+        xcfr = self.reader(xcf([ ("Ink [en]", 1, (0, 0)), ("Sketch", 0, (-5, 7)) ]))
+        self.assertEqual((xcfr.width, xcfr.height), (100, 50))
+        self.assertEqual([ l['name'] for l in xcfr.layers ], [ "Ink [en]", "Sketch" ])
+        self.assertEqual([ l['visible'] for l in xcfr.layers ], [ True, False ])
+        self.assertEqual(xcfr.layers[1]['offsets'], (-5, 7))
+        xcfr.close()
+
+    def test_unsupported_and_corrupt(self):
+        self.assertRaises(book.XcfError, self.reader, "not an xcf file at all, just text padding it out")
+        self.assertRaises(book.XcfError, self.reader, xcf([], basetype=2)) # Indexed.
+        self.assertRaises(book.XcfError, self.reader, xcf([ ("Ink", 1, (0, 0)) ])[:-20])
+
+    def test_rle_tiles(self):
+        # Tiles of two channels of three pixels, RLE compressed channel by channel, the second one cut short.
+        data = xcf([])
+        xcfr = self.reader(data + '\x02a\x02b' + '\x02a\x7f')
+        self.assertEqual([ str(p) for p in xcfr.read_tile(len(data), len(data) + 4, 3, 2) ], [ 'aaa', 'bbb' ])
+        self.assertRaises(book.XcfError, xcfr.read_tile, len(data) + 4, 0, 3, 2)
+        xcfr.close()
+
+if __name__ == '__main__':
+    unittest.main()